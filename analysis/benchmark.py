@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:12:40 2026
+
+@author: Tempesta_team
+
+Benchmark suite for the localization analysis. Synthetic SMLM stacks with
+known emitter positions are generated with the same gaussian PSF model used
+by tools.kernel and tools.get_fwhm, and the analysis chain of
+stack.localize_chunk is timed stage by stage (background estimation,
+detection, parameter extraction and fitting). Every run also reports the
+localization precision against the ground truth so that a speedup is only
+accepted when the accuracy holds (see check_accuracy).
+
+Usage:
+    python -m analysis.benchmark --frames 50 --sizes 64 128 --save ref.json
+    python -m analysis.benchmark --reference ref.json
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+from scipy.ndimage import shift
+
+import analysis.tools as tools
+import analysis.maxima as maxima
+import analysis.stack as stack
+
+
+def psf_fwhm(lambda_em=670, NA=1.42, nm_per_px=120):
+    """ FWHM in px of the PSF, computed the same way as in stack.Stack."""
+    return tools.get_fwhm(lambda_em, NA) / nm_per_px
+
+
+def emitter_positions(shape, n, margin, rng):
+    """ Uniformly distributed emitter positions at least margin px away from
+    the frame edges. Positions use the pixel-edge convention of the fitter:
+    pixel i spans [i, i + 1) so its center is at i + 0.5."""
+    x = rng.uniform(margin, shape[0] - margin, n)
+    y = rng.uniform(margin, shape[1] - margin, n)
+    return np.column_stack((x, y))
+
+
+def render_frame(shape, positions, photons, fwhm, bkg, rng):
+    """ Poisson-noisy frame with one gaussian spot per position. Every spot
+    is the tools.kernel PSF (a normalized product of tools.best_gauss) shifted
+    to the subpixel position of the emitter."""
+    mean = np.full(shape, float(bkg))
+    half = int(np.ceil(2*fwhm)) + 1
+    for x0, y0 in positions:
+        i0, j0 = int(x0), int(y0)
+        i = np.arange(max(i0 - half, 0), min(i0 + half + 1, shape[0]))
+        j = np.arange(max(j0 - half, 0), min(j0 + half + 1, shape[1]))
+        spot = np.outer(tools.best_gauss(i + 0.5, x0, fwhm),
+                        tools.best_gauss(j + 0.5, y0, fwhm))
+        mean[i[0]:i[-1] + 1, j[0]:j[-1] + 1] += photons * spot / spot.sum()
+
+    return rng.poisson(mean).astype(np.uint16)
+
+
+def synthetic_stack(n_frames, shape, density, fwhm, photons=1000, bkg=10,
+                    nm_per_px=120, seed=0):
+    """ Synthetic SMLM stack. Density is given in molecules/µm². Returns the
+    stack and the ground truth as a record array with fields frame, x, y."""
+    rng = np.random.RandomState(seed)
+    area_um2 = shape[0] * shape[1] * (nm_per_px / 1000)**2
+    margin = int(np.ceil(fwhm)) + 2
+
+    data = np.zeros((n_frames,) + tuple(shape), dtype=np.uint16)
+    truth = []
+    for n in np.arange(n_frames):
+        n_mol = rng.poisson(density * area_um2)
+        pos = emitter_positions(shape, n_mol, margin, rng)
+        data[n] = render_frame(shape, pos, photons, fwhm, bkg, rng)
+        truth.extend((n, p[0], p[1]) for p in pos)
+
+    truth = np.array(truth, dtype=[('frame', int), ('x', float),
+                                   ('y', float)])
+    return data, truth
+
+
+def localize_timed(data, fwhm, fit_model='2d'):
+    """ Same analysis as stack.localize_chunk, but timing every stage
+    separately. Returns the localizations and a dict of stage times in s."""
+    win_size = int(np.ceil(fwhm))
+    kernel = tools.kernel(fwhm)
+    xkernel = tools.xkernel(fwhm)
+    fit_parameters = maxima.fit_par(fit_model)
+    res_dt = maxima.results_dt(fit_parameters)
+
+    times = {'background': 0., 'detection': 0., 'parameters': 0.,
+             'fitting': 0.}
+    failed = 0
+
+    t0 = time.perf_counter()
+    bkg_stack = stack.bkg_estimation(data)
+    times['background'] = time.perf_counter() - t0
+
+    results = []
+    for n in np.arange(len(data)):
+        t0 = time.perf_counter()
+        maxi = maxima.Maxima(data[n], fit_parameters, res_dt, fwhm, win_size,
+                             kernel, xkernel, bkg_stack[n])
+        maxi.find()
+        t1 = time.perf_counter()
+        times['detection'] += t1 - t0
+
+        if len(maxi.positions) == 0:
+            continue
+
+        try:
+            maxi.getParameters()
+            t2 = time.perf_counter()
+            times['parameters'] += t2 - t1
+            maxi.fit(fit_model)
+            times['fitting'] += time.perf_counter() - t2
+        except (RuntimeWarning, ValueError):
+            # maxima turns numpy warnings into errors, a single bad spot
+            # makes the whole frame fail
+            failed += 1
+            continue
+
+        maxi.results['frame'] = n
+        results.append(maxi.results)
+
+    if len(results) > 0:
+        results = np.concatenate(results)
+    else:
+        results = np.zeros(0, dtype=res_dt)
+
+    return results, times, failed
+
+
+def match(results, truth, radius=1.):
+    """ Pairs every localization with the closest ground truth emitter of the
+    same frame, if it is closer than radius px. Returns the (dx, dy) errors of
+    the matched pairs in px."""
+    errors = []
+    for n in np.unique(truth['frame']):
+        t = truth[truth['frame'] == n]
+        r = results[results['frame'] == n]
+        if len(r) == 0:
+            continue
+        dx = r['fit_x'][:, np.newaxis] - t['x']
+        dy = r['fit_y'][:, np.newaxis] - t['y']
+        d2 = dx**2 + dy**2
+        closest = np.argmin(d2, 1)
+        rows = np.arange(len(r))
+        ok = d2[rows, closest] < radius**2
+        # one localization per emitter: keep the closest one
+        used = {}
+        for i in rows[ok]:
+            j = closest[i]
+            if j not in used or d2[i, j] < d2[used[j], j]:
+                used[j] = i
+        for j, i in used.items():
+            errors.append((dx[i, j], dy[i, j]))
+
+    return np.array(errors).reshape(-1, 2)
+
+
+def run_case(n_frames, shape, density, photons=1000, bkg=10, nm_per_px=120,
+             seed=0):
+    fwhm = psf_fwhm(nm_per_px=nm_per_px)
+    data, truth = synthetic_stack(n_frames, shape, density, fwhm, photons,
+                                  bkg, nm_per_px, seed)
+
+    t0 = time.perf_counter()
+    results, times, failed = localize_timed(data, fwhm)
+    total = time.perf_counter() - t0
+
+    errors = match(results, truth)
+    if len(errors) > 0:
+        rms = nm_per_px * np.sqrt(np.mean(errors**2, 0))
+        bias = nm_per_px * np.mean(errors, 0)
+    else:
+        rms = bias = np.array([np.nan, np.nan])
+
+    return {'frames': n_frames, 'shape': list(shape), 'density': density,
+            'emitters': len(truth), 'localizations': len(results),
+            'matched': len(errors), 'failed_frames': failed,
+            'recall': len(errors) / max(len(truth), 1),
+            'rms_nm': rms.tolist(), 'bias_nm': bias.tolist(),
+            'total_s': total, 'mol_per_s': len(results) / total,
+            'ms_per_frame': {k: 1000 * v / n_frames
+                             for k, v in times.items()}}
+
+
+def drift_case(shape=(128, 128), true_shift=(1.3, -0.7), density=0.5,
+               seed=0):
+    """ Times xydrift.drift on a synthetic image shifted by a known amount and
+    returns the estimation error in px."""
+    import analysis.xydrift as xydrift
+
+    fwhm = psf_fwhm()
+    rng = np.random.RandomState(seed)
+    data, _ = synthetic_stack(1, shape, density, fwhm, seed=seed)
+    image = data[0].astype(float)
+    shifted = shift(image, true_shift) + rng.normal(0, 1, shape)
+
+    t0 = time.perf_counter()
+    # drift(data1, data2) measures the shift of data1 with respect to data2
+    dx, dy = xydrift.drift(shifted, image)
+    elapsed = time.perf_counter() - t0
+
+    return {'shape': list(shape), 'shift': list(true_shift),
+            'error_px': [dx - true_shift[0], dy - true_shift[1]],
+            'ms': 1000 * elapsed}
+
+
+def run(n_frames=50, sizes=(64, 128), densities=(0.05, 0.2, 0.5), seed=0):
+    results = []
+    for size in sizes:
+        for density in densities:
+            results.append(run_case(n_frames, (size, size), density,
+                                    seed=seed))
+    return results
+
+
+def report(results):
+    header = ('{:>9} {:>7} {:>6} {:>6} {:>7} {:>9} {:>15} {:>8} {:>8} '
+              '{:>8} {:>8}')
+    print(header.format('size', 'density', 'mols', 'recall', 'failed',
+                        'mol/s', 'rms x/y [nm]', 'bkg', 'detect', 'params',
+                        'fit'))
+    row = ('{:>9} {:>7} {:>6} {:>6.2f} {:>7} {:>9.0f} {:>15} {:>8.2f} '
+           '{:>8.2f} {:>8.2f} {:>8.2f}')
+    for r in results:
+        ms = r['ms_per_frame']
+        print(row.format('x'.join(str(s) for s in r['shape']), r['density'],
+                         r['emitters'], r['recall'], r['failed_frames'],
+                         r['mol_per_s'],
+                         '{:.1f}/{:.1f}'.format(*r['rms_nm']),
+                         ms['background'], ms['detection'], ms['parameters'],
+                         ms['fitting']))
+    print('Stage times in ms per frame')
+
+
+def check_accuracy(results, reference, rms_tol=1.0, recall_tol=0.02):
+    """ Compares a benchmark run against a reference run with the same
+    parameters. A faster implementation is acceptable only if the rms error
+    does not grow by more than rms_tol nm and the recall does not drop by more
+    than recall_tol. Returns a list of the failing cases (empty if ok)."""
+    failures = []
+    for new, ref in zip(results, reference):
+        worse_rms = np.nanmax(np.array(new['rms_nm']) -
+                              np.array(ref['rms_nm'])) > rms_tol
+        worse_recall = ref['recall'] - new['recall'] > recall_tol
+        if worse_rms or worse_recall:
+            failures.append((new, ref))
+
+    return failures
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--frames', type=int, default=50)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128])
+    parser.add_argument('--densities', type=float, nargs='+',
+                        default=[0.05, 0.2, 0.5])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='store results as json')
+    parser.add_argument('--reference', help='json results to compare with')
+    args = parser.parse_args()
+
+    results = run(args.frames, args.sizes, args.densities, args.seed)
+    report(results)
+
+    drift = drift_case()
+    print('xydrift.drift: {:.1f} ms, error {:.3f}/{:.3f} px'.format(
+        drift['ms'], *drift['error_px']))
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({'localization': results, 'drift': drift}, f, indent=1)
+
+    if args.reference is not None:
+        with open(args.reference) as f:
+            reference = json.load(f)['localization']
+        failures = check_accuracy(results, reference)
+        if failures:
+            for new, ref in failures:
+                print('Accuracy regression in {} @ {}/µm²: rms {} -> {} nm, '
+                      'recall {:.2f} -> {:.2f}'.format(
+                          new['shape'], new['density'], ref['rms_nm'],
+                          new['rms_nm'], ref['recall'], new['recall']))
+            raise SystemExit(1)
+        print('Accuracy holds with respect to', args.reference)
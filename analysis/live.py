@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 17:04:33 2026
+
+@author: Tempesta_team
+
+Localization of single frames during the acquisition (see
+control.livesmlm). localize_frame runs in the worker processes of a pool.
+analysis.maxima turns every numpy warning into an error when imported, so it
+is only imported inside the workers and never in the acquisition process.
+"""
+
+import numpy as np
+
+# Kernels and fit settings of each worker process, by settings
+_setup = {}
+
+
+def setup(settings):
+    """ FWHM, window size and kernels for the given (lambda_em [nm], NA,
+    nm_per_px, fit model) settings, computed once per worker."""
+    try:
+        return _setup[settings]
+    except KeyError:
+        import analysis.tools as tools
+        import analysis.maxima as maxima
+
+        lambda_em, NA, nm_per_px, fit_model = settings
+        fwhm = tools.get_fwhm(lambda_em, NA) / nm_per_px
+        fit_parameters = maxima.fit_par(fit_model)
+        _setup[settings] = (fit_parameters, maxima.results_dt(fit_parameters),
+                            fwhm, int(np.ceil(fwhm)), tools.kernel(fwhm),
+                            tools.xkernel(fwhm))
+        return _setup[settings]
+
+
+def localize_frame(args):
+    """ Finds and fits the molecules of a frame. args is (frame, background
+    estimate or None to use the frame, frame number, settings). Returns the
+    frame number and the results array of analysis.maxima, or None if the
+    frame failed."""
+    import analysis.maxima as maxima
+
+    frame, bkg, number, settings = args
+    frame = np.asarray(frame, dtype=np.float64)
+    if bkg is None:
+        bkg = frame
+    max_args = setup(settings)
+    try:
+        maxi = maxima.Maxima(frame, *max_args, bkg_image=bkg)
+        maxi.find()
+        if len(maxi.positions) == 0:
+            return number, np.zeros(0, dtype=max_args[1])
+        maxi.getParameters()
+        maxi.fit(settings[3])
+    except (RuntimeWarning, ValueError):
+        # maxima turns numpy warnings into errors, a single bad spot makes
+        # the whole frame fail
+        return number, None
+
+    maxi.results['frame'] = number
+    return number, maxi.results
+
+
+class LiveHistogram():
+    """ Super-resolution histogram of the localizations, zoom bins per
+    camera pixel (less if the histogram would be larger than maxSize bins
+    per side), and number of molecules of the last maxlen analysed
+    frames."""
+
+    def __init__(self, shape, zoom=8, maxlen=2000, maxSize=4096):
+        self.shape = tuple(shape)
+        self.zoom = max(1, min(zoom, maxSize // max(self.shape)))
+        self.maxlen = maxlen
+        self.reset()
+
+    def reset(self):
+        self.image = np.zeros((self.shape[0]*self.zoom,
+                               self.shape[1]*self.zoom), dtype=np.uint32)
+        self.numbers = np.zeros(0, dtype=int)
+        self.counts = np.zeros(0, dtype=int)
+        self.nMolecules = 0
+
+    def add(self, number, results):
+        x = (results['fit_x'] * self.zoom).astype(int)
+        y = (results['fit_y'] * self.zoom).astype(int)
+        inside = ((x >= 0) & (x < self.image.shape[0]) &
+                  (y >= 0) & (y < self.image.shape[1]))
+        np.add.at(self.image, (x[inside], y[inside]), 1)
+        self.nMolecules += inside.sum()
+
+        self.numbers = np.append(self.numbers[-self.maxlen + 1:], number)
+        self.counts = np.append(self.counts[-self.maxlen + 1:], len(results))
@@ -21,7 +21,7 @@ import analysis.tools as tools
 
 # data-type definitions
 def fit_par(fit_model):
-    if fit_model is '2d':
+    if fit_model == '2d':
         return [('amplitude_fit', float), ('fit_x', float), ('fit_y', float),
                 ('background_fit', float)]
 
@@ -37,9 +37,11 @@ class Maxima():
     """ Class defined as the local maxima in an image frame. """
 
     def __init__(self, image, fit_par=None, dt=0, fw=None, win_size=None,
-                 kernel=None, xkernel=None, bkg_image=None):
+                 kernel=None, xkernel=None, bkg_image=None, var_image=None):
         self.image = image
         self.bkg_image = bkg_image
+        # Per pixel read noise variance in photons² (sCMOS), see fit_area
+        self.var_image = var_image
 
         # Noise removal by convolving with a null sum gaussian. Its FWHM
         # has to match the one of the objects we want to detect.
@@ -150,9 +152,13 @@ class Maxima():
             self.overlaps = 0
 
     def drop_border(self):
-        """ Drop near-the-edge spots. """
-        keep = ((self.positions[:, 0] < 126) & (self.positions[:, 0] > 1) &
-                (self.positions[:, 1] < 126) & (self.positions[:, 1] > 1))
+        """ Drop the spots whose fit area doesn't fit in the image. """
+        w = self.win_size
+        shape = self.image.shape
+        keep = ((self.positions[:, 0] >= w) &
+                (self.positions[:, 0] < shape[0] - w) &
+                (self.positions[:, 1] >= w) &
+                (self.positions[:, 1] < shape[1] - w))
         self.positions = self.positions[keep]
 
     def getParameters(self):
@@ -219,7 +225,11 @@ class Maxima():
             # Fit and store fitting results
             area = self.area(self.image, i)
             bkg = self.area(self.bkg_image, i)
-            fit = fit_area(area, self.fwhm, bkg)
+            if self.var_image is None:
+                fit = fit_area(area, self.fwhm, bkg)
+            else:
+                fit = fit_area(area, self.fwhm, bkg,
+                               var=self.area(self.var_image, i))
             offset = self.positions[i] - self.win_size
             fit[1] += offset[0]
             fit[2] += offset[1]
@@ -249,12 +259,22 @@ def start_point(area, bkg):
 
 
 # TODO: run calibration routine for better fwhm estimate
-def fit_area(area, fwhm, bkg, fit_results=np.zeros(4), x=np.arange(5)):
+def fit_area(area, fwhm, bkg, fit_results=np.zeros(4), x=np.arange(5),
+             var=None):
+    ''' With the per pixel read noise variance var (in photons², area in
+    photons) the sCMOS likelihood of Huang et al. (2013) is used: the read
+    noise is approximated as Poisson noise of mean var added to both the
+    data and the model.'''
+
+    if var is None:
+        args = (fwhm, area)
+    else:
+        args = (fwhm, area + var, var)
 
     # TODO: get error of each parameter from the fit
-    fit_results = minimize(logll, start_point(area, bkg), args=(fwhm, area),
+    fit_results = minimize(logll, start_point(area, bkg), args=args,
                            bounds=[(0, np.max(area)), (1, 4), (1, 4),
-                                   (0, np.min(area))],
+                                   (0, max(np.min(area), 0))],
                            method='L-BFGS-B', jac=ll_jac).x
     return fit_results
 
@@ -332,12 +352,15 @@ def logll(parameters, *args, xy=np.arange(5)):
     as the model PSF. x, x0 and sigma are in px units.
     """
     A, x0, y0, bkg = parameters
-    fwhm, area = args
+    fwhm, area = args[:2]
 
 #    fwhm *= 0.5*(np.log(2))**(-1/2)
 #    fwhm *= 0.6
 
     lambda_p = A * derfs(x0, y0, fwhm * 0.6, xy) + bkg
+    # sCMOS read noise variance, see fit_area
+    if len(args) > 2:
+        lambda_p = lambda_p + args[2]
     return np.sum(lambda_p - area * np.log(lambda_p))
 
 
@@ -365,7 +388,7 @@ def ll_jac(parameters, *args, xy=np.arange(5), jac=np.zeros((4, 5, 5))):
     Order of derivatives: A, x0, y0, bkg.
     """
     A, x0, y0, bkg = parameters
-    fwhm, area = args
+    fwhm, area = args[:2]
     fwhm *= 0.6
 
     derfx = derf(x0, fwhm, xy)
@@ -379,7 +402,10 @@ def ll_jac(parameters, *args, xy=np.arange(5), jac=np.zeros((4, 5, 5))):
     jac[1:3] *= A
     # d-L/d(bkg)
     jac[3] = 1
-    jac *= 1 - area/(A * jac[0] + bkg)
+    if len(args) > 2:
+        jac *= 1 - area/(A * jac[0] + bkg + args[2])
+    else:
+        jac *= 1 - area/(A * jac[0] + bkg)
 
     return np.sum(jac, (1, 2))
 
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 16:10:05 2026
+
+@author: Tempesta_team
+
+Per pixel noise calibration of sCMOS cameras, following Huang et al.,
+"Video-rate nanoscopy using sCMOS camera-specific single-molecule
+localization algorithms", Nat. Methods 10, 653 (2013).
+
+The offset and the variance of every pixel are measured from a dark stack
+and the gain (ADU per photoelectron) from one or more stacks with uniform
+illumination at different intensities: for each pixel the excess variance
+over the dark variance grows linearly with the mean signal over the offset,
+with the gain as slope.
+
+The stacks are never loaded into memory. Every worker of a process pool
+reads its range of frames in chunks of about chunk_bytes (as float64, a
+single frame if larger) and accumulates count, mean and sum
+of squared deviations per pixel, and the partial results are merged with
+the parallel update of the Welford algorithm (Chan et al.).
+
+The maps are saved as .npz with:
+    offset      mean dark level [ADU]
+    variance    dark (read noise) variance [ADU²]
+    adu_per_e   gain [ADU/e-]
+    gain        mean gain / gain of the pixel, relative gain correction in
+                the format of control.correction
+    flat        ones, for control.correction
+    origin      position on the sensor of the calibrated area
+
+Usage:
+    python -m analysis.noise maps.npz dark.hdf5 light1.hdf5 light2.hdf5
+"""
+
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+import h5py as hdf
+
+
+def moments(chunk):
+    """ Count, mean and sum of squared deviations of a stack of frames."""
+    chunk = np.asarray(chunk, dtype=np.float64)
+    mean = chunk.mean(0)
+    m2 = ((chunk - mean)**2).sum(0)
+    return len(chunk), mean, m2
+
+
+def merge(a, b):
+    """ Merges the (count, mean, m2) accumulations of two sets of frames."""
+    na, mean_a, m2_a = a
+    nb, mean_b, m2_b = b
+    if na == 0:
+        return b
+    if nb == 0:
+        return a
+    n = na + nb
+    delta = mean_b - mean_a
+    mean = mean_a + delta * nb / n
+    m2 = m2_a + m2_b + delta**2 * na * nb / n
+    return n, mean, m2
+
+
+def range_moments(args):
+    """ Accumulation over the frames start:end of a dataset, read chunk by
+    chunk. Runs in the pool workers."""
+    filename, imagename, start, end, chunk = args
+    acc = (0, 0., 0.)
+    with hdf.File(filename, 'r') as f:
+        data = f[imagename]
+        for i in range(start, end, chunk):
+            acc = merge(acc, moments(data[i:min(i + chunk, end)]))
+    return acc
+
+
+def pixel_stats(data, chunk_bytes=2**25, processes=None):
+    """ Per pixel mean and variance of all the frames of a stack.Stack
+    (or a (filename, dataset name) pair)."""
+    try:
+        filename, imagename = data.filename, data.imagename
+    except AttributeError:
+        filename, imagename = data
+
+    with hdf.File(filename, 'r') as f:
+        nframes = len(f[imagename])
+        frame_bytes = 8 * int(np.prod(f[imagename].shape[1:]))
+    if nframes < 2:
+        raise ValueError('The variance of {} needs at least 2 frames, it '
+                         'has {}'.format(filename, nframes))
+    # Frames per chunk, the deviations take as much memory again
+    chunk = max(1, chunk_bytes // frame_bytes)
+
+    if processes is None:
+        processes = mp.cpu_count()
+    processes = max(1, min(processes, nframes // chunk))
+    bounds = np.linspace(0, nframes, processes + 1).astype(int)
+    args = [(filename, imagename, bounds[i], bounds[i + 1], chunk)
+            for i in range(processes)]
+
+    if processes == 1:
+        partial = [range_moments(args[0])]
+    else:
+        pool = mp.Pool(processes=processes)
+        partial = pool.map(range_moments, args)
+        pool.close()
+
+    acc = (0, 0., 0.)
+    for p in partial:
+        acc = merge(acc, p)
+    n, mean, m2 = acc
+    return mean, m2 / (n - 1)
+
+
+def calibrate(dark, lights, **kwargs):
+    """ Offset, variance and gain maps from a dark stack and a list of
+    illuminated stacks. With a single illuminated stack the gain is the
+    ratio of excess variance and signal, with more it's the least squares
+    slope through the origin."""
+    offset, variance = pixel_stats(dark, **kwargs)
+
+    signal = []
+    excess = []
+    for light in lights:
+        mean, var = pixel_stats(light, **kwargs)
+        signal.append(mean - offset)
+        excess.append(var - variance)
+    signal = np.array(signal)
+    excess = np.array(excess)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gain = (signal * excess).sum(0) / (signal**2).sum(0)
+
+    # Pixels without signal get the median gain
+    valid = np.isfinite(gain) & (gain > 0)
+    gain[~valid] = np.median(gain[valid])
+
+    return offset, variance, gain
+
+
+def save_maps(filename, offset, variance, gain, origin=(0, 0)):
+    np.savez(filename, offset=offset.astype(np.float32),
+             variance=variance.astype(np.float32),
+             adu_per_e=gain.astype(np.float32),
+             gain=(gain.mean() / gain).astype(np.float32),
+             flat=np.ones(offset.shape, dtype=np.float32),
+             origin=np.array(origin))
+
+
+def load_maps(filename, origin=(0, 0), shape=None):
+    """ Offset, variance and gain maps of a frame with the given origin on
+    the sensor and shape, cropped from the calibrated area."""
+    maps = np.load(filename)
+    x0, y0 = np.array(origin) - maps['origin']
+    if shape is None:
+        shape = maps['offset'].shape
+    crop = (slice(x0, x0 + shape[0]), slice(y0, y0 + shape[1]))
+    offset = maps['offset'][crop]
+    if x0 < 0 or y0 < 0 or offset.shape != tuple(shape):
+        raise ValueError('Frame outside of the calibrated area')
+    return offset, maps['variance'][crop], maps['adu_per_e'][crop]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[2])
+    parser.add_argument('maps', help='output .npz file')
+    parser.add_argument('dark', help='dark hdf5 recording')
+    parser.add_argument('lights', nargs='+',
+                        help='hdf5 recordings with uniform illumination')
+    parser.add_argument('--dataset', default='Images')
+    parser.add_argument('--origin', type=int, nargs=2, default=[0, 0],
+                        help='position of the recorded frame on the sensor')
+    args = parser.parse_args()
+
+    offset, variance, gain = calibrate(
+        (args.dark, args.dataset),
+        [(light, args.dataset) for light in args.lights])
+    save_maps(args.maps, offset, variance, gain, args.origin)
+    print('Median offset {:.1f} ADU, read noise {:.2f} ADU, '
+          'gain {:.3f} ADU/e-'.format(np.median(offset),
+                                      np.sqrt(np.median(variance)),
+                                      np.median(gain)))
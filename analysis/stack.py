@@ -14,6 +14,8 @@ from scipy.ndimage.filters import uniform_filter, median_filter
 
 import analysis.tools as tools
 import analysis.maxima as maxima
+import analysis.noise as noise
+import control.chunkstore as chunkstore
 
 
 def convert(word):
@@ -22,7 +24,7 @@ def convert(word):
 
 
 class Stack(object):
-    """Measurement stored in a hdf5 file"""
+    """Measurement stored in a hdf5 file or a chunked directory store"""
 
     def __init__(self, filename=None, imagename='data'):
 
@@ -36,14 +38,22 @@ class Stack(object):
                                                   title='Select hdf5 file')
             root.destroy()
 
-        self.file = hdf.File(filename, 'r')
-
-        # Loading of measurements (i.e., images) in HDF5 file
-        self.imageData = self.file[imagename].value
+        self.filename = filename
+        self.imagename = imagename
+
+        # Measurements (i.e., images) in HDF5 file or chunked directory store,
+        # frames are only read from disk when sliced
+        if chunkstore.isChunkStore(filename):
+            self.file = chunkstore.ChunkReader(filename)
+            self.imageData = self.file
+            self.attrs = self.file.attrs
+        else:
+            self.file = hdf.File(filename, 'r')
+            self.imageData = self.file[imagename]
+            self.attrs = self.file[imagename].attrs
         self.nframes = len(self.imageData)
 
         # Attributes loading as attributes of the stack
-        self.attrs = self.file[imagename].attrs
         try:
             self.lambda_em = self.attrs['lambda_em']
         except:
@@ -59,6 +69,15 @@ class Stack(object):
         except:
             self.nm_per_px = 120
 
+        # Per-frame metadata stored by the recording next to the images
+        if isinstance(self.file, chunkstore.ChunkReader):
+            self.meta = self.file.meta
+        else:
+            try:
+                self.meta = self.file[imagename].parent['FrameMeta'][()]
+            except KeyError:
+                self.meta = None
+
         self.frame = 0
         self.fwhm = tools.get_fwhm(self.lambda_em, self.NA) / self.nm_per_px
         self.win_size = int(np.ceil(self.fwhm))
@@ -66,6 +85,17 @@ class Stack(object):
         self.kernel = tools.kernel(self.fwhm)
         self.xkernel = tools.xkernel(self.fwhm)
 
+        self.noise_maps = None
+
+    def load_noise(self, filename, origin=None):
+        """ Loads the sCMOS noise maps made with analysis.noise for the
+        frames of this stack, which start at origin on the sensor (by default
+        the X0, Y0 recording attributes)."""
+        if origin is None:
+            origin = (self.attrs.get('X0', 0), self.attrs.get('Y0', 0))
+        self.noise_maps = noise.load_maps(filename, origin,
+                                          self.imageData.shape[1:])
+
     def localize_molecules(self, ran=(0, None), fit_model='2d'):
 
         if ran[1] is None:
@@ -79,15 +109,48 @@ class Stack(object):
         chunks = [[i*step, (i + 1)*step - 1] for i in np.arange(cpus)]
         chunks[-1][1] = ran[1] - 1
 
+        # Chunks are split at dropped frames so the background estimation
+        # only averages consecutive frames
+        for cut in self.gaps()[0]:
+            chunks = [part for i, j in chunks
+                      for part in ([[i, cut], [cut, j]] if i < cut < j
+                                   else [[i, j]])]
+
         max_args = (self.fit_parameters, self.dt, self.fwhm, self.win_size,
                     self.kernel, self.xkernel)
-        args = [[self.imageData[i:j], i, fit_model, max_args]
-                for i, j in chunks]
+        args = [[self.imageData[i:j], i, fit_model, max_args,
+                 self.noise_maps] for i, j in chunks]
 
         pool = mp.Pool(processes=cpus)
         results = pool.map(localize_chunk, args)
         self.molecules = np.concatenate(results[:])
 
+    def gaps(self):
+        """ Returns the indexes of the frames that come after dropped frames
+        and how many frames were dropped before each of them, according to the
+        camera frame counter."""
+        if self.meta is None:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        missing = np.diff(self.meta['frame_number']) - 1
+        index = np.nonzero(missing > 0)[0]
+        return index + 1, missing[index]
+
+    def segments(self):
+        """ (start, end) frame index ranges without dropped frames, to be
+        analysed separately."""
+        index = self.gaps()[0]
+        bounds = np.concatenate(([0], index, [self.nframes]))
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def timing(self):
+        """ Mean and std of the time between frames retrievals [s] and the
+        maximum camera backlog during the recording."""
+        if self.meta is None:
+            return None
+        dt = np.diff(np.unique(self.meta['timestamp']))
+        return dt.mean(), dt.std(), self.meta['backlog'].max()
+
     def scatter_plot(self):
         plt.plot(self.molecules['fit_y'], self.molecules['fit_x'], 'bo',
                  markersize=0.2)
@@ -145,10 +208,18 @@ def bkg_estimation(data_stack, window=100):
 
 def localize_chunk(args, index=0):
 
-    stack, init_frame, fit_model, max_args = args
+    stack, init_frame, fit_model, max_args = args[:4]
     fit_parameters, res_dt, fwhm, win_size, kernel, xkernel = max_args
     n_frames = len(stack)
 
+    # With sCMOS noise maps the frames are converted to photons and the
+    # fit uses the per pixel read noise
+    var_image = None
+    if len(args) > 4 and args[4] is not None:
+        offset, variance, gain = args[4]
+        stack = (stack - offset) / gain
+        var_image = variance / gain**2
+
     bkg_stack = bkg_estimation(stack)
 
     # I create a big array, I'll keep the non-null part at the end
@@ -163,7 +234,7 @@ def localize_chunk(args, index=0):
 
         # fit all molecules in each frame
         maxi = maxima.Maxima(stack[n], fit_parameters, res_dt, fwhm, win_size,
-                             kernel, xkernel, bkg_stack[n])
+                             kernel, xkernel, bkg_stack[n], var_image)
         maxi.find()
 
         maxi.getParameters()
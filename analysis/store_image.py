@@ -6,19 +6,23 @@ Created on Fri Dec 13 17:36:09 2013
 """
 
 import os
+import json
 
 import numpy as np
 import h5py as hdf
+import tifffile as tiff
 
 
-def store_stack(shape, dtype,
-                data_name='image', filename=None, attributes=None):
-    """Store binary data and measurement attributes in HDF5 format"""
+def store_stack(shape, dtype, data_name='image', filename=None,
+                attributes=None, fmt='hdf5', chunk=256):
+    """Store binary data and measurement attributes in HDF5 (or TIFF, with
+    the attributes in a .txt file) format. The binary file is copied by
+    chunks of frames so it doesn't need to fit in memory. Returns the name
+    of the stored file."""
 
     if filename is None:
 
-        import tkFileDialog as filedialog
-        from Tkinter import Tk
+        from tkinter import filedialog, Tk
 
         root = Tk()
         filename = filedialog.askopenfilename(parent=root,
@@ -28,33 +32,81 @@ def store_stack(shape, dtype,
     file_name = os.path.splitext(filename)
 
     # Data loading, reshaping, labelling
-    data = np.memmap(filename, dtype=dtype, mode='r')
-    data = data.reshape(shape)
-    data = (data_name, data)
+    data = np.memmap(filename, dtype=dtype, mode='r', shape=tuple(shape))
+
+    # Given attributes override the defaults
+    defaults = [('nframes', shape[0]),
+                ('size', shape[1:3]),
+                ('nm_per_px', 133),
+                ('NA', 1.4),
+                ('lambda_em', 670)]
+    given = [] if attributes is None else list(attributes)
+    names = [item[0] for item in given]
+    attributes = [item for item in defaults if item[0] not in names] + given
+    # None can't be stored as an hdf5 attribute
+    attributes = [(name, 'None' if value is None else value)
+                  for name, value in attributes]
+
+    if fmt == 'tiff':
+        storename = file_name[0] + '.tiff'
+        bigtiff = data.nbytes > 2**32 - 2**25
+        with tiff.TiffWriter(storename, bigtiff=bigtiff,
+                             software='Tormenta') as store_file:
+            for frame in data:
+                store_file.save(np.asarray(frame))
+        with open(file_name[0] + '.txt', 'w') as fp:
+            fp.write('\n'.join('{}= {}'.format(*x) for x in attributes))
+        return storename
+
+    storename = file_name[0] + '.hdf5'
+    with hdf.File(storename, "w") as store_file:
+        dataset = store_file.create_dataset(data_name, data.shape,
+                                            dtype=data.dtype)
+        for i in range(0, len(data), chunk):
+            dataset[i:i + chunk] = data[i:i + chunk]
+
+        # On the file and on the dataset, where analysis.stack.Stack looks
+        # for them
+        for name, value in attributes:
+            store_file.attrs[name] = value
+            dataset.attrs[name] = value
+
+    return storename
+
+
+def read_header(filename):
+    """ JSON header of a raw recording (see recording.RawStore)."""
+    with open(os.path.splitext(filename)[0] + '.json') as f:
+        return json.load(f)
+
+
+def pack_raw(filename, fmt='hdf5', remove=False):
+    """ Converts a raw recording with its JSON header to HDF5 or TIFF. The
+    per-frame metadata goes to the 'FrameMeta' dataset (hdf5) or to a _meta
+    csv file (tiff), like in the direct recordings. With remove the raw
+    files are deleted once packed. Returns the name of the stored file."""
+    header = read_header(filename)
+    storename = store_stack(header['shape'], np.dtype(header['dtype']),
+                            'Images', filename, header['attrs'], fmt)
+
+    metaname = os.path.splitext(filename)[0] + '_meta.npy'
+    if os.path.exists(metaname):
+        meta = np.load(metaname)
+        if fmt == 'tiff':
+            np.savetxt(os.path.splitext(storename)[0] + '_meta.csv', meta,
+                       fmt=header['meta_fmt'], delimiter=',',
+                       header=','.join(meta.dtype.names), comments='')
+        else:
+            with hdf.File(storename, 'a') as store_file:
+                store_file.create_dataset('FrameMeta', data=meta)
+
+    if remove:
+        for name in [filename, os.path.splitext(filename)[0] + '.json',
+                     metaname]:
+            if os.path.exists(name):
+                os.remove(name)
+    return storename
 
-    attributes = [('nframes', shape[0]),
-                  ('size', shape[1:3]),
-                  ('nm_per_px', 133),
-                  ('NA', 1.4),
-                  ('lambda_em', 670)]
-
-    store_file = hdf.File(file_name[0] + '.hdf5', "w")
-
-    # data should be a list of tuples in the format ('data name', data)
-    if type(data) is tuple:
-        data = [data]
-
-    for i in np.arange(len(data)):
-        store_file.create_dataset(data[i][0], data=data[i][1])
-
-    if attributes is None:
-        print("No attributes were saved")
-
-    else:
-        for i in np.arange(len(attributes)):
-            store_file.attrs[attributes[i][0]] = attributes[i][1]
-
-    store_file.close()
 
 if __name__ == "__main__":
 
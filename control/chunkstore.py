@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 19:05:41 2026
+
+@author: Tempesta_team
+
+Chunked directory store for the recordings. A recording is a directory
+(savename.chunks) with
+
+    manifest.json   shape, dtype, frames per chunk, compression, list of the
+                    chunks and recording attributes
+    meta.npy        per-frame metadata (recording.frameMetaDt)
+    c000000.bin     chunks of consecutive frames, raw C-ordered bytes, each
+    c000001.bin     one optionally compressed with zlib
+    ...
+
+Full chunks are flushed by a few writer threads while the next chunk is
+filled (zlib and file writes release the GIL), and the readers only touch
+the chunks of the requested frames, reading several of them in parallel.
+Everything is plain files, numpy and the standard library.
+
+The manifest is written without chunks with the first frames and complete
+when the store is closed. The chunks of an interrupted recording are found
+from the chunk files when it's opened.
+
+Usage:
+    python -m control.chunkstore [folder] [--frames N] [--size N]
+benchmarks the store against the HDF5 recording path.
+"""
+
+import os
+import json
+import zlib
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+MANIFEST = 'manifest.json'
+META = 'meta.npy'
+FORMAT = 'tempesta-chunks'
+
+
+def chunkName(index):
+    return 'c{:06d}.bin'.format(index)
+
+
+def jsonValue(value):
+    """ Recording attributes as JSON values."""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode('latin-1')
+    return str(value)
+
+
+class ChunkStore():
+    """ Writer of a chunked directory store, with the write(frames, meta)
+    interface of recording.HDF5Store and recording.TiffStore.
+
+    The frame shape and dtype are taken from the first written frames.
+    compression is None or 'zlib' (level 1 is usually enough for camera
+    frames and keeps up with the acquisition)."""
+
+    def __init__(self, path, chunkFrames=64, compression=None, level=1,
+                 nThreads=4, attrs=None, metaDtype=None):
+        self.path = path
+        self.chunkFrames = chunkFrames
+        if compression not in [None, 'zlib']:
+            raise ValueError('Unknown compression {}'.format(compression))
+        self.compression = compression
+        self.level = level
+        self.attrs = {} if attrs is None else dict(attrs)
+        self.metaDtype = metaDtype
+        os.makedirs(path, exist_ok=True)
+
+        self.pool = ThreadPoolExecutor(nThreads)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.error = None
+        self.chunks = []
+        self.meta = []
+        self.buffer = None
+        self.filled = 0
+        self.nFrames = 0
+        self.frameShape = None
+        self.dtype = None
+        self.bytesWritten = 0
+
+    def write(self, frames, meta=()):
+        if len(frames) == 0:
+            return
+        if self.buffer is None:
+            first = np.asarray(frames[0])
+            self.frameShape = first.shape
+            self.dtype = first.dtype
+            self.buffer = self.newBuffer()
+            self.writeManifest(complete=False)
+
+        self.meta.extend(meta)
+        for frame in frames:
+            self.buffer[self.filled] = frame
+            self.filled += 1
+            if self.filled == self.chunkFrames:
+                self.flush()
+
+    def newBuffer(self):
+        return np.empty((self.chunkFrames,) + self.frameShape,
+                        dtype=self.dtype)
+
+    def flush(self):
+        """ Sends the current chunk to the writer threads."""
+        if self.filled == 0:
+            return
+        index = len(self.chunks)
+        block = self.buffer[:self.filled]
+        with self.lock:
+            self.chunks.append({'file': chunkName(index),
+                                'start': self.nFrames, 'frames': self.filled})
+        self.pending.append(self.pool.submit(self.writeChunk, index, block))
+        self.nFrames += self.filled
+        self.buffer = self.newBuffer()
+        self.filled = 0
+        self.checkWrites()
+
+    def checkWrites(self, finish=False):
+        """ Drops the finished chunk writes, raising the first error of the
+        writer threads. The store is not complete after an error."""
+        if finish:
+            wait(self.pending)
+        pending = []
+        for p in self.pending:
+            if not p.done():
+                pending.append(p)
+            elif p.exception() is not None and self.error is None:
+                self.error = p.exception()
+        self.pending = pending
+        if self.error is not None:
+            raise self.error
+
+    def writeChunk(self, index, block):
+        data = block.tobytes()
+        if self.compression == 'zlib':
+            data = zlib.compress(data, self.level)
+        with open(os.path.join(self.path, chunkName(index)), 'wb') as f:
+            f.write(data)
+        with self.lock:
+            self.chunks[index]['bytes'] = len(data)
+            self.bytesWritten += len(data)
+
+    def writeManifest(self, complete=True):
+        manifest = {'format': FORMAT, 'version': 1, 'complete': complete,
+                    'shape': [self.nFrames] + list(self.frameShape or []),
+                    'dtype': None if self.dtype is None else self.dtype.str,
+                    'order': 'C', 'chunk_frames': self.chunkFrames,
+                    'compression': self.compression,
+                    'chunks': self.chunks if complete else [],
+                    'attrs': {str(k): v for k, v in self.attrs.items()}}
+        # The manifest is replaced atomically, readers never see half of it
+        name = os.path.join(self.path, MANIFEST)
+        with open(name + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1, default=jsonValue)
+        os.replace(name + '.tmp', name)
+
+    def close(self):
+        try:
+            self.flush()
+            self.checkWrites(finish=True)
+        finally:
+            self.pool.shutdown(wait=True)
+            if self.metaDtype is not None:
+                meta = np.array(self.meta, dtype=self.metaDtype)
+            else:
+                meta = np.array(self.meta)
+            np.save(os.path.join(self.path, META), meta)
+            # An incomplete manifest makes the readers recover the chunks
+            # that were actually written
+            self.writeManifest(complete=self.error is None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ChunkReader():
+    """ Lazy reader of a chunked directory store. Slicing it like an array
+    (reader[i], reader[start:stop]) reads only the needed chunks, in
+    parallel with nThreads threads."""
+
+    def __init__(self, path, nThreads=4):
+        if os.path.basename(path) == MANIFEST:
+            path = os.path.dirname(path)
+        self.path = path
+        self.filename = path
+        self.nThreads = nThreads
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.info = json.load(f)
+        if self.info.get('format') != FORMAT:
+            raise ValueError('{} is not a chunked store'.format(path))
+        if not self.info['complete']:
+            self.recover()
+
+        self.shape = tuple(self.info['shape'])
+        self.dtype = np.dtype(self.info['dtype'])
+        self.chunks = self.info['chunks']
+        self.starts = np.array([c['start'] for c in self.chunks], dtype=int)
+        self.attrs = self.info['attrs']
+        self.pool = ThreadPoolExecutor(nThreads)
+
+    def recover(self):
+        """ Chunk list of an interrupted recording, from the chunk files.
+        Stops at the first chunk that was not completely written."""
+        frameShape = self.info['shape'][1:]
+        frameBytes = (np.dtype(self.info['dtype']).itemsize *
+                      int(np.prod(frameShape)))
+        chunks = []
+        start = 0
+        for index in range(len(os.listdir(self.path))):
+            name = os.path.join(self.path, chunkName(index))
+            if not os.path.exists(name):
+                break
+            size = os.path.getsize(name)
+            if self.info['compression'] == 'zlib':
+                try:
+                    with open(name, 'rb') as f:
+                        size = len(zlib.decompress(f.read()))
+                except zlib.error:
+                    break
+            frames = size // frameBytes
+            if frames < self.info['chunk_frames']:
+                # Only the last chunk can be shorter, and a cut raw chunk
+                # would be read with the wrong size
+                if size % frameBytes or frames == 0:
+                    break
+            chunks.append({'file': chunkName(index), 'start': start,
+                           'frames': frames,
+                           'bytes': os.path.getsize(name)})
+            start += frames
+            if frames < self.info['chunk_frames']:
+                break
+        self.info['chunks'] = chunks
+        self.info['shape'] = [start] + frameShape
+
+    @property
+    def meta(self):
+        try:
+            return np.load(os.path.join(self.path, META))
+        except FileNotFoundError:
+            return None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def readChunk(self, index):
+        chunk = self.chunks[index]
+        with open(os.path.join(self.path, chunk['file']), 'rb') as f:
+            data = f.read()
+        if self.info['compression'] == 'zlib':
+            data = zlib.decompress(data)
+        return np.frombuffer(data, dtype=self.dtype).reshape(
+            (chunk['frames'],) + self.shape[1:])
+
+    def read(self, start=0, stop=None):
+        """ Frames start:stop as a new array."""
+        n = len(self)
+        start, stop, _ = slice(start, stop).indices(n)
+        out = np.empty((max(stop - start, 0),) + self.shape[1:],
+                       dtype=self.dtype)
+        if stop <= start:
+            return out
+
+        first = np.searchsorted(self.starts, start, 'right') - 1
+        last = np.searchsorted(self.starts, stop, 'left')
+
+        def copy(index):
+            chunk = self.chunks[index]
+            c0 = chunk['start']
+            i0 = max(start, c0)
+            i1 = min(stop, c0 + chunk['frames'])
+            out[i0 - start:i1 - start] = self.readChunk(index)[i0 - c0:
+                                                               i1 - c0]
+
+        indexes = range(first, last)
+        if len(indexes) == 1:
+            copy(first)
+        else:
+            list(self.pool.map(copy, indexes))
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            frames = self[key[0]]
+            if isinstance(key[0], slice):
+                return frames[(slice(None),) + key[1:]]
+            return frames[key[1:]]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                return self.read(start, stop)
+            index = np.arange(start, stop, step)
+            if len(index) == 0:
+                return self.read(0, 0)
+            first = index.min()
+            return self.read(first, index.max() + 1)[index - first]
+        key = int(key)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('Frame {} out of range'.format(key))
+        return self.read(key, key + 1)[0]
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def isChunkStore(path):
+    return (os.path.isdir(path) and
+            os.path.exists(os.path.join(path, MANIFEST))) or \
+        os.path.basename(path) == MANIFEST
+
+
+def benchmark(folder, nFrames=2000, shape=(512, 512), chunkFrames=64):
+    """ Write and read times of the same frames with the HDF5 store of the
+    recordings and with chunked stores. Frames are written in batches of
+    20, like RecWorker does."""
+    import h5py as hdf
+    import control.recording as recording
+
+    rng = np.random.RandomState(0)
+    frames = (100 + rng.poisson(20, (nFrames,) + shape)).astype(np.uint16)
+    meta = [(i, 0., 0, 0, 0., 0.) for i in range(nFrames)]
+    batches = range(0, nFrames, 20)
+    results = []
+
+    name = os.path.join(folder, 'benchmark.hdf5')
+    t0 = time.perf_counter()
+    with hdf.File(name, 'w') as f:
+        store = recording.HDF5Store(f, shape)
+        for i in batches:
+            store.write(frames[i:i + 20], meta[i:i + 20])
+    tWrite = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    with hdf.File(name, 'r') as f:
+        f['Images'][nFrames // 4:3 * nFrames // 4]
+    results.append(('hdf5', tWrite, time.perf_counter() - t0,
+                    os.path.getsize(name)))
+
+    for compression, nThreads in [(None, 1), (None, 4), ('zlib', 1),
+                                  ('zlib', 4)]:
+        name = os.path.join(folder, 'benchmark_{}_{}.chunks'.format(
+            compression, nThreads))
+        t0 = time.perf_counter()
+        with ChunkStore(name, chunkFrames, compression, nThreads=nThreads,
+                        metaDtype=recording.frameMetaDt) as store:
+            for i in batches:
+                store.write(frames[i:i + 20], meta[i:i + 20])
+        tWrite = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        with ChunkReader(name, nThreads) as reader:
+            reader[nFrames // 4:3 * nFrames // 4]
+        size = sum(c['bytes'] for c in reader.chunks)
+        results.append(('chunks {} x{}'.format(compression or 'raw',
+                                               nThreads),
+                        tWrite, time.perf_counter() - t0, size))
+
+    mb = frames.nbytes / 2**20
+    print('{} frames of {}, {:.0f} MB'.format(nFrames, shape, mb))
+    print('{:<18}{:>12}{:>12}{:>10}'.format('store', 'write MB/s',
+                                           'read MB/s', 'size MB'))
+    for label, tWrite, tRead, size in results:
+        print('{:<18}{:>12.0f}{:>12.0f}{:>10.0f}'.format(
+            label, mb / tWrite, 0.5 * mb / tRead, size / 2**20))
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the chunked store against HDF5')
+    parser.add_argument('folder', nargs='?', default='.')
+    parser.add_argument('--frames', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--chunk', type=int, default=64)
+    args = parser.parse_args()
+    benchmark(args.folder, args.frames, (args.size, args.size), args.chunk)
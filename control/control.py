@@ -7,6 +7,7 @@ Created on Mon Jun 16 18:19:24 2014
 
 import numpy as np
 import os
+import re
 import time
 
 from pyqtgraph.Qt import QtCore, QtGui
@@ -23,6 +24,11 @@ import control.scanner as scanner
 import control.guitools as guitools
 import control.focus as focus
 import control.recording as record
+import control.metrics as metrics
+import control.correction as correction
+import control.livesmlm as livesmlm
+import control.drift as drift
+import control.snapshot as snapshot
 
 
 class CamParamTree(ParameterTree):
@@ -34,6 +40,12 @@ class CamParamTree(ParameterTree):
         BinTip = ("Sets binning mode. Binning mode specifies if and how \n"
                   "many pixels are to be read out and interpreted as a \n"
                   "single pixel value.")
+        BufferTip = ("Memory reserved for the camera buffers of each \n"
+                     "camera. It's allocated once and reused for any \n"
+                     "frame size.")
+        SnapshotTip = ("Period of the background reading of the laser \n"
+                       "powers and piezo position saved with the \n"
+                       "recordings.")
 
         # Parameter tree for the camera configuration
         params = [{'name': 'Model', 'type': 'str',
@@ -80,7 +92,13 @@ class CamParamTree(ParameterTree):
                        'values': ['Internal trigger',
                                   'External "Start-trigger"',
                                   'External "frame-trigger"'],
-                       'siPrefix': True, 'suffix': 's'}]}]
+                       'siPrefix': True, 'suffix': 's'},
+                      {'name': 'Buffer budget', 'type': 'int',
+                       'value': 2048, 'limits': (64, 65536), 'step': 256,
+                       'suffix': ' MB', 'tip': BufferTip},
+                      {'name': 'Snapshot interval', 'type': 'float',
+                       'value': 1, 'limits': (0.1, 60), 'step': 0.5,
+                       'suffix': ' s', 'tip': SnapshotTip}]}]
 
         self.p = Parameter.create(name='params', type='group', children=params)
         self.setParameters(self.p, showTop=False)
@@ -113,6 +131,8 @@ class CamParamTree(ParameterTree):
         framePar.param('Y0').setWritable(value)
         framePar.param('Width').setWritable(value)
         framePar.param('Height').setWritable(value)
+        self.p.param('Acquisition mode').param(
+            'Buffer budget').setWritable(value)
 
         # WARNING: If Apply and New ROI button are included here they will
         # emit status changed signal and their respective functions will be
@@ -150,6 +170,9 @@ class LVWorker(QtCore.QObject):
         self.running = False
         self.recording = False
         self.fRecorded = []
+        # (DCAM frame number, host timestamp, buffer index, backlog, drift x,
+        # drift y) of every recorded frame, see recording.frameMetaDt
+        self.fMeta = []
 
         # Memory variable to keep track of if update has been run many times in
         # a row with camera trigger source as internal trigger
@@ -176,23 +199,63 @@ class LVWorker(QtCore.QObject):
     def update(self):
         if self.running:
             try:
-                hcData = self.orcaflash.getFrames()[0]
-                frame = hcData[0].getData()
-                self.image = np.reshape(
-                    frame, (self.orcaflash.frame_x, self.orcaflash.frame_y),
-                    'F')
-                self.main.latest_images[self.ind] = self.image
-
-                # stock frames while recording
-                # TODO: don't store data in a list. We should create an array
-                #       because we know the nFrames beforehand
-                if self.recording:
-                    for hcDatum in hcData:
-                        reshapedFrame = np.reshape(hcDatum.getData(),
-                                                   (self.orcaflash.frame_x,
-                                                    self.orcaflash.frame_y),
-                                                   'F')
-                        self.fRecorded.append(reshapedFrame)
+                with metrics.timer('liveview.update'):
+                    hcData = self.orcaflash.getFrames()[0]
+                    frame = hcData[0].getData()
+
+                    # Offset/gain/flat correction, in place in the camera
+                    # buffers for the recorded frames
+                    corrector = self.main.correctors[self.ind]
+                    if self.recording and corrector.recording:
+                        if not corrector.display:
+                            frame = frame.copy()
+                        corrector.correct([d.getData() for d in hcData])
+                    elif corrector.display:
+                        frame = corrector.corrected(frame)
+
+                    self.image = np.reshape(
+                        frame, (self.orcaflash.frame_x,
+                                self.orcaflash.frame_y), 'F')
+                    self.main.latest_images[self.ind] = self.image
+
+                    timestamp = time.perf_counter()
+                    numbers = self.orcaflash.frame_numbers
+                    frames = [np.reshape(d.getData(), self.image.shape, 'F')
+                              for d in hcData]
+                    current = self.ind == self.main.currCamIdx
+
+                    # Live localization of the displayed camera frames
+                    localizer = self.main.smlmWidget.localizer
+                    if localizer.running and current:
+                        for i, reshapedFrame in enumerate(frames):
+                            localizer.offer(reshapedFrame, numbers[i])
+
+                    # Scan images built while scanning
+                    builder = self.main.scanWidget.multiScanWgt.builder
+                    if builder.running and self.ind == 0:
+                        for reshapedFrame in frames:
+                            builder.add(reshapedFrame)
+
+                    # Fiducial drift of every frame
+                    tracker = self.main.driftWidget.tracker
+                    if tracker.active and current:
+                        drifts = [tracker.track(f, numbers[i], timestamp)
+                                  for i, f in enumerate(frames)]
+                    else:
+                        drifts = [(np.nan, np.nan)] * len(frames)
+
+                    # stock frames while recording
+                    # TODO: don't store data in a list. We should create an
+                    #       array because we know the nFrames beforehand
+                    if self.recording:
+                        buffers = self.orcaflash.frame_buffers
+                        backlog = self.orcaflash.backlog
+                        for i, reshapedFrame in enumerate(frames):
+                            self.fRecorded.append(reshapedFrame)
+                            self.fMeta.append((numbers[i], timestamp,
+                                               buffers[i], backlog,
+                                               *drifts[i]))
+                metrics.observe('liveview.frames', len(hcData))
 
                 """Following is causing problems with two cameras..."""
     #            trigSource = self.orcaflash.getPropertyValue('trigSource')[0]
@@ -214,6 +277,7 @@ class LVWorker(QtCore.QObject):
     def startRecording(self):
         self.recording = True
         self.fRecorded.clear()
+        self.fMeta.clear()
 
     def stopRecording(self):
         self.recording = False
@@ -249,6 +313,9 @@ class TormentaGUI(QtGui.QMainWindow):
                         c.getPropertyValue('image_width')[0])
                        for c in self.cameras]
         self.frameStart = (0, 0)
+        self.correctors = [correction.FrameCorrector() for c in self.cameras]
+        for corrector, shape in zip(self.correctors, self.shapes):
+            corrector.setFrame(self.frameStart, shape)
 
         self.currCamIdx = 0
         noImage = np.zeros(self.shapes[self.currCamIdx])
@@ -293,6 +360,13 @@ class TormentaGUI(QtGui.QMainWindow):
         self.exportlastAction.setStatusTip('Export last recording to Tiff ' +
                                            'format')
         fileMenu.addAction(self.exportlastAction)
+
+        self.exportMetricsAction = QtGui.QAction('Export metrics...', self)
+        self.exportMetricsAction.setStatusTip(
+            'Export the collected timing metrics to CSV or JSON')
+        self.exportMetricsAction.triggered.connect(
+            lambda: self.metricsWidget.export())
+        fileMenu.addAction(self.exportMetricsAction)
         fileMenu.addSeparator()
 
         exitAction = QtGui.QAction(QtGui.QIcon('exit.png'), '&Exit', self)
@@ -347,6 +421,9 @@ class TormentaGUI(QtGui.QMainWindow):
         acquisParam = self.tree.p.param('Acquisition mode')
         self.trigsourceparam = acquisParam.param('Trigger source')
         self.trigsourceparam.sigValueChanged.connect(self.changeTriggerSource)
+        self.bufferBudgetPar = acquisParam.param('Buffer budget')
+        self.bufferBudgetPar.sigValueChanged.connect(self.changeBufferBudget)
+        self.changeBufferBudget()
 
         # Camera settings widget
         cameraWidget = QtGui.QFrame()
@@ -550,6 +627,50 @@ class TormentaGUI(QtGui.QMainWindow):
         piezoDock.addWidget(self.piezoWidget)
         dockArea.addDock(piezoDock, 'bottom', alignmentDock)
 
+        # Acquisition, recording and focus lock timing statistics
+        metricsDock = Dock('Metrics', size=(1, 1))
+        self.metricsWidget = guitools.MetricsWidget()
+        metricsDock.addWidget(self.metricsWidget)
+        dockArea.addDock(metricsDock, 'above', scanDock)
+
+        smlmDock = Dock('Live localization', size=(1, 1))
+        self.smlmWidget = livesmlm.LiveSMLMWidget(self)
+        smlmDock.addWidget(self.smlmWidget)
+        dockArea.addDock(smlmDock, 'above', scanDock)
+
+        driftDock = Dock('Drift', size=(1, 1))
+        self.driftWidget = drift.DriftWidget(self)
+        driftDock.addWidget(self.driftWidget)
+        dockArea.addDock(driftDock, 'above', scanDock)
+
+        correctionDock = Dock('Frame correction', size=(1, 1))
+        self.correctionWidget = correction.CorrectionWidget(self)
+        correctionDock.addWidget(self.correctionWidget)
+        dockArea.addDock(correctionDock, 'above', scanDock)
+        scanDock.raiseDock()
+
+        # Instrument state polled in the background for the recording
+        # attributes, see RecordingWidget.getAttrs
+        self.snapshot = snapshot.SnapshotPoller()
+        for laserControl in self.laserWidgets.controls:
+            name = re.sub('<[^<]+?>', '', laserControl.name.text())
+            # The serial lasers are already polled by their io thread
+            try:
+                getter = lambda io=laserControl.io: io.power
+            except AttributeError:
+                getter = lambda laser=laserControl.laser: laser.power
+            self.snapshot.add(name, getter)
+        for axis in ['x', 'y', 'z']:
+            self.snapshot.add('Piezo ' + axis, lambda axis=axis:
+                              getattr(self.piezoWidget, axis))
+        # The camera timings are already in the parameter tree, which
+        # updateTimings keeps up to date from the GUI thread
+        self.snapshotPar = self.tree.p.param('Acquisition mode').param(
+            'Snapshot interval')
+        self.snapshotPar.sigValueChanged.connect(self.changeSnapshotInterval)
+        self.changeSnapshotInterval()
+        self.snapshot.start()
+
         console = ConsoleWidget(namespace={'pg': pg, 'np': np})
 
         self.setWindowTitle('TempestaDev')
@@ -637,6 +758,25 @@ class TormentaGUI(QtGui.QMainWindow):
                 lambda: self.cameras[self.currCamIdx].setPropertyValue(
                     'trigger_mode', 1))
 
+    def changeSnapshotInterval(self):
+        """ Period of the background polling of the laser powers and piezo
+        position for the recording attributes."""
+        self.snapshot.setInterval(self.snapshotPar.value())
+
+    def changeBufferBudget(self):
+        """ Memory for the camera buffers, the liveview is restarted for
+        the change to take effect."""
+        budget = self.bufferBudgetPar.value() * 1024 * 1024
+        for c in self.cameras:
+            c.setBufferBudget(budget)
+
+        try:
+            if self.liveviewButton.isChecked():
+                self.liveviewPause()
+                self.liveviewRun()
+        except AttributeError:
+            pass
+
     def updateLevels(self, image):
         std = np.std(image)
         self.hist.setLevels(np.min(image) - std, np.max(image) + std)
@@ -668,13 +808,6 @@ class TormentaGUI(QtGui.QMainWindow):
 
     def cropOrca(self, hpos, vpos, hsize, vsize):
         """Method to crop the frame read out by Orcaflash. """
-        self.cameras[self.currCamIdx].setPropertyValue('subarray_vpos', 0)
-        self.cameras[self.currCamIdx].setPropertyValue('subarray_hpos', 0)
-        self.cameras[self.currCamIdx].setPropertyValue(
-            'subarray_vsize', 2048)
-        self.cameras[self.currCamIdx].setPropertyValue(
-            'subarray_hsize', 2048)
-
         # Round to closest "divisable by 4" value.
 #        vpos = int(4 * np.ceil(vpos / 4))
 #        hpos = int(4 * np.ceil(hpos / 4))
@@ -688,15 +821,22 @@ class TormentaGUI(QtGui.QMainWindow):
         vsize = int(min(2048 - vpos, minroi * np.ceil(vsize / minroi)))
         hsize = int(min(2048 - hpos, minroi * np.ceil(hsize / minroi)))
 
-        self.cameras[self.currCamIdx].setPropertyValue('subarray_vsize', vsize)
-        self.cameras[self.currCamIdx].setPropertyValue('subarray_hsize', hsize)
-        self.cameras[self.currCamIdx].setPropertyValue('subarray_vpos', vpos)
-        self.cameras[self.currCamIdx].setPropertyValue('subarray_hpos', hpos)
+        # The position is reset first so that any size is within range
+        self.cameras[self.currCamIdx].setPropertyValues([
+            ('subarray_vpos', 0), ('subarray_hpos', 0),
+            ('subarray_vsize', vsize), ('subarray_hsize', hsize),
+            ('subarray_vpos', vpos), ('subarray_hpos', hpos)])
 
         # This should be the only place where self.frameStart is changed
         self.frameStart = (hpos, vpos)
         # Only place self.shapes is changed
         self.shapes[self.currCamIdx] = (hsize, vsize)
+        self.correctors[self.currCamIdx].setFrame(self.frameStart,
+                                                  (hsize, vsize))
+        try:
+            self.correctionWidget.updateLabel()
+        except AttributeError:
+            pass
 
     def adjustFrame(self):
         """ Method to change the area of the sensor to be used and adjust the
@@ -974,4 +1114,9 @@ class TormentaGUI(QtGui.QMainWindow):
         self.RotalignWidget.closeEvent(*args, **kwargs)
         self.scanWidget.closeEvent(*args, **kwargs)
         self.FocusLockWidget.closeEvent(*args, **kwargs)
+        self.metricsWidget.closeEvent(*args, **kwargs)
+        self.smlmWidget.closeEvent(*args, **kwargs)
+        self.driftWidget.closeEvent(*args, **kwargs)
+        self.recWidget.closeEvent(*args, **kwargs)
+        self.snapshot.stop()
         super().closeEvent(*args, **kwargs)
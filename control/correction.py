@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 15:02:47 2026
+
+@author: Tempesta_team
+
+Offset and flat-field correction of the camera frames.
+
+Every pixel is corrected as
+
+    corrected = (raw - offset) / flat + pedestal
+
+where offset is the mean dark frame and flat the flat-field normalized to
+mean 1. The flat is the response of every pixel, so it already includes the
+differences of gain between pixels: a separate gain map measured from the
+same flat recording would cancel out. The pedestal keeps the noise around the
+zero level positive, since the corrected frames are stored back as uint16 in
+the camera buffers. The maps are kept for the full sensor (or the area they
+were measured on) and cropped to the current ROI when the frame changes, as
+float32 arrays in the memory order of the camera buffers. The correction is
+folded into a multiply and a subtraction and applied in place, block by
+block, split among a few threads.
+
+The maps are built from dark and flat stacks recorded with the usual
+recording modes (buildMaps) and saved as .npz files.
+"""
+
+import os
+import time
+import numpy as np
+import h5py as hdf
+import tifffile as tiff
+from concurrent.futures import ThreadPoolExecutor
+
+from pyqtgraph.Qt import QtGui
+from tkinter import Tk, filedialog
+
+import control.metrics as metrics
+
+
+class FrameCorrector():
+    """ Applies the correction maps to the raw frames of a camera.
+
+    mode selects which frames are corrected: 'Off', 'Display' (only the
+    liveview image), 'Recording' (only the recorded frames) or 'Both'."""
+
+    modes = ['Off', 'Display', 'Recording', 'Both']
+
+    def __init__(self, pedestal=100, nThreads=None, blockSize=2**16):
+        self.pedestal = pedestal
+        self.blockSize = blockSize
+        if nThreads is None:
+            nThreads = min(4, os.cpu_count() or 1)
+        self.nThreads = nThreads
+        self.pool = ThreadPoolExecutor(nThreads)
+        self.work = [np.empty(blockSize, dtype=np.float32)
+                     for i in range(nThreads)]
+
+        self.mode = 'Off'
+        self.maps = None
+        self.filename = None
+        self.origin = (0, 0)
+        self.shape = None
+        self.scale = None
+        self.bias = None
+        self.warned = False
+
+    @property
+    def display(self):
+        return self.ready and self.mode in ['Display', 'Both']
+
+    @property
+    def recording(self):
+        return self.ready and self.mode in ['Recording', 'Both']
+
+    @property
+    def ready(self):
+        return self.scale is not None
+
+    def setMode(self, mode):
+        if mode not in self.modes:
+            raise ValueError('Unknown correction mode {}'.format(mode))
+        self.mode = mode
+
+    def load(self, filename):
+        maps = np.load(filename)
+        flat = maps['flat']
+        if 'gain' in maps:
+            # Maps saved with a gain map, same correction
+            flat = flat / np.where(maps['gain'] > 0, maps['gain'], np.inf)
+        self.filename = filename
+        self.setMaps(maps['offset'], flat, tuple(maps['origin']))
+
+    def setMaps(self, offset, flat=None, origin=(0, 0)):
+        """ Maps in image coordinates ([x, y], like the liveview image and
+        the recorded frames), measured with the frame starting at origin
+        on the sensor."""
+        offset = np.asarray(offset, dtype=np.float32)
+        if flat is None:
+            flat = np.ones_like(offset)
+        flat = np.asarray(flat, np.float32)
+        if flat.shape != offset.shape:
+            raise ValueError('Flat of shape {} for an offset of shape '
+                             '{}'.format(flat.shape, offset.shape))
+        self.maps = {'offset': offset, 'flat': flat,
+                     'origin': np.array(origin)}
+        if self.shape is not None:
+            self.setFrame(self.origin, self.shape)
+
+    def setFrame(self, origin, shape):
+        """ Crops the maps for the frame of the given shape (x, y) starting
+        at origin on the sensor."""
+        self.origin = tuple(origin)
+        self.shape = tuple(shape)
+        self.scale = self.bias = None
+        self.warned = False
+        if self.maps is None:
+            return
+
+        x0 = self.origin[0] - self.maps['origin'][0]
+        y0 = self.origin[1] - self.maps['origin'][1]
+        x1, y1 = x0 + self.shape[0], y0 + self.shape[1]
+        size = self.maps['offset'].shape
+        if x0 < 0 or y0 < 0 or x1 > size[0] or y1 > size[1]:
+            print('Frame outside of the calibrated area, no correction')
+            return
+
+        crop = (slice(x0, x1), slice(y0, y1))
+        flat = self.maps['flat'][crop]
+        # Dead pixels of the flat are left uncorrected
+        flat = np.where(flat > 0, flat, 1)
+        scale = 1 / flat
+        bias = self.maps['offset'][crop] * scale - self.pedestal
+        # Same memory order as the camera buffers, see LVWorker
+        self.scale = scale.ravel('F').astype(np.float32)
+        self.bias = bias.ravel('F').astype(np.float32)
+
+    def correctBlock(self, frame, start, end, work):
+        raw = frame[start:end]
+        w = work[:end - start]
+        np.multiply(raw, self.scale[start:end], out=w)
+        np.subtract(w, self.bias[start:end], out=w)
+        np.clip(w, 0, 65535, out=w)
+        np.copyto(raw, w, casting='unsafe')
+
+    def correctPart(self, frames, part):
+        n = len(self.scale)
+        step = -(-n // self.nThreads)
+        work = self.work[part]
+        for frame in frames:
+            for start in range(part*step, min((part + 1)*step, n),
+                               self.blockSize):
+                end = min(start + self.blockSize, (part + 1)*step, n)
+                self.correctBlock(frame, start, end, work)
+
+    def correct(self, frames):
+        """ Corrects in place a list of flat uint16 frames (the arrays of the
+        camera buffers)."""
+        if not self.ready or len(frames) == 0:
+            return
+        if len(frames[0]) != len(self.scale):
+            if not self.warned:
+                print('Frame size differs from the correction maps')
+                self.warned = True
+            return
+
+        with metrics.timer('correction.batch'):
+            if self.nThreads == 1:
+                self.correctPart(frames, 0)
+            else:
+                list(self.pool.map(lambda p: self.correctPart(frames, p),
+                                   range(self.nThreads)))
+        metrics.count('correction.frames', len(frames))
+
+    def corrected(self, frame):
+        """ Corrected copy of a flat uint16 frame."""
+        frame = frame.copy()
+        self.correct([frame])
+        return frame
+
+
+def checkShape(filename, frameShape, shape):
+    if shape is not None and tuple(frameShape) != tuple(shape):
+        raise ValueError('Frames of {} are {}, not {}'.format(
+            filename, tuple(frameShape), tuple(shape)))
+
+
+def meanFrame(filename, shape=None, chunk=100):
+    """ Mean of all the frames of a recording (hdf5 or tiff), computed by
+    chunks so that long stacks don't need to fit in memory. Raises
+    ValueError if the file has no frames or, if shape is given, frames of
+    another shape."""
+    if os.path.splitext(filename)[1] in ['.tif', '.tiff']:
+        with tiff.TiffFile(filename) as tfile:
+            if len(tfile.pages) == 0:
+                raise ValueError('No frames in {}'.format(filename))
+            total = None
+            for page in tfile.pages:
+                frame = page.asarray().astype(np.float64)
+                checkShape(filename, frame.shape, shape)
+                total = frame if total is None else total + frame
+            return total / len(tfile.pages)
+
+    with hdf.File(filename, 'r') as f:
+        # Recordings of a single stack, see recording.HDF5Store
+        data = f.get('Images')
+        if not isinstance(data, hdf.Dataset) or data.ndim != 3:
+            raise ValueError('No Images stack in {}'.format(filename))
+        if len(data) == 0:
+            raise ValueError('No frames in {}'.format(filename))
+        checkShape(filename, data.shape[1:], shape)
+        total = np.zeros(data.shape[1:])
+        for i in range(0, len(data), chunk):
+            total += data[i:i + chunk].sum(0, dtype=np.float64)
+        return total / len(data)
+
+
+def buildMaps(darkFile, flatFile=None, shape=None):
+    """ Correction maps from a dark recording (shutter closed, same exposure
+    as the measurements) and optionally a flat recording (homogeneous
+    illumination), both of frames of the given shape. Returns the offset
+    and flat maps."""
+    offset = meanFrame(darkFile, shape)
+    if flatFile is not None:
+        flat = meanFrame(flatFile, offset.shape) - offset
+        if not np.any(flat > 0):
+            raise ValueError('The flat recording is not above the dark')
+        flat /= flat[flat > 0].mean()
+    else:
+        flat = np.ones_like(offset)
+    return offset, flat
+
+
+def saveMaps(filename, offset, flat, origin=(0, 0)):
+    np.savez(filename, offset=offset.astype(np.float32),
+             flat=flat.astype(np.float32), origin=np.array(origin),
+             date=time.strftime('%Y-%m-%d %H:%M'))
+
+
+class CorrectionWidget(QtGui.QFrame):
+    """ Selection of the corrected streams and of the correction maps, and
+    calibration of new maps from dark and flat recordings."""
+
+    def __init__(self, main, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.main = main
+
+        self.modeBox = QtGui.QComboBox()
+        self.modeBox.addItems(FrameCorrector.modes)
+        self.modeBox.currentIndexChanged.connect(self.changeMode)
+        self.loadButton = QtGui.QPushButton('Load maps...')
+        self.loadButton.clicked.connect(self.loadMaps)
+        self.calibrateButton = QtGui.QPushButton('Calibrate...')
+        self.calibrateButton.setToolTip(
+            'Build the maps from a dark and a flat recording of the\n'
+            'current frame (the flat can be skipped)')
+        self.calibrateButton.clicked.connect(self.calibrate)
+        self.mapsLabel = QtGui.QLabel('No maps loaded')
+
+        grid = QtGui.QGridLayout()
+        self.setLayout(grid)
+        grid.addWidget(QtGui.QLabel('Correct'), 0, 0)
+        grid.addWidget(self.modeBox, 0, 1)
+        grid.addWidget(self.loadButton, 1, 0)
+        grid.addWidget(self.calibrateButton, 1, 1)
+        grid.addWidget(self.mapsLabel, 2, 0, 1, 2)
+
+    @property
+    def corrector(self):
+        return self.main.correctors[self.main.currCamIdx]
+
+    def changeMode(self):
+        self.corrector.setMode(self.modeBox.currentText())
+
+    def askFile(self, title, save=False):
+        root = Tk()
+        root.withdraw()
+        if save:
+            filename = filedialog.asksaveasfilename(
+                title=title, defaultextension='.npz',
+                filetypes=[('Correction maps', '.npz')])
+        else:
+            filename = filedialog.askopenfilename(
+                title=title, filetypes=[('Recordings', '.hdf5 .tiff .tif'),
+                                        ('Correction maps', '.npz')])
+        root.destroy()
+        return filename
+
+    def loadMaps(self, filename=None):
+        if not filename:
+            filename = self.askFile('Load correction maps')
+        if filename:
+            try:
+                self.corrector.load(filename)
+            except (KeyError, ValueError) as e:
+                print('Cannot load the correction maps:', e)
+            self.updateLabel()
+
+    def calibrate(self):
+        darkFile = self.askFile('Dark recording')
+        if not darkFile:
+            return
+        flatFile = self.askFile('Flat recording (cancel to skip)') or None
+        try:
+            offset, flat = buildMaps(darkFile, flatFile,
+                                     self.main.shapes[self.main.currCamIdx])
+        except ValueError as e:
+            print('Calibration failed:', e)
+            return
+        filename = self.askFile('Save correction maps', save=True)
+        if filename:
+            saveMaps(filename, offset, flat, self.main.frameStart)
+            self.loadMaps(filename)
+
+    def updateLabel(self):
+        if self.corrector.filename is None:
+            text = 'No maps loaded'
+        else:
+            text = os.path.basename(self.corrector.filename)
+            if not self.corrector.ready:
+                text += ' (not valid for this frame)'
+        self.mapsLabel.setText(text)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 18:12:09 2026
+
+@author: Tempesta_team
+
+Live drift tracking on fiducials (beads) selected in the liveview. Every
+frame the center of mass of each fiducial is computed on a small crop
+around its last position, and the mean displacement of the fiducials from
+their positions when tracking started is the drift of the frame. LVWorker
+stores it with the per-frame metadata of the recordings (drift_x, drift_y
+in recording.frameMetaDt) and other modules can read it as a stream with
+DriftTracker.getSamples, the same way as the focus lock signal.
+"""
+
+import time
+import threading
+import collections
+
+import numpy as np
+import pyqtgraph as pg
+from pyqtgraph.Qt import QtCore, QtGui
+
+import control.metrics as metrics
+
+
+class DriftTracker():
+    """ Tracks the fiducials given as (x, y) positions in image coordinates.
+    Drift values are in px."""
+
+    def __init__(self, boxSize=15, maxlen=10000):
+        self.boxSize = boxSize
+        self.lock = threading.Lock()
+        self.samples = collections.deque(maxlen=maxlen)
+        self.sampleCount = 0
+        self.setFiducials([])
+
+    @property
+    def active(self):
+        return len(self.positions) > 0
+
+    def setFiducials(self, positions):
+        """ Starts tracking around the given positions. The fiducial
+        positions in the next frame are the reference, with zero drift."""
+        with self.lock:
+            self.positions = np.array(positions, dtype=float).reshape(-1, 2)
+            self.reference = None
+            self.samples.clear()
+            self.sampleCount = 0
+
+    def centroid(self, image, position):
+        """ Center of mass of the crop around position, after subtracting
+        the mean of the crop. Returns None if the crop has no signal."""
+        half = self.boxSize // 2
+        x0 = int(round(position[0])) - half
+        y0 = int(round(position[1])) - half
+        x0 = min(max(x0, 0), image.shape[0] - self.boxSize)
+        y0 = min(max(y0, 0), image.shape[1] - self.boxSize)
+        crop = image[x0:x0 + self.boxSize, y0:y0 + self.boxSize]
+        crop = crop.astype(np.float32)
+        crop -= crop.mean()
+        np.maximum(crop, 0, out=crop)
+        total = crop.sum()
+        if total == 0:
+            return None
+        index = np.arange(self.boxSize, dtype=np.float32)
+        x = np.dot(crop.sum(1), index) / total
+        y = np.dot(crop.sum(0), index) / total
+        return x0 + x, y0 + y
+
+    def track(self, image, number=0, timestamp=None):
+        """ Drift (dx, dy) of the frame, NaN if no fiducial could be
+        found."""
+        if not self.active:
+            return np.nan, np.nan
+        if timestamp is None:
+            timestamp = time.perf_counter()
+
+        t0 = time.perf_counter()
+        with self.lock:
+            shifts = []
+            for i, position in enumerate(self.positions):
+                new = self.centroid(image, position)
+                if new is not None:
+                    self.positions[i] = new
+                    if self.reference is not None:
+                        shifts.append(self.positions[i] - self.reference[i])
+            if self.reference is None:
+                self.reference = self.positions.copy()
+                shifts = [np.zeros(2)]
+            if shifts:
+                dx, dy = np.mean(shifts, 0)
+            else:
+                dx = dy = np.nan
+            self.samples.append((number, timestamp, dx, dy))
+            self.sampleCount += 1
+        metrics.observe('drift.track', 1000*(time.perf_counter() - t0))
+        return dx, dy
+
+    def latest(self):
+        """ Last (frame number, timestamp, dx, dy) sample or None."""
+        with self.lock:
+            return self.samples[-1] if self.samples else None
+
+    def getSamples(self, n, timeout=5):
+        """ Waits for n new drift samples and returns them as an array of
+        (frame number, timestamp, dx, dy) rows."""
+        start = self.sampleCount
+        t0 = time.perf_counter()
+        while (self.sampleCount - start < n and
+               time.perf_counter() - t0 < timeout):
+            time.sleep(0.005)
+        with self.lock:
+            new = min(self.sampleCount - start, len(self.samples))
+            return np.array(list(self.samples)[len(self.samples) - new:])
+
+
+class DriftWidget(QtGui.QFrame):
+    """ Selection of the fiducials in the liveview and plot of the drift."""
+
+    def __init__(self, main, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.main = main
+        self.tracker = DriftTracker()
+        self.rois = []
+
+        self.addButton = QtGui.QPushButton('Add fiducial')
+        self.addButton.clicked.connect(self.addFiducial)
+        self.clearButton = QtGui.QPushButton('Clear')
+        self.clearButton.clicked.connect(self.clearFiducials)
+        self.trackButton = QtGui.QPushButton('Track')
+        self.trackButton.setCheckable(True)
+        self.trackButton.clicked.connect(self.toggleTracking)
+        self.driftLabel = QtGui.QLabel('')
+
+        self.plot = pg.PlotWidget()
+        self.plot.setLabels(bottom=('Frame'), left=('Drift', 'nm'))
+        self.plot.addLegend()
+        self.xCurve = self.plot.plot(pen='y', name='x')
+        self.yCurve = self.plot.plot(pen='c', name='y')
+
+        grid = QtGui.QGridLayout()
+        self.setLayout(grid)
+        grid.addWidget(self.addButton, 0, 0)
+        grid.addWidget(self.clearButton, 0, 1)
+        grid.addWidget(self.trackButton, 0, 2)
+        grid.addWidget(self.plot, 1, 0, 1, 3)
+        grid.addWidget(self.driftLabel, 2, 0, 1, 3)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.updatePlot)
+
+    def addFiducial(self):
+        size = self.tracker.boxSize
+        center = self.main.vb.viewRect().center()
+        roi = pg.RectROI((int(center.x()) - size // 2,
+                          int(center.y()) - size // 2), (size, size),
+                         pen='c', movable=True)
+        roi.setZValue(100)
+        self.main.vb.addItem(roi)
+        self.rois.append(roi)
+
+    def clearFiducials(self):
+        self.trackButton.setChecked(False)
+        self.toggleTracking()
+        for roi in self.rois:
+            self.main.vb.removeItem(roi)
+        self.rois = []
+
+    def toggleTracking(self):
+        if self.trackButton.isChecked() and self.rois:
+            centers = [(roi.pos()[0] + 0.5*roi.size()[0],
+                        roi.pos()[1] + 0.5*roi.size()[1])
+                       for roi in self.rois]
+            self.tracker.setFiducials(centers)
+            self.timer.start(200)
+        else:
+            self.trackButton.setChecked(False)
+            self.tracker.setFiducials([])
+            self.timer.stop()
+
+    def updatePlot(self):
+        with self.tracker.lock:
+            samples = np.array(self.tracker.samples)
+        if len(samples) == 0:
+            return
+        nmPerPx = 1000 * self.main.umxpx
+        self.xCurve.setData(samples[:, 0], nmPerPx * samples[:, 2])
+        self.yCurve.setData(samples[:, 0], nmPerPx * samples[:, 3])
+        self.driftLabel.setText('x: {:.1f} nm, y: {:.1f} nm'.format(
+            nmPerPx * samples[-1, 2], nmPerPx * samples[-1, 3]))
+
+    def closeEvent(self, *args, **kwargs):
+        self.timer.stop()
@@ -7,8 +7,9 @@ Created on Wed Oct  1 13:41:48 2014
 
 import numpy as np
 import time
+import json
+import collections
 import scipy.ndimage as ndi
-from skimage.feature import peak_local_max
 
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui
@@ -16,6 +17,7 @@ import pyqtgraph.ptime as ptime
 
 from lantz import Q_
 import control.pi as pi
+import control.metrics as metrics
 
 from instrumental import u
 
@@ -70,6 +72,7 @@ class FocusWidget(QtGui.QFrame):
         self.CalibToLabel = QtGui.QLabel('to [um]')
         self.CalibToEdit = QtGui.QLineEdit('51')
         self.focusCalibThread = FocusCalibThread(self)
+        self.focusCalibThread.doneSignal.connect(self.calibrationDone)
         self.focusCalibButton = QtGui.QPushButton('Calib')
         self.focusCalibButton.setSizePolicy(QtGui.QSizePolicy.Preferred,
                                             QtGui.QSizePolicy.Expanding)
@@ -77,22 +80,33 @@ class FocusWidget(QtGui.QFrame):
         self.CalibCurveButton = QtGui.QPushButton('See Calib')
         self.CalibCurveButton.clicked.connect(self.showCalibCurve)
         self.CalibCurveWindow = CaribCurveWindow(self)
-        try:
-            prevCal = np.around(np.loadtxt('calibration')[0]/10)
-            text = '1 px --> {} nm'.format(prevCal)
-            self.calibrationDisplay = QtGui.QLineEdit(text)
-        except:
-            self.calibrationDisplay = QtGui.QLineEdit('0 px --> 0 nm')
+        self.calibrationDisplay = QtGui.QLineEdit('0 px --> 0 nm')
         self.calibrationDisplay.setReadOnly(False)
+        self.calibration = loadCalibration()
+        if self.calibration is not None:
+            self.calibrationDone()
 
         # focus lock graph widget
         self.focusLockGraph = FocusLockGraph(self, main)
         self.webcamGraph = WebcamGraph()
 
+        # Focus lock loop rate
+        self.rateLabel = QtGui.QLabel('Rate [Hz]')
+        self.rateEdit = QtGui.QLineEdit('10')
+        self.rateEdit.editingFinished.connect(self.changeRate)
+        self.loopLabel = QtGui.QLabel('')
+
         # Thread for getting the data and processing it
         self.processDataThread = ProcessDataThread(self)
+        self.processDataThread.unlockSignal.connect(self.unlockFocus)
+        self.changeRate()
         self.processDataThread.start()
 
+        # Graphs are updated from the GUI thread, independently of the loop
+        self.graphTimer = QtCore.QTimer()
+        self.graphTimer.timeout.connect(self.updateGraphs)
+        self.graphTimer.start(100)
+
         # GUI layout
         self.setFrameStyle(QtGui.QFrame.Panel | QtGui.QFrame.Raised)
         grid = QtGui.QGridLayout()
@@ -116,6 +130,9 @@ class FocusWidget(QtGui.QFrame):
         grid.addWidget(self.positionLabel, 2, 6)
         grid.addWidget(self.positionEdit, 2, 7)
         grid.addWidget(self.positionSetButton, 3, 6, 1, 2)
+        grid.addWidget(self.rateLabel, 5, 0)
+        grid.addWidget(self.rateEdit, 5, 1)
+        grid.addWidget(self.loopLabel, 5, 2, 1, 6)
 
 #        grid.setColumnMinimumWidth(1, 100)
 #        grid.setColumnMinimumWidth(2, 40)
@@ -140,13 +157,14 @@ class FocusWidget(QtGui.QFrame):
             self.setPoint = self.processDataThread.focusSignal
             self.focusLockGraph.line = self.focusLockGraph.plot.addLine(
                 y=self.setPoint, pen='r')
-            self.PI = pi.PI(self.setPoint,
-                            np.float(self.kpEdit.text()),
-                            np.float(self.kiEdit.text()))
-            self.initialZ = self.z.position
+            self.processDataThread.lock(self.setPoint,
+                                        np.float(self.kpEdit.text()),
+                                        np.float(self.kiEdit.text()),
+                                        self.z.position)
 
     def unlockFocus(self):
         if self.locked:
+            self.processDataThread.unlock()
             self.locked = False
             self.lockButton.setChecked(False)
             self.focusLockGraph.plot.removeItem(self.focusLockGraph.line)
@@ -158,16 +176,34 @@ class FocusWidget(QtGui.QFrame):
             self.twoFociVar = False
         else:
             self.twoFociVar = True
-            
-    def updatePI(self):
-        # TODO: explain ifs
-        self.distance = self.z.position - self.initialZ
-        #        out = self.PI.update(self.stream.newData)
-        out = self.PI.update(self.processDataThread.focusSignal)
-        if abs(self.distance) > 10 * self.um or abs(out) > 5:
+
+    def changeRate(self):
+        try:
+            rate = float(self.rateEdit.text())
+        except ValueError:
+            rate = self.processDataThread.scansPerS
+        if rate <= 0:
+            rate = self.processDataThread.scansPerS
+        self.rateEdit.setText('{:g}'.format(rate))
+        if rate != self.processDataThread.scansPerS:
+            # The gains are scaled to the rate when locking
             self.unlockFocus()
-        else:
-            self.z.moveRelative(out * self.um)
+            self.processDataThread.setRate(rate)
+
+    def updateGraphs(self):
+        """ Drains the data produced by the focus lock loop."""
+        data = self.processDataThread.plotData
+        samples = [data.popleft() for _ in range(len(data))]
+        if len(samples) > 0:
+            times, signals = np.array(samples).T
+            self.focusLockGraph.update(signals, times)
+        self.webcamGraph.update(self.processDataThread.image)
+
+        rate, jitter, maxPeriod = self.processDataThread.timingStats()
+        self.loopLabel.setText(
+            '{:.1f} Hz, jitter {:.2f} ms, max period {:.1f} ms, {} overruns'
+            ''.format(rate, jitter, maxPeriod,
+                      self.processDataThread.overruns))
 
     def exportData(self):
         self.sizeofData = np.size(self.focusLockGraph.savedDataSignal)
@@ -200,15 +236,138 @@ class FocusWidget(QtGui.QFrame):
 
         self.n += 1
 
+    def calibrationDone(self):
+        self.calibrationResult = np.around(self.calibration['poly'], 4)
+        text = '1 px --> {} nm'.format(
+            np.round(1000 / self.calibration['slope'], 1))
+        hysteresis = self.calibration.get('hysteresis_um')
+        if hysteresis is not None:
+            text += ', hysteresis {} nm'.format(np.round(1000*hysteresis))
+        self.calibrationDisplay.setText(text)
+
     def showCalibCurve(self):
         self.CalibCurveWindow.run()
         self.CalibCurveWindow.show()
 
     def closeEvent(self, *args, **kwargs):
+        self.graphTimer.stop()
+        self.processDataThread.stop()
         super().closeEvent(*args, **kwargs)
 
 
+class FocusSpotTracker():
+    """ Focus signal engine. Finds the reflected laser spot in the webcam
+    image and returns its center of mass relative to the sensor center.
+
+    Once the spot has been found, only a ROI around its previous position is
+    filtered, as a float32 separable gaussian. The ROI margin adapts to the
+    last displacement of the spot so fast drifts are still followed. The
+    whole frame is only searched, downsampled, when there is no previous
+    position or the spot is lost (its maximum falls at the ROI border or its
+    intensity drops below minRatio of the last one).
+
+    With twoFoci, among the two strongest spots of the full frame the one
+    with the lowest column is followed (same choice as the old peak_local_max
+    implementation)."""
+
+    def __init__(self, boxSize=150, sigma=5, downsample=4, minDistance=100,
+                 minRatio=0.5):
+        self.boxSize = boxSize
+        self.sigma = sigma
+        self.downsample = downsample
+        self.minDistance = minDistance
+        self.minRatio = minRatio
+        self.reset()
+
+    def reset(self):
+        self.position = None
+        self.peak = None
+        self.margin = 3*self.sigma
+
+    def filtered(self, image):
+        out = image.astype(np.float32)
+        ndi.gaussian_filter1d(out, self.sigma, 0, output=out)
+        ndi.gaussian_filter1d(out, self.sigma, 1, output=out)
+        return out
+
+    def search(self, image, twoFoci=False):
+        """ Coarse spot position from a downsampled version of the frame."""
+        d = self.downsample
+        h, w = image.shape[0] // d, image.shape[1] // d
+        small = image[:h*d, :w*d].reshape(h, d, w, d).mean((1, 3),
+                                                           dtype=np.float32)
+        small = ndi.gaussian_filter(small, self.sigma / d)
+
+        if twoFoci:
+            size = max(2*self.minDistance // d + 1, 3)
+            peaks = small == ndi.maximum_filter(small, size)
+            coords = np.argwhere(peaks)
+            if len(coords) > 1:
+                values = small[peaks]
+                top = coords[np.argsort(values)[-2:]]
+                return (top[np.argmin(top[:, 1])] + 0.5) * d
+
+        return (np.array(np.unravel_index(np.argmax(small), small.shape)) +
+                0.5) * d
+
+    def crop(self, image, center, half):
+        low = np.clip(np.round(center - half).astype(int), 0, image.shape)
+        high = np.clip(np.round(center + half).astype(int), 0, image.shape)
+        return image[low[0]:high[0], low[1]:high[1]], low
+
+    def locate(self, image, twoFoci=False):
+        sensorCenter = np.array(image.shape) / 2
+        if self.position is None:
+            self.position = self.search(image, twoFoci)
+
+        # Filtered ROI around the previous position. Filtering a wider area
+        # than the center of mass box avoids the filter's border effects.
+        half = self.boxSize / 2 + self.margin
+        roi, low = self.crop(image, self.position, half)
+        roi = self.filtered(roi)
+        peak = np.array(np.unravel_index(np.argmax(roi), roi.shape))
+        value = roi[tuple(peak)]
+
+        # Maxima at the sensor edges are fine, at the ROI edges they mean that
+        # the spot is outside of the ROI
+        edge = self.margin / 2
+        size = np.array(roi.shape)
+        atBorder = np.any(((peak < edge) & (low > 0)) |
+                          ((peak >= size - edge) &
+                           (low + size < image.shape)))
+        dimmer = self.peak is not None and value < self.minRatio*self.peak
+        if (atBorder or dimmer) and self.peak is not None:
+            # Spot lost, search it again in the whole frame
+            self.reset()
+            return self.locate(image, twoFoci)
+
+        # Center of mass on a box around the maximum. If the spot moved so
+        # much that the box doesn't fit in the ROI, filter around the new
+        # position.
+        center = low + peak
+        step = np.max(np.abs(center - self.position))
+        box, boxLow = self.crop(roi, peak, self.boxSize / 2)
+        imageBox, imageBoxLow = self.crop(image, center, self.boxSize / 2)
+        if (np.any(boxLow + low != imageBoxLow) or
+                box.shape != imageBox.shape):
+            roi, low = self.crop(image, center, self.boxSize / 2 + self.sigma)
+            roi = self.filtered(roi)
+            box, boxLow = self.crop(roi, center - low, self.boxSize / 2)
+        massCenter = np.array(ndi.center_of_mass(box)) + boxLow + low
+
+        self.margin = max(3*self.sigma, 3*step)
+        self.position = center
+        self.peak = value
+
+        return massCenter - sensorCenter
+
+
 class ProcessDataThread(QtCore.QThread):
+    """ Focus lock control loop: grab, focus signal, PI and piezo correction
+    at a fixed rate. No GUI object is touched from this thread, the plotted
+    data goes through plotData and unlocking through unlockSignal."""
+
+    unlockSignal = QtCore.pyqtSignal()
 
     def __init__(self, focusWidget, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -236,77 +395,145 @@ class ProcessDataThread(QtCore.QThread):
 
         self.focusSignal = 0
 
-        self.scansPerS = 10
+        # Loop rate and timing statistics. The kp and ki of the FocusWidget
+        # are the ones tuned at gainRate, see scaledGains.
+        self.gainRate = 10
+        self.scansPerS = self.gainRate
         self.focusTime = 1000 / self.scansPerS
+        self.running = False
+        self.periods = collections.deque(maxlen=500)
+        self.overruns = 0
+
         self.focusBoxSize = 150
+        self.tracker = FocusSpotTracker(self.focusBoxSize)
+
+        # Lock state, only modified through lock() and unlock()
+        self.locked = False
+        self.PI = None
+        self.initialZ = None
+        self.zTarget = None
+
+        # Data for the GUI, drained by FocusWidget.updateGraphs. Appending
+        # to and popping from a deque are atomic so no lock is needed.
+        self.plotDecimation = 1
+        self.plotData = collections.deque(maxlen=10000)
+        self.startTime = ptime.time()
+
+        # Every focus signal value, for the calibration
+        self.sampleCount = 0
+        self.samples = collections.deque(maxlen=1000)
+
+    def setRate(self, scansPerS):
+        self.scansPerS = scansPerS
+        self.focusTime = 1000 / scansPerS
+        # keep the plot at ~10 points per second
+        self.plotDecimation = max(1, int(round(scansPerS / 10)))
+
+    def scaledGains(self, kp, ki):
+        """ The piezo moves by the PI output every iteration, so the
+        correction per second of the proportional term grows with the rate
+        and the one of the integral term with its square. Returns the gains
+        that give at scansPerS the response kp and ki give at gainRate."""
+        ratio = self.gainRate / self.scansPerS
+        return kp * ratio, ki * ratio**2
+
+    def lock(self, setPoint, kp, ki, z):
+        self.PI = pi.PI(setPoint, *self.scaledGains(kp, ki))
+        self.initialZ = z
+        self.zTarget = z
+        self.locked = True
+
+    def unlock(self):
+        self.locked = False
 
     def run(self):
-        while True:
-            self.update()
-            self.msleep(int(self.focusTime))
-
-    def update(self):
-        self.updateFS()
-        self.focusWidget.webcamGraph.update(self.image)
-        self.focusWidget.focusLockGraph.update(self.focusSignal)
+        """ Fixed-rate loop. Every iteration is scheduled at an absolute
+        deadline so that the processing time doesn't add to the period. If
+        an iteration takes longer than the period, the loop starts the next
+        one right away instead of trying to catch up."""
+        self.running = True
+        period = self.focusTime / 1000
+        deadline = time.perf_counter()
+        last = deadline
+        i = 0
+        while self.running:
+            self.update(i % self.plotDecimation == 0)
+            i += 1
+
+            now = time.perf_counter()
+            self.periods.append(now - last)
+            metrics.observe('focus.period', 1000*(now - last))
+            last = now
+
+            period = self.focusTime / 1000
+            deadline += period
+            if deadline > now:
+                time.sleep(deadline - now)
+            else:
+                self.overruns += 1
+                metrics.count('focus.overruns')
+                deadline = now
+
+    def stop(self):
+        self.running = False
+        self.wait()
+
+    def getSamples(self, n, timeout=5):
+        """ Waits for n new focus signal values and returns them."""
+        start = self.sampleCount
+        t0 = time.perf_counter()
+        while (self.sampleCount - start < n and
+               time.perf_counter() - t0 < timeout):
+            time.sleep(0.2*self.focusTime / 1000)
+        new = min(self.sampleCount - start, len(self.samples))
+        return np.array(list(self.samples)[len(self.samples) - new:])
+
+    def timingStats(self):
+        """ Returns the mean rate [Hz], the period jitter (std) and the
+        maximum period [ms] of the last iterations."""
+        periods = np.array(self.periods)
+        if len(periods) < 2:
+            return 0, 0, 0
+        return 1 / periods.mean(), 1000*periods.std(), 1000*periods.max()
+
+    def update(self, plot=True):
+        with metrics.timer('focus.updateFS'):
+            self.updateFS()
+        self.samples.append(self.focusSignal)
+        self.sampleCount += 1
         # update the PI control
-        if self.focusWidget.locked:
-            self.focusWidget.updatePI()
+        if self.locked:
+            with metrics.timer('focus.updatePI'):
+                self.updatePI()
+        if plot:
+            self.plotData.append((ptime.time() - self.startTime,
+                                  self.focusSignal))
+
+    def updatePI(self):
+        """ Moves the piezo according to the PI output. The commanded position
+        is tracked here so the piezo doesn't have to be queried every
+        iteration. If the correction goes out of range the loop unlocks and
+        tells the GUI through unlockSignal."""
+        out = self.PI.update(self.focusSignal)
+        distance = self.zTarget - self.initialZ
+        if abs(distance) > 10 * self.focusWidget.um or abs(out) > 5:
+            self.locked = False
+            self.unlockSignal.emit()
+        else:
+            self.zTarget = self.zTarget + out * self.focusWidget.um
+            self.focusWidget.z.moveAbsolute(self.zTarget)
 
     def updateFS(self):
         try:
             self.image = self.webcam.grab_image()
         except:
             pass
-        
-        #Take a sub-part of the image and gaussian filter it, to remove strong
-        # reflections that can interfere and to lower the influence of noise
-        # in the case of a low signal especially.
-        imagearray = np.array(self.image)
-        imagearray = imagearray[:, :]
-        imagearraygf = ndi.filters.gaussian_filter(imagearray, 5)
-
-        # If there are two strong maxima in the image, follow only the top one. 
-        if self.focusWidget.twoFociVar:
-            allmaxcoords = peak_local_max(imagearraygf, min_distance=100)
-            size = allmaxcoords.shape
-            maxvals = np.zeros(size[0])
-            maxvalpos = np.zeros(2)
-            for n in range(0, size[0]):
-                if imagearraygf[allmaxcoords[n][0], allmaxcoords[n][1]] > maxvals[0]:
-                    if imagearraygf[allmaxcoords[n][0], allmaxcoords[n][1]] > maxvals[1]:
-                        tempval = maxvals[1]
-                        maxvals[0] = tempval
-                        maxvals[1] = imagearraygf[allmaxcoords[n][0], allmaxcoords[n][1]]
-                        tempval = maxvalpos[1]
-                        maxvalpos[0] = tempval
-                        maxvalpos[1] = n
-                    else:
-                        maxvals[0] = imagearraygf[allmaxcoords[n][0], allmaxcoords[n][1]]
-                        maxvalpos[0] = n
-            xcenter = allmaxcoords[maxvalpos[0]][0]
-            ycenter = allmaxcoords[maxvalpos[0]][1]
-            if allmaxcoords[maxvalpos[1]][1] < ycenter:
-                xcenter = allmaxcoords[maxvalpos[1]][0]
-                ycenter = allmaxcoords[maxvalpos[1]][1]
-            centercoords2 = np.array([xcenter, ycenter])
-        else:
-            centercoords = np.where(imagearraygf == np.array(imagearraygf.max()))
-            centercoords2 = np.array([centercoords[0][0], centercoords[1][0]])
-
-        # Calculate the center of mass on only a small sub box with the max,
-        # to remove influence of noise outside the maximum.
-        xlow = max(0, (centercoords2[0] - self.focusBoxSize / 2))
-        xhigh = min(1024, (centercoords2[0] + self.focusBoxSize / 2))
-        ylow = max(0, (centercoords2[1] - self.focusBoxSize / 2))
-        yhigh = min(1280, (centercoords2[1] + self.focusBoxSize / 2))
-        imagearraygfsub = imagearraygf[xlow:xhigh,ylow:yhigh]
-        self.image = imagearraygf
-        self.massCenter = np.array(ndi.measurements.center_of_mass(imagearraygfsub))
-        self.massCenter[0] = self.massCenter[0] + centercoords2[0] - self.focusBoxSize / 2 - self.sensorSize[0] / 2
-        self.massCenter[1] = self.massCenter[1] + centercoords2[1] - self.focusBoxSize / 2 - self.sensorSize[1] / 2
+
+        self.massCenter = self.tracker.locate(np.asarray(self.image),
+                                              self.focusWidget.twoFociVar)
         self.focusSignal = self.massCenter[1]
 
+
 class FocusLockGraph(pg.GraphicsWindow):
 
     def __init__(self, focusWidget, main=None, *args, **kwargs):
@@ -344,31 +571,30 @@ class FocusLockGraph(pg.GraphicsWindow):
         if self.main is not None:
             self.recButton = self.main.recButton
 
-    def update(self, focusSignal):
-        """ Update the data displayed in the graphs"""
-        self.focusSignal = focusSignal
-
-        if self.ptr < self.npoints:
-            self.data[self.ptr] = self.focusSignal
-            self.time[self.ptr] = ptime.time() - self.startTime
-            self.focusCurve.setData(self.time[1:self.ptr + 1],
-                                    self.data[1:self.ptr + 1])
+    def update(self, focusSignals, times):
+        """ Update the data displayed in the graphs with the new samples of
+        the focus signal and their times [s]"""
+        n = len(focusSignals)
+        self.focusSignal = focusSignals[-1]
 
+        if n >= self.npoints:
+            self.data[:] = focusSignals[-self.npoints:]
+            self.time[:] = times[-self.npoints:]
         else:
-            self.data[:-1] = self.data[1:]
-            self.data[-1] = self.focusSignal
-            self.time[:-1] = self.time[1:]
-            self.time[-1] = ptime.time() - self.startTime
+            self.data = np.roll(self.data, -n)
+            self.data[-n:] = focusSignals
+            self.time = np.roll(self.time, -n)
+            self.time[-n:] = times
+        self.ptr += n
 
-            self.focusCurve.setData(self.time, self.data)
-
-        self.ptr += 1
+        valid = min(self.ptr, self.npoints)
+        self.focusCurve.setData(self.time[-valid:], self.data[-valid:])
 
         if self.main is not None:
 
             if self.recButton.isChecked():
-                self.savedDataSignal.append(self.focusSignal)
-                self.savedDataTime.append(self.time[-1])
+                self.savedDataSignal.extend(focusSignals)
+                self.savedDataTime.extend(times)
 #               self.savedDataPosition.append(self.DAQ.position)
 
             if self.recButton.isChecked():
@@ -388,7 +614,56 @@ class WebcamGraph(pg.GraphicsWindow):
         self.image.setImage(image)
 
 
+def robustLinearFit(x, y, k=1.345, iterations=20):
+    """ Linear fit with Huber weights (iteratively reweighted least squares)
+    so outlier steps don't pull the calibration. Returns the coefficients in
+    np.polyfit order and the final weights."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    A = np.column_stack((x, np.ones_like(x)))
+    weights = np.ones_like(x)
+    for i in range(iterations):
+        sw = np.sqrt(weights)
+        poly = np.linalg.lstsq(A * sw[:, np.newaxis], y * sw, rcond=None)[0]
+        residuals = y - A.dot(poly)
+        # scale from the median absolute deviation
+        scale = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+        if scale == 0:
+            break
+        u = np.abs(residuals) / (k * scale)
+        newWeights = np.where(u <= 1, 1, 1 / np.maximum(u, 1e-12))
+        if np.allclose(newWeights, weights, atol=1e-4):
+            break
+        weights = newWeights
+
+    return poly, weights
+
+
+def loadCalibration(filename='calibration.json'):
+    """ Returns the stored calibration as a dict, or None. Falls back to the
+    old text file with only the polynomial."""
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    try:
+        poly = np.loadtxt('calibration')
+        return {'poly': poly.tolist(), 'slope': poly[0]}
+    except (OSError, ValueError, IndexError):
+        return None
+
+
 class FocusCalibThread(QtCore.QThread):
+    """ Focus calibration. The piezo is stepped between the two positions of
+    the GUI and, at every step, the focus signal from the lock loop is used
+    to detect when the piezo has settled: the std of the last settleWindow
+    values has to be below settleTol, and the mean has to stay put from one
+    window to the next. nAverage values are then averaged. With bidirectional
+    the sweep goes back to the start to measure the hysteresis. The signal vs
+    position line is fitted robustly and stored in calibration.json."""
+
+    doneSignal = QtCore.pyqtSignal()
 
     def __init__(self, focusWidget, *args, **kwargs):
 
@@ -399,35 +674,99 @@ class FocusCalibThread(QtCore.QThread):
         self.focusWidget = focusWidget  # mainwidget será FocusLockWidget
         self.um = Q_(1, 'micrometer')
 
+        self.nSteps = 20
+        self.nAverage = 10
+        self.settleWindow = 5
+        self.settleTol = None     # px, None to estimate it from the noise
+        self.settleTimeout = 2    # s
+        self.bidirectional = True
+        self.filename = 'calibration.json'
+
+    def settle(self, tol):
+        """ Waits until the focus signal is stable. Returns the time it took
+        and whether it settled before the timeout."""
+        loop = self.focusWidget.processDataThread
+        t0 = time.perf_counter()
+        last = loop.getSamples(self.settleWindow)
+        while time.perf_counter() - t0 < self.settleTimeout:
+            window = loop.getSamples(self.settleWindow)
+            if (np.std(window) < tol and
+                    abs(np.mean(window) - np.mean(last)) < tol):
+                return time.perf_counter() - t0, True
+            last = window
+
+        return time.perf_counter() - t0, False
+
     def run(self):
-        self.signalData = []
-        self.positionData = []
+        loop = self.focusWidget.processDataThread
         self.start = np.float(self.focusWidget.CalibFromEdit.text())
         self.end = np.float(self.focusWidget.CalibToEdit.text())
-        self.scan_list = np.round(np.linspace(self.start, self.end, 20), 2)
-        for x in self.scan_list:
+        self.scan_list = np.round(np.linspace(self.start, self.end,
+                                              self.nSteps), 2)
+        if self.bidirectional:
+            self.scan_list = np.concatenate((self.scan_list,
+                                             self.scan_list[::-1]))
+        direction = np.zeros(len(self.scan_list), dtype=int)
+        if self.bidirectional:
+            direction[self.nSteps:] = 1
+
+        # Settling tolerance from the signal noise at the first position
+        self.z.moveAbsolute(self.scan_list[0] * self.um)
+        time.sleep(0.5)
+        tol = self.settleTol
+        if tol is None:
+            noise = np.std(loop.getSamples(4*self.settleWindow))
+            tol = max(3*noise, 0.05)
+
+        n = len(self.scan_list)
+        self.positionData = np.zeros(n)
+        self.signalData = np.zeros(n)
+        self.signalStd = np.zeros(n)
+        self.settleTimes = np.zeros(n)
+        self.settled = np.zeros(n, dtype=bool)
+        for i, x in enumerate(self.scan_list):
             self.z.moveAbsolute(x * self.um)
-            time.sleep(0.5)
-            self.focusCalibSignal = \
-                self.focusWidget.processDataThread.focusSignal
-            self.signalData.append(self.focusCalibSignal)
-            self.positionData.append(self.z.position.magnitude)
+            self.settleTimes[i], self.settled[i] = self.settle(tol)
+            signal = loop.getSamples(self.nAverage)
+            self.signalData[i] = np.mean(signal)
+            self.signalStd[i] = np.std(signal)
+            self.positionData[i] = self.z.position.magnitude
+
+        self.poly, self.weights = robustLinearFit(self.positionData,
+                                                  self.signalData)
+        residuals = self.signalData - np.polyval(self.poly, self.positionData)
+
+        # Hysteresis: difference between the sweeps at the same positions
+        if self.bidirectional:
+            up = self.signalData[direction == 0]
+            down = self.signalData[direction == 1][::-1]
+            self.hysteresis = np.max(np.abs(up - down)) / self.poly[0]
+        else:
+            self.hysteresis = None
 
-        self.poly = np.polyfit(self.positionData, self.signalData, 1)
         self.calibrationResult = np.around(self.poly, 4)
+        self.calibration = {
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'poly': self.poly.tolist(),
+            'slope': self.poly[0],
+            'nm_per_px': 1000 / self.poly[0],
+            'residual_std': np.std(residuals[self.weights > 0.5]),
+            'hysteresis_um': self.hysteresis,
+            'settle_tol': tol,
+            'positions': self.positionData.tolist(),
+            'signals': self.signalData.tolist(),
+            'signal_std': self.signalStd.tolist(),
+            'direction': direction.tolist(),
+            'weights': self.weights.tolist(),
+            'settle_times': self.settleTimes.tolist(),
+            'settled': self.settled.tolist()}
         self.export()
+        self.doneSignal.emit()
 
     def export(self):
-
-        np.savetxt('calibration', self.calibrationResult)
-        cal = self.poly[0]
-        calText = '1 px --> {} nm'.format(np.round(1000/cal, 1))
-        self.focusWidget.calibrationDisplay.setText(calText)
-        d = [self.positionData, self.calibrationResult[::-1]]
-        self.savedCalibData = [self.positionData,
-                               self.signalData,
-                               np.polynomial.polynomial.polyval(d[0], d[1])]
-        np.savetxt('calibrationcurves', self.savedCalibData)
+        with open(self.filename, 'w') as f:
+            json.dump(self.calibration, f, indent=1)
+        self.focusWidget.calibration = self.calibration
 
 
 class CaribCurveWindow(QtGui.QFrame):
@@ -459,11 +798,18 @@ class FocusCalibGraph(pg.GraphicsWindow):
 
     def draw(self):
         self.plot.clear()
-        self.signalData = self.focusWidget.focusCalibThread.signalData
-        self.positionData = self.focusWidget.focusCalibThread.positionData
-        self.poly = self.focusWidget.focusCalibThread.poly
-        self.plot.plot(self.positionData,
-                       self.signalData, pen=None, symbol='o')
+        calibration = self.focusWidget.calibration
+        if calibration is None or 'positions' not in calibration:
+            return
+
+        self.positionData = np.array(calibration['positions'])
+        self.signalData = np.array(calibration['signals'])
+        self.poly = calibration['poly']
+        direction = np.array(calibration['direction'])
+        for d, brush in zip([0, 1], ['y', 'c']):
+            self.plot.plot(self.positionData[direction == d],
+                           self.signalData[direction == d], pen=None,
+                           symbol='o', symbolBrush=brush)
         self.plot.plot(self.positionData,
                        np.polyval(self.poly, self.positionData), pen='r')
 
@@ -5,10 +5,7 @@ Created on Fri Feb  6 13:20:02 2015
 @author: federico
 """
 import os
-import time
 import numpy as np
-import h5py as hdf
-import tifffile as tiff
 import configparser
 import collections
 from ast import literal_eval
@@ -21,6 +18,9 @@ from tkinter import Tk, filedialog, simpledialog
 
 from lantz import Q_
 
+import control.metrics as metrics
+import control.tiffconvert as tiffconvert
+
 
 # taken from https://www.mrao.cam.ac.uk/~dag/CUBEHELIX/cubehelix.py
 def cubehelix(gamma=1.0, s=0.5, r=-1.5, h=1.0):
@@ -68,15 +68,6 @@ def insertSuffix(filename, suffix, newExt=None):
         return names[0] + suffix + newExt
 
 
-def fileSizeGB(shape):
-    # self.nPixels() * self.nExpositions * 16 / (8 * 1024**3)
-    return shape[0]*shape[1]*shape[2] / 2**29
-
-
-def nFramesPerChunk(shape):
-    return int(1.8 * 2**29 / (shape[1] * shape[2]))
-
-
 def getFilenames(title, filetypes):
     try:
         root = Tk()
@@ -337,6 +328,8 @@ class TiffConverterThread(QtCore.QThread):
 
 
 class TiffConverter(QtCore.QObject):
+    """ Runs control.tiffconvert on the selected HDF5 files (or on the given
+    one) from a Qt thread."""
 
     def __init__(self, filenames, thread, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -345,49 +338,18 @@ class TiffConverter(QtCore.QObject):
 
     def run(self):
 
-        if self.filenames is None:
+        # Triggered actions pass their checked state as filenames
+        if not isinstance(self.filenames, str):
             self.filenames = getFilenames("Select HDF5 files",
                                           [('HDF5 files', '.hdf5')])
 
         else:
             self.filenames = [self.filenames]
 
-        if len(self.filenames) > 0:
-            for filename in self.filenames:
-
-                file = hdf.File(filename, mode='r')
-
-                for dataname in file:
-
-                    data = file[dataname]
-                    filesize = fileSizeGB(data.shape)
-                    filename = (os.path.splitext(filename)[0] + '_' + dataname)
-                    attrsToTxt(filename, [at for at in data.attrs.items()])
-
-                    if filesize < 2:
-                        time.sleep(5)
-                        tiff.imsave(filename + '.tiff', data,
-                                    description=dataname, software='Tormenta')
-                    else:
-                        n = nFramesPerChunk(data.shape)
-                        i = 0
-                        while i < filesize // 1.8:
-                            suffix = '_part{}'.format(i)
-                            partName = insertSuffix(filename, suffix, '.tiff')
-                            tiff.imsave(partName, data[i*n:(i + 1)*n],
-                                        description=dataname,
-                                        software='Tormenta')
-                            i += 1
-                        if filesize % 2 > 0:
-                            suffix = '_part{}'.format(i)
-                            partName = insertSuffix(filename, suffix, '.tiff')
-                            tiff.imsave(partName, data[i*n:],
-                                        description=dataname,
-                                        software='Tormenta')
-
-                file.close()
-
-        print(self.filenames, 'exported to TIFF')
+        if self.filenames:
+            tiffconvert.convert(self.filenames)
+            print(self.filenames, 'exported to TIFF')
+
         self.filenames = None
         self.thread.terminate()
         # for opening attributes this should work:
@@ -657,6 +619,72 @@ class AlignWidgetAverage(QtGui.QFrame):
         super().closeEvent(*args, **kwargs)
 
 
+class EnvelopeCurve():
+    """Curve of a long waveform in a PlotItem, drawn as the min/max envelope
+    of the samples falling in each pixel column of the view instead of all
+    the samples. The envelopes are computed once for each decimation factor
+    (powers of 2, each from the finer one) and cached until setData, so
+    zooming and panning only slice them; zooming in refines the envelope
+    down to the samples themselves. x is the sample index.
+
+    :param pg.PlotItem plot: plot where the curve is added
+    Other arguments go to PlotItem.plot (pen, name...)."""
+
+    def __init__(self, plot, *args, **kwargs):
+        self.plot = plot
+        self.item = plot.plot(*args, **kwargs)
+        self.data = np.zeros(0)
+        self.cache = {}
+        plot.vb.sigXRangeChanged.connect(self.refresh)
+        plot.vb.sigResized.connect(self.refresh)
+
+    def setData(self, data):
+        self.data = np.asarray(data)
+        self.cache = {1: (self.data, self.data)}
+        self.refresh()
+
+    def envelope(self, factor):
+        """ (min, max) of each block of factor samples."""
+        if factor not in self.cache:
+            mins, maxs = self.envelope(factor // 2)
+            n = len(mins) - len(mins) % 2
+            newMins = np.minimum(mins[0:n:2], mins[1:n:2])
+            newMaxs = np.maximum(maxs[0:n:2], maxs[1:n:2])
+            if n < len(mins):
+                newMins = np.append(newMins, mins[-1])
+                newMaxs = np.append(newMaxs, maxs[-1])
+            self.cache[factor] = (newMins, newMaxs)
+        return self.cache[factor]
+
+    def refresh(self):
+        size = len(self.data)
+        if size == 0:
+            self.item.setData([], [])
+            return
+
+        if self.plot.vb.autoRangeEnabled()[0]:
+            start, stop = 0, size
+        else:
+            xRange = self.plot.vb.viewRange()[0]
+            start = min(max(int(xRange[0]), 0), size - 1)
+            stop = min(max(int(np.ceil(xRange[1])) + 1, start + 1), size)
+        perPixel = (stop - start) / max(self.plot.vb.width(), 1)
+
+        if perPixel < 2:
+            x = np.arange(start, stop)
+            y = self.data[start:stop]
+        else:
+            factor = 2**int(np.log2(perPixel))
+            mins, maxs = self.envelope(factor)
+            first = start // factor
+            last = -(-stop // factor)
+            x = np.repeat(np.arange(first, last) * factor, 2)
+            y = np.empty(2*(last - first), dtype=mins.dtype)
+            y[0::2] = mins[first:last]
+            y[1::2] = maxs[first:last]
+        self.item.setData(x, y)
+
+
 class SumpixelsGraph(pg.GraphicsWindow):
     """The graph window class"""
     def __init__(self, *args, **kwargs):
@@ -815,3 +843,69 @@ class ProjectionGraph(pg.GraphicsWindow):
         """
         self.data = values
         self.sumCurve.setData(np.arange(len(self.data)), self.data)
+
+
+class MetricsWidget(QtGui.QFrame):
+    """ Live table of the statistics collected by control.metrics. Timers
+    are shown in ms."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.enableBox = QtGui.QCheckBox('Collect metrics')
+        self.enableBox.setChecked(metrics.enabled())
+        self.enableBox.stateChanged.connect(self.toggle)
+        self.resetButton = QtGui.QPushButton('Reset')
+        self.resetButton.clicked.connect(metrics.reset)
+        self.exportButton = QtGui.QPushButton('Export...')
+        self.exportButton.clicked.connect(self.export)
+
+        self.columns = ['Metric', 'n', 'mean', 'p50', 'p95', 'max']
+        self.table = QtGui.QTableWidget(0, len(self.columns))
+        self.table.setHorizontalHeaderLabels(self.columns)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)
+
+        grid = QtGui.QGridLayout()
+        self.setLayout(grid)
+        grid.addWidget(self.enableBox, 0, 0)
+        grid.addWidget(self.resetButton, 0, 1)
+        grid.addWidget(self.exportButton, 0, 2)
+        grid.addWidget(self.table, 1, 0, 1, 3)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.updateTable)
+        self.timer.start(1000)
+
+    def toggle(self):
+        metrics.enable(self.enableBox.isChecked())
+
+    def export(self):
+        root = Tk()
+        root.withdraw()
+        filename = filedialog.asksaveasfilename(
+            title='Export metrics', defaultextension='.csv',
+            filetypes=[('CSV', '.csv'), ('JSON', '.json')])
+        root.destroy()
+        if filename:
+            metrics.export(filename)
+
+    def updateTable(self):
+        if not metrics.enabled():
+            return
+
+        stats = metrics.snapshot()
+        self.table.setRowCount(len(stats))
+        for row, name in enumerate(sorted(stats)):
+            value = stats[name]
+            if isinstance(value, dict):
+                items = [name, str(value['n'])] + [
+                    '{:.2f}'.format(value[k]) for k in self.columns[2:]]
+            else:
+                items = [name, str(value), '', '', '', '']
+            for col, text in enumerate(items):
+                self.table.setItem(row, col, QtGui.QTableWidgetItem(text))
+
+    def closeEvent(self, *args, **kwargs):
+        self.timer.stop()
+        super().closeEvent(*args, **kwargs)
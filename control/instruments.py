@@ -5,8 +5,12 @@ Created on Sun Dec 28 13:25:27 2014
 @author: federico
 """
 
+import time
 import importlib
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+
 import control.mockers as mockers
+import control.metrics as metrics
 import numpy as np
 import nidaqmx
 
@@ -44,13 +48,50 @@ class LinkedLaserCheck(object):
 
 
 class LinkedLaser(object):
+    """ Several lasers driven as one. With concurrent, every command is sent
+    to all the lasers at the same time from a thread pool, so it takes a
+    single serial round trip instead of one per laser."""
 
-    def __init__(self, lasers):
+    def __init__(self, lasers, concurrent=True):
         self.lasers = lasers
+        self.concurrent = concurrent
+        self.pool = ThreadPoolExecutor(len(lasers))
+
+    def fanOut(self, function):
+        """ function(laser) for every laser. Returns the list of results
+        when all the lasers have answered, or raises the first error after
+        all of them are done."""
+        t0 = time.perf_counter()
+        if self.concurrent:
+            futures = [self.pool.submit(function, laser)
+                       for laser in self.lasers]
+            wait(futures)
+        else:
+            futures = []
+            for laser in self.lasers:
+                future = Future()
+                try:
+                    future.set_result(function(laser))
+                except Exception as e:
+                    future.set_exception(e)
+                futures.append(future)
+        metrics.observe('laser.linked', 1000*(time.perf_counter() - t0))
+
+        for future in futures:
+            if future.exception() is not None:
+                metrics.count('laser.linked.errors')
+                raise future.exception()
+        return [future.result() for future in futures]
+
+    def get(self, name):
+        return self.fanOut(lambda laser: getattr(laser, name))
+
+    def set(self, name, value):
+        self.fanOut(lambda laser: setattr(laser, name, value))
 
     @property
     def idn(self):
-        return 'Linked Lasers' + self.lasers[0].idn + self.lasers[1].idn
+        return 'Linked Lasers' + ''.join(self.get('idn'))
 
     @property
     def autostart(self):
@@ -58,7 +99,7 @@ class LinkedLaser(object):
 
     @autostart.setter
     def autostart(self, value):
-        self.lasers[0].autostart = self.lasers[1].autostart = value
+        self.set('autostart', value)
 
     @property
     def enabled(self):
@@ -66,54 +107,62 @@ class LinkedLaser(object):
 
     @enabled.setter
     def enabled(self, value):
-        self.lasers[0].enabled = self.lasers[1].enabled = value
+        self.set('enabled', value)
+
+    def total(self, name):
+        """ Sum of a quantity of all the lasers."""
+        values = self.get(name)
+        total = values[0]
+        for value in values[1:]:
+            total = total + value
+        return total
 
     @property
     def power(self):
-        return self.lasers[0].power + self.lasers[1].power
+        return self.total('power')
 
     @property
     def power_sp(self):
-        return self.lasers[0].power_sp + self.lasers[1].power_sp
+        return self.total('power_sp')
 
     @power_sp.setter
     def power_sp(self, value):
-        self.lasers[0].power_sp = self.lasers[1].power_sp = 0.5*value
+        self.set('power_sp', value / len(self.lasers))
 
     @property
     def digital_mod(self):
-        return self.lasers[0].digital_mode
+        return self.lasers[0].digital_mod
 
     @digital_mod.setter
     def digital_mod(self, value):
-        self.lasers[0].digital_mod = self.lasers[1].digital_mod = value
+        self.set('digital_mod', value)
 
     @property
     def mod_mode(self):
-        return [self.lasers[0].mod_mode, self.lasers[1].mod_mode]
+        return self.get('mod_mode')
 
     def enter_mod_mode(self):
-        [self.lasers[i].enter_mod_mode() for i in [0, 1]]
+        self.fanOut(lambda laser: laser.enter_mod_mode())
 
     def changeEdit(self):
-        [self.lasers[i].changeEdit() for i in [0, 1]]
+        self.fanOut(lambda laser: laser.changeEdit())
 
     def query(self, value):
-        [self.lasers[i].query(value) for i in [0, 1]]
+        self.fanOut(lambda laser: laser.query(value))
 
     @property
     def power_mod(self):
         """Laser modulated power (mW).
         """
-        return self.lasers[0].power_mod + self.lasers[1].power_mod
+        return self.total('power_mod')
 
     @power_mod.setter
     def power_mod(self, value):
-        self.lasers[0].power_mod = self.lasers[1].power_mod = 0.5*value
+        self.set('power_mod', value / len(self.lasers))
 
     def finalize(self):
-        self.lasers[0].finalize()
-        self.lasers[1].finalize()
+        self.fanOut(lambda laser: laser.finalize())
+        self.pool.shutdown()
 
 
 class LaserTTL(object):
@@ -201,7 +250,8 @@ class Cameras(object):
             import lantz.drivers.hamamatsu.hamamatsu_camera as hm
             for i in np.arange(hm.n_cameras):
                 print('Trying to import camera', i)
-                cameras.append(hm.HamamatsuCameraMR(i))
+                cameras.append(hm.HamamatsuCameraMR(
+                    i, cache_dir='camera_cache'))
                 print('Initialized Hamamatsu Camera Object, model: ', cameras[i].camera_model)
             return cameras
 
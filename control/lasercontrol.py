@@ -5,27 +5,113 @@ Created on Tue Aug 12 11:51:21 2014
 @author: Federico Barabas
 """
 
+import time
+import threading
+import collections
+
 import numpy as np
 from pyqtgraph.Qt import QtCore, QtGui
 from lantz import Q_
 
+import control.metrics as metrics
 
-class UpdatePowers(QtCore.QObject):
 
-    def __init__(self, laserwidget, *args, **kwargs):
-        super(QtCore.QObject, self).__init__(*args, **kwargs)
-        self.widget = laserwidget
+class LaserIO(QtCore.QObject):
+    """ Serial communication with a laser from its own thread, so that the
+    GUI never waits for the device.
 
-    def update(self):
-#        bluepower = '{:~}'.format(self.widget.bluelaser.power)
-#        lilapower = '{:~}'.format(self.widget.lilalaser.power)
-#        uvpower = '{:~}'.format(self.widget.uvlaser.power)
-#        self.widget.blueControl.powerIndicator.setText(bluepower)
-#        self.widget.lilaControl.powerIndicator.setText(lilapower)
-#        self.widget.uvControl.powerIndicator.setText(uvpower)
-#        time.sleep(1)
-#        QtCore.QTimer.singleShot(0.01, self.update)
-        pass
+    Commands are executed in order. Consecutive set-points of the same
+    property are coalesced to the last value: dragging a slider sends only
+    the value the slider has when the laser is ready for a new command. The
+    emission power is polled every pollInterval seconds while no commands
+    are pending and sent with powerSignal. Other properties are read with
+    get() and sent with valueSignal."""
+
+    powerSignal = QtCore.pyqtSignal(object)
+    valueSignal = QtCore.pyqtSignal(str, object)
+    errorSignal = QtCore.pyqtSignal(str)
+
+    def __init__(self, laser, pollInterval=1., *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.laser = laser
+        self.pollInterval = pollInterval
+        self.power = None
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, daemon=True,
+                                           name='laserIO')
+            self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(5)
+            self.thread = None
+
+    def set(self, name, value):
+        """ Queues laser.name = value."""
+        with self.condition:
+            if self.queue and self.queue[-1][0] == name:
+                self.queue[-1] = (name, value)
+                metrics.count('laser.coalesced')
+            else:
+                self.queue.append((name, value))
+            self.condition.notify()
+
+    def call(self, function, *args):
+        """ Queues function(*args), for sequences of commands that have to
+        run without other commands in between."""
+        with self.condition:
+            self.queue.append((function, args))
+            self.condition.notify()
+
+    def get(self, name):
+        """ Queues a read of laser.name, sent with valueSignal."""
+        self.call(self.read, name)
+
+    def read(self, name):
+        self.valueSignal.emit(name, getattr(self.laser, name))
+
+    def run(self):
+        lastPoll = 0
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    timeout = lastPoll + self.pollInterval - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                if not self.running:
+                    return
+                command = self.queue.popleft() if self.queue else None
+
+            if command is None:
+                self.execute(self.poll)
+                lastPoll = time.monotonic()
+            elif callable(command[0]):
+                self.execute(command[0], *command[1])
+            else:
+                self.execute(setattr, self.laser, *command)
+
+    def execute(self, function, *args):
+        t0 = time.perf_counter()
+        try:
+            function(*args)
+        except Exception as e:
+            self.errorSignal.emit(str(e))
+        metrics.observe('laser.command', 1000*(time.perf_counter() - t0))
+
+    def poll(self):
+        self.power = self.laser.power
+        self.powerSignal.emit(self.power)
 
 
 class LaserWidget(QtGui.QFrame):
@@ -66,15 +152,9 @@ class LaserWidget(QtGui.QFrame):
         grid.addWidget(self.excControl, 0, 2, 4, 1)
         grid.addWidget(self.DigCtrl, 4, 0, 2, 3)
 
-        # Current power update routine
-        self.updatePowers = UpdatePowers(self)
-        self.updateThread = QtCore.QThread()
-        self.updatePowers.moveToThread(self.updateThread)
-        self.updateThread.start()
-        self.updateThread.started.connect(self.updatePowers.update)
-
     def closeEvent(self, *args, **kwargs):
-        self.updateThread.terminate()
+        self.actControl.io.stop()
+        self.offControl.io.stop()
         super().closeEvent(*args, **kwargs)
 
 
@@ -93,12 +173,16 @@ class DigitalControl(QtGui.QFrame):
 
         self.controls = controls
         self.setFrameStyle(QtGui.QFrame.Panel | QtGui.QFrame.Raised)
-        actPower = str(self.controls[0].laser.power_mod.magnitude)
-        self.ActPower = QtGui.QLineEdit(actPower)
+        self.ActPower = QtGui.QLineEdit()
         self.ActPower.textChanged.connect(self.updateDigitalPowers)
-        offPower = str(self.controls[1].laser.power_mod.magnitude)
-        self.OffPower = QtGui.QLineEdit(offPower)
+        self.OffPower = QtGui.QLineEdit()
         self.OffPower.textChanged.connect(self.updateDigitalPowers)
+        # The modulation powers are read by the io threads of the lasers
+        self.powerEdits = {self.controls[0].io: self.ActPower,
+                           self.controls[1].io: self.OffPower}
+        for io in self.powerEdits:
+            io.valueSignal.connect(self.showModPower)
+            io.get('power_mod')
         self.ExcPower = QtGui.QLineEdit()
         self.ExcPower.textChanged.connect(self.updateDigitalPowers)
         # Our 473nm laser has a fixed emission power
@@ -145,6 +229,14 @@ class DigitalControl(QtGui.QFrame):
         grid.addWidget(excModFrame, 1, 2)
         grid.addWidget(self.DigitalControlButton, 2, 0, 1, 3)
 
+    def showModPower(self, name, value):
+        edit = self.powerEdits[self.sender()]
+        if name == 'power_mod' and edit.text() == '':
+            # Not an edit of the user, nothing to send to the lasers
+            edit.blockSignals(True)
+            edit.setText(str(value.magnitude))
+            edit.blockSignals(False)
+
     def GlobalDigitalMod(self):
         self.digitalPowers = [float(self.ActPower.text()),
                               float(self.OffPower.text())]
@@ -169,7 +261,7 @@ class DigitalControl(QtGui.QFrame):
         if self.DigitalControlButton.isChecked():
             for i in np.arange(len(self.digitalPowers)):
                 powMag = float(self.digitalPowers[i])
-                self.controls[i].laser.power_mod = powMag * self.mW
+                self.controls[i].io.set('power_mod', powMag * self.mW)
 
 
 class LaserControl(QtGui.QFrame):
@@ -263,35 +355,54 @@ class LaserControl(QtGui.QFrame):
         self.slider.valueChanged[int].connect(self.changeSlider)
         self.setPointEdit.returnPressed.connect(self.changeEdit)
 
+        # All the communication with the laser from now on goes through io
+        self.io = LaserIO(self.laser)
+        self.io.powerSignal.connect(self.updatePower)
+        self.io.errorSignal.connect(self.showError)
+        self.io.start()
+
+    def updatePower(self, power):
+        self.powerIndicator.setText(str(power.magnitude))
+
+    def showError(self, message):
+        print('Laser error:', message)
+
     def toggleLaser(self):
-        if self.enableButton.isChecked():
-            self.laser.enabled = True
-        else:
-            self.laser.enabled = False
+        self.io.set('enabled', self.enableButton.isChecked())
 
     def digitalMod(self, tof, power=0):
         if tof:
-            self.laser.enter_mod_mode()
-            self.laser.power_mod = power * self.mW
-            print('Entered digital modulation mode with power :', power)
-            print('Modulation mode is: ', self.laser.mod_mode)
+            self.io.call(self.enterModMode, power)
         else:
-            self.laser.digital_mod = False
-            self.changeEdit()
-            self.laser.query('cp')
-            print('Exited digital modulation mode')
+            self.io.call(self.exitModMode,
+                         float(self.setPointEdit.text()) * self.mW)
+
+    def enterModMode(self, power):
+        """ Runs in the io thread."""
+        self.laser.enter_mod_mode()
+        self.laser.power_mod = power * self.mW
+        print('Entered digital modulation mode with power :', power)
+        print('Modulation mode is: ', self.laser.mod_mode)
+
+    def exitModMode(self, power_sp):
+        """ Runs in the io thread."""
+        self.laser.digital_mod = False
+        self.laser.power_sp = power_sp
+        self.laser.query('cp')
+        print('Exited digital modulation mode')
 
     def enableLaser(self):
-        self.laser.enabled = True
-        self.laser.power_sp = float(self.setPointEdit.text()) * self.mW
+        self.io.set('enabled', True)
+        self.io.set('power_sp', float(self.setPointEdit.text()) * self.mW)
 
     def changeSlider(self, value):
-        self.laser.power_sp = self.slider.value() * self.mW
-        self.setPointEdit.setText(str(self.laser.power_sp.magnitude))
+        self.io.set('power_sp', value * self.mW)
+        self.setPointEdit.setText(str(value))
 
     def changeEdit(self):
-        self.laser.power_sp = float(self.setPointEdit.text()) * self.mW
-        self.slider.setValue(self.laser.power_sp.magnitude)
+        value = float(self.setPointEdit.text())
+        self.io.set('power_sp', value * self.mW)
+        self.slider.setValue(value)
 
 
 class LaserControlTTL(QtGui.QFrame):
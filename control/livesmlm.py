@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 17:31:18 2026
+
+@author: Tempesta_team
+
+Live localization preview. LVWorker offers the acquired frames to a
+LiveLocalizer, which sends every Nth frame to a process pool running
+analysis.live.localize_frame and accumulates the localizations in a
+super-resolution histogram and a molecules per frame trace shown by
+LiveSMLMWidget.
+
+The acquisition is never slowed down: offer() only copies the frame and
+queues it, and when all the workers are busy the frame is skipped. The
+workers convert the frames to float and the background is updated in the
+result thread of the pool.
+"""
+
+import threading
+import functools
+import multiprocessing as mp
+
+import numpy as np
+import pyqtgraph as pg
+from pyqtgraph.Qt import QtCore, QtGui
+
+import analysis.live as live
+import control.metrics as metrics
+
+
+class LiveLocalizer():
+    """ Frame tap feeding the localization pool.
+
+    settings is (lambda_em [nm], NA, nm_per_px, fit model). The background
+    of each frame is estimated as a running mean of the analysed frames.
+    Every update makes a new array, so the frames are sent with the current
+    one without copying it."""
+
+    def __init__(self, settings, every=1, processes=None, zoom=8,
+                 bkgWeight=0.05):
+        self.settings = settings
+        self.every = every
+        if processes is None:
+            processes = max(1, mp.cpu_count() // 2)
+        self.processes = processes
+        self.maxInFlight = 2 * processes
+        self.zoom = zoom
+        self.bkgWeight = bkgWeight
+
+        self.pool = None
+        self.lock = threading.Lock()
+        self.inFlight = 0
+        self.nOffered = 0
+        self.nSkipped = 0
+        self.nFailed = 0
+        self.bkg = None
+        self.histogram = None
+
+    @property
+    def running(self):
+        return self.pool is not None
+
+    def start(self):
+        if self.pool is None:
+            self.pool = mp.Pool(processes=self.processes)
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        self.inFlight = 0
+
+    def reset(self):
+        with self.lock:
+            self.bkg = None
+            self.histogram = None
+            self.nOffered = self.nSkipped = self.nFailed = 0
+
+    def offer(self, frame, number):
+        """ Called from the acquisition thread with every new frame (image
+        coordinates)."""
+        if self.pool is None:
+            return
+        self.nOffered += 1
+        if self.nOffered % self.every:
+            return
+        if self.inFlight >= self.maxInFlight:
+            self.nSkipped += 1
+            metrics.count('smlm.skipped')
+            return
+
+        # The camera buffers are recycled, the frame has to be copied
+        frame = frame.copy()
+        with self.lock:
+            if (self.histogram is None or
+                    self.histogram.shape != frame.shape):
+                self.bkg = None
+                self.histogram = live.LiveHistogram(frame.shape, self.zoom)
+            bkg = self.bkg
+            self.inFlight += 1
+        # Without a background yet, the frame is its own
+        self.pool.apply_async(
+            live.localize_frame, ((frame, bkg, number, self.settings),),
+            callback=functools.partial(self.collect, frame),
+            error_callback=self.failed)
+
+    def collect(self, frame, result):
+        """ Runs in the result thread of the pool."""
+        number, results = result
+        with self.lock:
+            bkg = self.bkg
+        if bkg is None or bkg.shape != frame.shape:
+            bkg = frame.astype(np.float64)
+        else:
+            bkg = bkg + self.bkgWeight * (frame - bkg)
+        with self.lock:
+            if (self.histogram is not None and
+                    self.histogram.shape == frame.shape):
+                self.bkg = bkg
+            self.inFlight -= 1
+            if results is None:
+                self.nFailed += 1
+            elif self.histogram is not None:
+                self.histogram.add(number, results)
+        metrics.count('smlm.frames')
+
+    def failed(self, error):
+        with self.lock:
+            self.inFlight -= 1
+            self.nFailed += 1
+
+
+class LiveSMLMWidget(QtGui.QFrame):
+    """ Controls of the live localization and display of the histogram and
+    of the number of molecules per frame."""
+
+    def __init__(self, main, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.main = main
+        self.localizer = LiveLocalizer((670, 1.42, 1000*main.umxpx, '2d'))
+
+        self.enableBox = QtGui.QCheckBox('Localize live')
+        self.enableBox.stateChanged.connect(self.toggle)
+        self.everyEdit = QtGui.QLineEdit('1')
+        self.everyEdit.setToolTip('Analyse one of every N frames')
+        self.everyEdit.textChanged.connect(self.changeEvery)
+        self.resetButton = QtGui.QPushButton('Reset')
+        self.resetButton.clicked.connect(self.localizer.reset)
+        self.statusLabel = QtGui.QLabel('')
+
+        imageWidget = pg.GraphicsLayoutWidget()
+        self.vb = imageWidget.addViewBox(row=0, col=0)
+        self.vb.setAspectLocked(True)
+        self.img = pg.ImageItem()
+        self.vb.addItem(self.img)
+        self.countsPlot = pg.PlotWidget()
+        self.countsPlot.setLabels(bottom=('Frame'), left=('Molecules'))
+        self.countsCurve = self.countsPlot.plot(pen='y')
+
+        grid = QtGui.QGridLayout()
+        self.setLayout(grid)
+        grid.addWidget(self.enableBox, 0, 0)
+        grid.addWidget(QtGui.QLabel('Every N frames'), 0, 1)
+        grid.addWidget(self.everyEdit, 0, 2)
+        grid.addWidget(self.resetButton, 0, 3)
+        grid.addWidget(imageWidget, 1, 0, 1, 4)
+        grid.addWidget(self.countsPlot, 2, 0, 1, 4)
+        grid.addWidget(self.statusLabel, 3, 0, 1, 4)
+        grid.setRowMinimumHeight(1, 200)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.updateView)
+
+    def toggle(self):
+        if self.enableBox.isChecked():
+            self.localizer.reset()
+            self.localizer.start()
+            self.timer.start(500)
+        else:
+            self.localizer.stop()
+            self.timer.stop()
+
+    def changeEvery(self):
+        try:
+            self.localizer.every = max(1, int(self.everyEdit.text()))
+        except ValueError:
+            pass
+
+    def updateView(self):
+        loc = self.localizer
+        with loc.lock:
+            if loc.histogram is None:
+                return
+            image = loc.histogram.image.copy()
+            numbers = loc.histogram.numbers.copy()
+            counts = loc.histogram.counts.copy()
+            nMolecules = loc.histogram.nMolecules
+
+        self.img.setImage(image, autoLevels=True)
+        order = np.argsort(numbers)
+        self.countsCurve.setData(numbers[order], counts[order])
+        mean = counts.mean() if len(counts) else 0
+        self.statusLabel.setText(
+            '{} molecules, {:.1f} per frame, {} frames skipped, '
+            '{} failed'.format(nMolecules, mean, loc.nSkipped, loc.nFailed))
+
+    def closeEvent(self, *args, **kwargs):
+        self.timer.stop()
+        self.localizer.stop()
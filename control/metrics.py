@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 10:05:12 2026
+
+@author: Tempesta_team
+
+Lightweight metrics for the acquisition, recording, focus lock and scanning
+hot paths: counters, histograms of observed values and per-stage timers.
+Everything is stored in a module-level registry so any module can record
+without passing objects around:
+
+    from control import metrics
+
+    with metrics.timer('camera.getFrames'):
+        ...
+    metrics.count('camera.frames', len(frames))
+    metrics.observe('camera.backlog', backlog)
+
+Metrics are disabled by default. While disabled every call returns right
+after checking a flag (timer returns a shared do-nothing context manager), so
+the instrumentation can stay in the hot paths. This module doesn't depend on
+Qt so it can also be used from the camera driver and the analysis scripts.
+"""
+
+import csv
+import json
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class _NullTimer():
+    """ Context manager returned by timer() when metrics are disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _Timer():
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.registry.observe(self.name, 1000*(time.perf_counter() - self.t0))
+        return False
+
+
+class Registry():
+    """ Storage of all counters and histograms.
+
+    Every observed value is kept, with its timestamp, in a bounded deque of
+    the last maxlen samples per metric. The samples are used both for the live
+    statistics (snapshot) and for the time series export. Timer values are
+    stored in ms."""
+
+    def __init__(self, maxlen=10000):
+        self.enabled = False
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter()
+        self.counters = {}
+        self.samples = {}
+
+    def enable(self, value=True):
+        self.enabled = value
+
+    def reset(self):
+        with self.lock:
+            self.t0 = time.perf_counter()
+            self.counters = {}
+            self.samples = {}
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        t = time.perf_counter() - self.t0
+        with self.lock:
+            try:
+                self.samples[name].append((t, value))
+            except KeyError:
+                self.samples[name] = deque([(t, value)], self.maxlen)
+
+    def timer(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def snapshot(self):
+        """ Returns a dict with the statistics of every metric. Counters map to
+        their value and histograms to a dict with n, mean, p50, p95 and max of
+        the stored samples."""
+        with self.lock:
+            counters = dict(self.counters)
+            samples = {k: np.array([s[1] for s in v], dtype=float)
+                       for k, v in self.samples.items()}
+
+        stats = {}
+        for name, value in counters.items():
+            stats[name] = value
+        for name, values in samples.items():
+            p50, p95 = np.percentile(values, [50, 95])
+            stats[name] = {'n': len(values), 'mean': values.mean(),
+                           'p50': p50, 'p95': p95, 'max': values.max()}
+
+        return stats
+
+    def series(self):
+        """ All stored samples as a list of (time [s], name, value) tuples
+        sorted by time."""
+        with self.lock:
+            rows = [(t, name, value) for name, v in self.samples.items()
+                    for t, value in v]
+        rows.sort()
+        return rows
+
+    def export_csv(self, filename):
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['time', 'metric', 'value'])
+            writer.writerows(self.series())
+            for name, value in sorted(self.counters.items()):
+                writer.writerow(['', name, value])
+
+    def export_json(self, filename):
+        series = {}
+        for t, name, value in self.series():
+            series.setdefault(name, []).append((t, value))
+        with open(filename, 'w') as f:
+            json.dump({'counters': self.counters, 'series': series,
+                       'stats': self.snapshot()}, f, indent=1, default=float)
+
+    def export(self, filename):
+        """ Exports to json or csv depending on the file extension."""
+        if filename.endswith('.json'):
+            self.export_json(filename)
+        else:
+            self.export_csv(filename)
+
+
+_NULL_TIMER = _NullTimer()
+
+registry = Registry()
+
+# Shortcuts to the registry methods
+enable = registry.enable
+reset = registry.reset
+count = registry.count
+observe = registry.observe
+timer = registry.timer
+snapshot = registry.snapshot
+export = registry.export
+
+
+def enabled():
+    return registry.enabled
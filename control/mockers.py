@@ -164,10 +164,14 @@ class MockHamamatsu(Driver):
         self.frame_y = 500
         self.frame_bytes = self.frame_x * self.frame_y * 2
         self.last_frame_number = 0
+        self.frame_numbers = []
+        self.frame_buffers = []
+        self.backlog = 0
         self.properties = {}
         self.max_backlog = 0
         self.number_image_buffers = 0
         self.hcam_data = []
+        self.buffer_budget = 2 * 1024 * 1024 * 1024
 
         self.s = Q_(1, 's')
 
@@ -201,6 +205,7 @@ class MockHamamatsu(Driver):
         properly.'''
         self.buffer_index = -1
         self.last_frame_number = 0
+        self.frame_numbers = []
 
         # Set sub array mode.
         self.setSubArrayMode()
@@ -230,6 +235,12 @@ class MockHamamatsu(Driver):
             hc_data = HMockCamData(self.frame_x * self.frame_y)
             frames.append(hc_data)
 
+        self.frame_numbers = [self.last_frame_number + i + 1
+                              for i in range(len(frames))]
+        self.last_frame_number += len(frames)
+        self.frame_buffers = list(range(len(frames)))
+        self.backlog = len(frames)
+
         return [frames, [self.frame_x, self.frame_y]]
 
     def getModelInfo(self):
@@ -359,6 +370,17 @@ class MockHamamatsu(Driver):
 #                return False
         return property_value
 
+    # setPropertyValues
+    #
+    # Set several properties in the given order, one at a time.
+    #
+    # @param values A list of (property name, value) pairs or a dictionary.
+    #
+    def setPropertyValues(self, values):
+        if isinstance(values, dict):
+            values = values.items()
+        return [self.setPropertyValue(name, value) for name, value in values]
+
     # setSubArrayMode
     #
     # This sets the sub-array mode as appropriate based on the current ROI.
@@ -377,13 +399,20 @@ class MockHamamatsu(Driver):
         else:
             self.setPropertyValue("subarray_mode", "ON")
 
+    # setBufferBudget
+    #
+    # @param buffer_budget Memory for the camera buffers in bytes.
+    #
+    def setBufferBudget(self, buffer_budget):
+        self.buffer_budget = int(buffer_budget)
+
     # startAcquisition
     #
     # Start data acquisition.
     #
     def startAcquisition(self):
         self.captureSetup()
-        n_buffers = int((2.0 * 1024 * 1024 * 1024) / self.frame_bytes)
+        n_buffers = int(self.buffer_budget / self.frame_bytes)
         self.number_image_buffers = n_buffers
 
         self.hcam_data = [HMockCamData(self.frame_x * self.frame_y)
@@ -449,3 +478,109 @@ class MockWebcam(Driver):
 
     def stop(self):
         pass
+
+
+class MockAOChannel():
+
+    def __init__(self, coeffs):
+        self.ao_dev_scaling_coeff = list(coeffs)
+
+
+class MockAOTask():
+    """Simulated analog output task of the NiDaq card, keeping the DAC codes
+    of its buffer. Voltages written with write are converted with the
+    calibration of each channel (ao_dev_scaling_coeff, polynomial from volts
+    to codes) and clipped at the rails as the card does, and codes written
+    with write_int16 are kept as they are. See checkScanProgram.
+    """
+
+    def __init__(self, coeffs=((-3.1, 3276.4, 2e-3, -1e-4),)*3):
+        self.ao_channels = [MockAOChannel(c) for c in coeffs]
+        self.codes = None
+
+    def write(self, data, auto_start=False):
+        volts = np.atleast_2d(data)
+        codes = np.empty(volts.shape, dtype=np.int16)
+        for i, chan in enumerate(self.ao_channels):
+            code = np.zeros(volts.shape[1])
+            for c in reversed(chan.ao_dev_scaling_coeff):
+                code = code*volts[i] + c
+            codes[i] = np.clip(np.rint(code), -32768, 32767)
+        self.codes = codes
+        return volts.shape[1]
+
+    def write_int16(self, data, timeout=10):
+        self.codes = np.array(data, dtype=np.int16, ndmin=2)
+        return self.codes.shape[1]
+
+
+# Calibrations unrelated to the default of MockAOTask. The gain of x and the
+# offset of y take part of the scans beyond the rails of the DACs, although
+# their voltages are within the range of the piezos.
+checkParValues = {'sizeX': 2, 'sizeY': 2, 'sizeZ': 2, 'seqTime': 0.001,
+                  'stepSizeXY': 0.1, 'stepSizeZ': 0.5}
+checkCoeffs = ((12.5, 30180.2, -41.3, 3.5),
+               (-32900.0, 3301.7, 2.7, -0.21),
+               (5.2, 3250.0, 0.9, 0.05))
+
+
+def checkScanProgram(scanMode, primScanDim='x', coeffs=checkCoeffs,
+                     parValues=checkParValues):
+    """Compiles the ScanProgram of a scan for a MockAOTask with the given
+    calibration and compares its DAC codes, written with write_int16, with
+    the codes the mock makes of the voltages of the same scan, written with
+    write. The voltages are the signals of the StageScan followed by a
+    linear return to 0 built here, so DACScaling is only used on one side.
+
+    Returns the largest difference between both and the number of codes at
+    the rails. Scans beyond the voltage range of the piezos raise ValueError
+    when compiled."""
+    import control.scanner as scanner
+
+    sampleRate = 10**5
+    stageScan = scanner.StageScan(sampleRate)
+    stageScan.setScanMode(scanMode)
+    stageScan.setPrimScanDim(primScanDim)
+    stageScan.update(parValues)
+    pxCycle = scanner.PixelCycle(sampleRate, ['CAM'], [0])
+    pxCycle.update(['CAM'], {'staCAM': 0, 'endCAM': 0.0005},
+                   stageScan.seqSamps)
+
+    channelOrder = ['x', 'y', 'z']
+    task = MockAOTask(coeffs)
+    program = scanner.ScanProgram(stageScan, pxCycle, channelOrder,
+                                  scanner.DACScaling.fromTask(task))
+    task.write_int16(program.aoSig)
+    compiled = task.codes
+
+    volts = []
+    for axis in channelOrder:
+        sig = np.asarray(stageScan.sigDict[axis], dtype=float)
+        ramp = sig[-1] + (0 - sig[-1])*np.arange(stageScan.seqSamps) / max(
+            stageScan.seqSamps - 1, 1)
+        volts.append(np.concatenate((sig, ramp)))
+    task.write(np.array(volts))
+    expected = task.codes.astype(int)
+
+    rails = int(np.count_nonzero((expected == 32767) |
+                                 (expected == -32768)))
+    return int(np.abs(expected - compiled).max()), rails
+
+
+if __name__ == '__main__':
+
+    for mode in ['FOV scan', 'VOL scan']:
+        for dim in ['x', 'y']:
+            diff, rails = checkScanProgram(mode, dim)
+            print('{}, {} first: max code difference {}, {} codes at the '
+                  'rails'.format(mode, dim, diff, rails))
+            assert rails > 0, 'the check does not reach the rails'
+            assert diff <= 1, 'compiled codes differ from the card'
+
+    # 50 µm of x take more than the 10 V of its piezo
+    try:
+        checkScanProgram('FOV scan', parValues=dict(checkParValues, sizeX=50))
+    except ValueError as e:
+        print('Out of range scan refused: {}'.format(e))
+    else:
+        raise AssertionError('out of range scan compiled')
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 13:20:31 2026
+
+@author: Tempesta_team
+
+Synchronized recording of two cameras. Every recorded frame comes with its
+DCAM frame counter and the host time at which it was retrieved (see
+LVWorker.fMeta). Frames are paired across cameras by their frame number
+relative to the first recorded frame of each camera, shifted by the number
+of frames that best lines up the host timestamps of the cameras (a camera
+may start recording a frame later than the other). The pair is accepted if
+the host timestamps agree within a tolerance, and both channels are written
+to a single HDF5 file with a shared time axis. Frames without partner are
+logged in the file instead of being silently dropped.
+"""
+
+import time
+import collections
+import numpy as np
+import h5py as hdf
+
+from pyqtgraph.Qt import QtCore
+
+import control.metrics as metrics
+
+
+class FramePairer():
+    """ Pairs the frames of several cameras. add() receives the new frames
+    of a camera and pairs() returns the complete sets.
+
+    The host timestamps are taken once per batch of frames retrieved by the
+    liveview, so a single pair can't tell whether the cameras are a frame
+    apart. Instead, the time of each frame is modelled per camera: the last
+    frame of a batch is retrieved less than a frame period after it was
+    taken, so the frame period comes from a fit of the timestamps of the
+    last window batch ends and the time of a frame from their lower
+    envelope. The relative frame numbers of each camera are shifted by the
+    number of periods (up to maxLag) between the times its model and the one
+    of camera 0 give to the latest frame of camera 0. No pair is made before
+    minBatches batches of each camera, and the shift is checked again every
+    window frames.
+
+    A frame becomes unpaired when every other camera has already delivered
+    frames maxLag numbers ahead of it without delivering its partner, or when
+    the timestamps of the set are more than tolerance s apart."""
+
+    def __init__(self, nCameras=2, tolerance=0.1, maxLag=10, window=50,
+                 minBatches=5):
+        self.nCameras = nCameras
+        self.tolerance = tolerance
+        self.maxLag = maxLag
+        self.window = window
+        self.minBatches = minBatches
+        self.firstNumber = [None] * nCameras
+        self.lastNumber = [-1] * nCameras
+        self.shift = [0] * nCameras
+        self.aligned = False
+        self.newFrames = 0
+        # (relative frame number, timestamp) of the last frame of the last
+        # window batches of each camera
+        self.ends = [collections.deque(maxlen=window)
+                     for i in range(nCameras)]
+        self.previous = [None] * nCameras
+        self.pending = [{} for i in range(nCameras)]
+        self.unpaired = []
+
+    def add(self, cam, frames, meta):
+        """ frames is a list of images and meta a list of the matching
+        LVWorker.fMeta records (frame number and timestamp first)."""
+        for frame, (number, timestamp, *rest) in zip(frames, meta):
+            if self.firstNumber[cam] is None:
+                self.firstNumber[cam] = number
+            rel = number - self.firstNumber[cam]
+            previous = self.previous[cam]
+            if previous is not None and previous[1] != timestamp:
+                self.ends[cam].append(previous)
+            self.previous[cam] = (rel, timestamp)
+            key = rel + self.shift[cam]
+            self.pending[cam][key] = (timestamp, frame)
+            self.lastNumber[cam] = max(self.lastNumber[cam], key)
+            if cam == 0:
+                self.newFrames += 1
+
+    def frameTime(self, cam, rel):
+        """ (time of the relative frame rel, frame period) of cam, None
+        without enough batches."""
+        ends = np.array(self.ends[cam]).reshape(-1, 2)
+        if len(ends) < self.minBatches:
+            return None
+        # The latencies average out in the slope, not in the intercept
+        period = np.polyfit(ends[:, 0], ends[:, 1], 1)[0]
+        return np.min(ends[:, 1] - period*(ends[:, 0] - rel)), period
+
+    def bestShift(self, cam):
+        """ Shift of the relative frame numbers of cam that lines up its
+        frame times with the ones of camera 0, None without enough
+        frames."""
+        if not self.ends[0]:
+            return None
+        # Compared at a recent frame, where an error in the period adds up
+        # over few frames
+        rel = self.ends[0][-1][0]
+        ref = self.frameTime(0, rel)
+        model = self.frameTime(cam, rel)
+        if ref is None or model is None:
+            return None
+        shift = int(np.round((model[0] - ref[0]) / ref[1]))
+        return int(np.clip(shift, -self.maxLag, self.maxLag))
+
+    def align(self):
+        """ Updates the shift of every camera. Returns False if some camera
+        doesn't have enough frames yet."""
+        shifts = [0] + [self.bestShift(cam)
+                        for cam in range(1, self.nCameras)]
+        if None in shifts:
+            return False
+        for cam, shift in enumerate(shifts):
+            change = shift - self.shift[cam]
+            if change == 0:
+                continue
+            if self.aligned:
+                metrics.count('multicam.reanchor')
+                print('Camera {} frames shifted by {}'.format(cam, change))
+            self.pending[cam] = {key + change: item
+                                 for key, item in self.pending[cam].items()}
+            self.lastNumber[cam] += change
+            self.shift[cam] = shift
+        self.aligned = True
+        return True
+
+    def pairs(self, final=False):
+        """ Returns a list of (relative frame number, timestamps, frames) of
+        the complete sets, sorted by frame number. With final, frames are
+        paired even if there were too few to check the shifts."""
+        if not self.aligned or self.newFrames >= self.window:
+            self.newFrames = 0
+            if not self.align() and not self.aligned:
+                if not final:
+                    return []
+                self.aligned = True
+
+        common = set(self.pending[0])
+        for p in self.pending[1:]:
+            common &= set(p)
+
+        complete = []
+        for rel in sorted(common):
+            items = [p.pop(rel) for p in self.pending]
+            timestamps = np.array([item[0] for item in items])
+            if np.ptp(timestamps) > self.tolerance:
+                for cam, item in enumerate(items):
+                    self.logUnpaired(cam, rel, item[0], 'timestamp')
+                continue
+            complete.append((rel, timestamps, [item[1] for item in items]))
+
+        # Frames whose partners should have arrived already
+        horizon = min(self.lastNumber) - self.maxLag
+        for cam, p in enumerate(self.pending):
+            for rel in [r for r in p if r < horizon]:
+                self.logUnpaired(cam, rel, p.pop(rel)[0], 'missing')
+
+        return complete
+
+    def flush(self):
+        """ Logs every frame still waiting for its partner."""
+        for cam, p in enumerate(self.pending):
+            for rel in sorted(p):
+                self.logUnpaired(cam, rel, p[rel][0], 'missing')
+            p.clear()
+
+    def logUnpaired(self, cam, rel, timestamp, reason):
+        metrics.count('multicam.unpaired')
+        self.unpaired.append((cam, rel, timestamp, reason))
+        print('Camera {} frame {} has no partner ({})'.format(cam, rel,
+                                                               reason))
+
+
+class DualCamRecWorker(QtCore.QObject):
+    """ Records both cameras into a single HDF5 file: datasets Channel0 and
+    Channel1 with the images, 'time' with the shared time axis (mean host
+    timestamp of each pair, relative to the first one), 'frame_number' with
+    the relative frame number of each pair and 'unpaired' with the frames
+    that couldn't be paired. Works for the frames, time and until stop
+    recording modes. It has the same interface as recording.RecWorker."""
+
+    updateSignal = QtCore.pyqtSignal()
+    doneSignal = QtCore.pyqtSignal()
+
+    def __init__(self, main, recMode, timeorframes, shapes, lvworkers,
+                 savename, attrs, tolerance=0.1, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.main = main
+        # 1=frames, 2=time, 5=until stop
+        self.recMode = recMode
+        self.timeorframes = timeorframes
+        self.shapes = shapes
+        self.lvworkers = lvworkers
+        self.savename = savename
+        self.attrs = attrs
+        self.pressed = True
+        self.done = False
+
+        self.pairer = FramePairer(len(lvworkers), tolerance)
+        self.nStored = 0  # number of pairs stored
+        self.nRead = [0] * len(lvworkers)
+        self.tRecorded = 0
+
+    def finished(self):
+        if not self.pressed:
+            return True
+        if self.recMode == 1:
+            return self.nStored >= self.timeorframes
+        elif self.recMode == 2:
+            return self.tRecorded >= self.timeorframes
+        return False
+
+    def readNew(self):
+        for cam, lvworker in enumerate(self.lvworkers):
+            # fMeta is appended after fRecorded
+            n = len(lvworker.fMeta)
+            frames = lvworker.fRecorded[self.nRead[cam]:n]
+            meta = lvworker.fMeta[self.nRead[cam]:n]
+            self.nRead[cam] = n
+            self.pairer.add(cam, frames, meta)
+
+    def write(self, storeFile, pairs):
+        if self.recMode == 1:
+            pairs = pairs[:max(self.timeorframes - self.nStored, 0)]
+        n = len(pairs)
+        if n == 0:
+            return
+
+        with metrics.timer('multicam.write'):
+            end = self.nStored + n
+            for cam in range(len(self.lvworkers)):
+                dataset = storeFile['Channel{}'.format(cam)]
+                dataset.resize(end, axis=0)
+                dataset[self.nStored:end] = [p[2][cam] for p in pairs]
+
+            timestamps = np.array([p[1] for p in pairs])
+            if self.t0 is None:
+                self.t0 = timestamps[0].mean()
+            storeFile['time'].resize((end,))
+            storeFile['time'][self.nStored:end] = (timestamps.mean(1) -
+                                                   self.t0)
+            storeFile['timestamps'].resize(end, axis=0)
+            storeFile['timestamps'][self.nStored:end] = timestamps
+            storeFile['frame_number'].resize((end,))
+            storeFile['frame_number'][self.nStored:end] = [p[0]
+                                                           for p in pairs]
+        self.nStored = end
+
+    def start(self):
+        for lvworker in self.lvworkers:
+            lvworker.startRecording()
+        time.sleep(0.1)
+
+        self.starttime = time.time()
+        self.t0 = None
+        nCams = len(self.lvworkers)
+        with hdf.File(self.savename + '.hdf5', 'w') as storeFile:
+            for cam, shape in enumerate(self.shapes):
+                storeFile.create_dataset(
+                    'Channel{}'.format(cam), (0, shape[0], shape[1]),
+                    maxshape=(None, shape[0], shape[1]), dtype=np.uint16)
+            storeFile.create_dataset('time', (0,), maxshape=(None,))
+            storeFile.create_dataset('timestamps', (0, nCams),
+                                     maxshape=(None, nCams))
+            storeFile.create_dataset('frame_number', (0,), maxshape=(None,),
+                                     dtype=int)
+
+            while not self.finished():
+                self.tRecorded = time.time() - self.starttime
+                time.sleep(0.01)
+                self.readNew()
+                self.write(storeFile, self.pairer.pairs())
+                self.updateSignal.emit()
+
+            for lvworker in self.lvworkers:
+                lvworker.stopRecording()
+            self.readNew()
+            self.write(storeFile, self.pairer.pairs(final=True))
+            # Frames after the last requested one are expected to be left
+            if not (self.recMode == 1 and self.nStored >= self.timeorframes):
+                self.pairer.flush()
+
+            unpaired = np.array(
+                [(c, n, t, r) for c, n, t, r in self.pairer.unpaired],
+                dtype=[('camera', int), ('frame_number', int),
+                       ('timestamp', float), ('reason', 'S9')])
+            storeFile.create_dataset('unpaired', data=unpaired)
+            storeFile['time'].attrs['units'] = 's'
+            for item in self.attrs:
+                if item[1] is not None:
+                    storeFile.attrs[item[0]] = item[1]
+
+        self.done = True
+        self.doneSignal.emit()
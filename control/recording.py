@@ -8,8 +8,8 @@ import os
 import sys
 import subprocess
 import time
+import json
 import numpy as np
-import re
 
 import h5py as hdf
 import tifffile as tiff
@@ -17,8 +17,14 @@ import tifffile as tiff
 from pyqtgraph.Qt import QtCore, QtGui
 import pyqtgraph.ptime as ptime
 from tkinter import Tk, filedialog, messagebox
+from concurrent.futures import ProcessPoolExecutor
 
 import control.guitools as guitools
+import control.metrics as metrics
+import control.chunkstore as chunkstore
+import control.multicam as multicam
+import control.scanner as scanner
+import analysis.store_image as store_image
 
 
 # Widget to control image or sequence recording. Recording only possible when
@@ -40,6 +46,8 @@ class RecordingWidget(QtGui.QFrame):
         self.recworkers = [None] * len(self.main.cameras)
         self.recthreads = [None] * len(self.main.cameras)
         self.savenames = [None] * len(self.main.cameras)
+        # Process converting the raw recordings, started when needed
+        self.packager = None
 
         self.z_stack = []
         self.recMode = 1
@@ -69,6 +77,13 @@ class RecordingWidget(QtGui.QFrame):
         self.formatBox = QtGui.QComboBox()
         self.formatBox.addItem('tiff')
         self.formatBox.addItem('hdf5')
+        # Directories of frame chunks, see control.chunkstore
+        self.formatBox.addItem('chunks')
+        self.formatBox.addItem('chunks zlib')
+        # Raw files, optionally converted after the recording (RawStore)
+        self.formatBox.addItem('raw')
+        self.formatBox.addItem('raw to hdf5')
+        self.formatBox.addItem('raw to tiff')
 
         # Snap and recording buttons
         self.snapTIFFButton = QtGui.QPushButton('Snap')
@@ -332,12 +347,12 @@ class RecordingWidget(QtGui.QFrame):
 
     # Attributes saving
     def getAttrs(self):
+        """ Parameters of the GUI and last snapshot of the instrument state
+        (laser powers, piezo position, camera timings), which is polled in
+        the background so that recordings never wait for the devices."""
         self.main.AbortROI()
         attrs = self.main.tree.attrs()
-
-        for laserControl in self.main.laserWidgets.controls:
-            name = re.sub('<[^<]+?>', '', laserControl.name.text())
-            attrs.append((name, laserControl.laser.power))
+        attrs.extend(self.main.snapshot.snapshot())
 
         for key in self.main.scanWidget.scanParValues:
             attrs.append((key, self.main.scanWidget.scanParValues[key]))
@@ -445,10 +460,15 @@ class RecordingWidget(QtGui.QFrame):
                     total = float(self.timeLapseTotalEdit.text())
                     each = float(self.timeLapseEdit.text())
                     self.timeLapseScan = int(np.ceil(total/each))
-                    self.timer = QtCore.QTimer()
-                    self.timer.timeout.connect(self.doRecording)
-                    self.timer.start(float(self.timeLapseEdit.text())*1000)
-                self.doRecording()
+                    self.scheduler = scanner.RepeatScheduler(
+                        each, self.timeLapseScan)
+                    self.scheduler.fire.connect(self.doRecording)
+                    scanWidget = self.main.scanWidget
+                    scanWidget.scanStarted.connect(self.scheduler.setupDone)
+                    scanWidget.scanEnded.connect(self.retryRecording)
+                    self.scheduler.start()
+                else:
+                    self.doRecording()
 
             else:
                 self.recButton.setChecked(False)
@@ -457,6 +477,8 @@ class RecordingWidget(QtGui.QFrame):
         else:
             if self.recMode in [3, 4]:
                 self.timeLapseScan = 0
+                if self.recMode == 4:
+                    self.stopScheduler()
                 self.recButton.setEnabled(False)
                 if not self.main.scanWidget.scanning:
                     self.endRecording()
@@ -464,8 +486,46 @@ class RecordingWidget(QtGui.QFrame):
                 ind = np.mod(self.main.currCamIdx + i, 2)
                 self.recworkers[ind].pressed = False
 
+    def dualRecording(self):
+        """ Both cameras are recorded synchronized into a single file when
+        Two-cam rec is checked, for the hdf5 format and the frames, time and
+        until stop modes."""
+        return (self.nCameras == 2 and self.DualCam.isChecked() and
+                self.formatBox.currentText() == 'hdf5' and
+                self.recMode in [1, 2, 5])
+
+    def recordingBusy(self):
+        """ Whether a worker of the last recording is still storing."""
+        return any(w is not None and not w.done for w in self.recworkers)
+
+    def retryRecording(self):
+        """ A time-lapse repetition fired while the previous scan was
+        running or being stored is started again once both ended."""
+        if not (self.main.scanWidget.scanning or self.recordingBusy()):
+            self.scheduler.retry()
+
     def doRecording(self):
-        if not self.main.scanWidget.scanning:
+        if self.recordingBusy():
+            # Would replace the workers still storing the last repetition,
+            # endRecording retries it once they are done
+            return
+        if not self.main.scanWidget.scanning and self.dualRecording():
+            self.makeSavenames()
+            savename = self.savenames[self.main.currCamIdx] + '_dualcam'
+            worker = multicam.DualCamRecWorker(
+                self, self.recMode, self.getTimeOrFrames(), self.main.shapes,
+                self.main.lvworkers, savename, self.getAttrs())
+            worker.updateSignal.connect(self.updateGUI)
+            worker.doneSignal.connect(self.endRecording)
+            thread = QtCore.QThread()
+            worker.moveToThread(thread)
+            thread.started.connect(worker.start)
+            # The same worker and thread stand for both cameras
+            self.recworkers = [worker] * self.nCameras
+            self.recthreads = [thread] * self.nCameras
+            thread.start()
+
+        elif not self.main.scanWidget.scanning:
             self.makeSavenames()
             for i in range(0, self.nCameras):
                 ind = np.mod(self.main.currCamIdx + i, 2)
@@ -519,8 +579,10 @@ class RecordingWidget(QtGui.QFrame):
                 self.currentFrame.setText('0 /')
             else:
                 self.timeLapseScan -= 1
-                if self.timeLapseScan <= 0:
-                    self.timer.stop()
+                if self.timeLapseScan > 0:
+                    self.retryRecording()
+                else:
+                    self.stopScheduler()
                     self.writable = True
                     self.readyToRecord = True
                     self.recButton.setEnabled(True)
@@ -532,6 +594,16 @@ class RecordingWidget(QtGui.QFrame):
                     self.currentTime.setText('0 /')
                     self.currentFrame.setText('0 /')
 
+    def stopScheduler(self):
+        self.scheduler.stop()
+        scanWidget = self.main.scanWidget
+        try:
+            scanWidget.scanStarted.disconnect(self.scheduler.setupDone)
+            scanWidget.scanEnded.disconnect(self.retryRecording)
+        except TypeError:
+            # Already disconnected when stopped with the Rec button
+            pass
+
     def makeSavenames(self):
         folder = self.folderEdit.text()
         if not os.path.exists(folder):
@@ -545,6 +617,156 @@ class RecordingWidget(QtGui.QFrame):
             # etc.
             self.savenames[ind] = guitools.getUniqueName(self.savenames[ind])
 
+    def packRaw(self, filenames, fmt):
+        """ Converts raw recordings to fmt ('hdf5' or 'tiff') in a
+        background process, one after the other. Called from the recording
+        workers."""
+        if self.packager is None:
+            self.packager = ProcessPoolExecutor(1)
+        for filename in filenames:
+            future = self.packager.submit(store_image.pack_raw, filename, fmt,
+                                          True)
+            future.add_done_callback(self.packed)
+
+    def packed(self, future):
+        try:
+            print('Packed', future.result())
+        except Exception as e:
+            print('Packing of raw recording failed:', e)
+
+    def closeEvent(self, *args, **kwargs):
+        # Pending conversions are finished before quitting
+        if self.packager is not None:
+            self.packager.shutdown(wait=True)
+
+
+# Per-frame metadata: DCAM frame counter, host time.perf_counter() timestamp
+# at retrieval, camera buffer index, camera backlog at read time and the
+# fiducial drift in px (NaN when not tracking, see control.drift).
+frameMetaDt = np.dtype([('frame_number', np.int64), ('timestamp', np.float64),
+                        ('buffer_index', np.int32), ('backlog', np.int32),
+                        ('drift_x', np.float64), ('drift_y', np.float64)])
+
+
+class HDF5Store():
+    """ Frames stored in the 'Images' dataset of an HDF5 group, with their
+    metadata in the parallel 'FrameMeta' dataset (see frameMetaDt)."""
+
+    def __init__(self, group, shape):
+        self.images = group.create_dataset(
+            'Images', (0, shape[0], shape[1]),
+            maxshape=(None, shape[0], shape[1]))
+        self.meta = group.create_dataset('FrameMeta', (0,), maxshape=(None,),
+                                         dtype=frameMetaDt)
+
+    def write(self, frames, meta):
+        if len(frames) == 0:
+            return
+        n = len(self.images)
+        self.images.resize(n + len(frames), axis=0)
+        self.images[n:] = frames
+        self.meta.resize((n + len(meta),))
+        self.meta[n:] = np.array(meta, dtype=frameMetaDt)
+
+
+class TiffStore():
+    """ Frames stored as the pages of a TIFF file. The metadata goes to a
+    sidecar csv file with the same name and the _meta suffix, written when
+    the store is closed."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = tiff.TiffWriter(filename, software='Tormenta')
+        self.meta = []
+
+    def write(self, frames, meta):
+        for frame in frames:
+            self.file.save(frame)
+        self.meta.extend(meta)
+
+    def close(self):
+        self.file.close()
+        metaName = guitools.insertSuffix(self.filename, '_meta', '.csv')
+        np.savetxt(metaName, np.array(self.meta, dtype=frameMetaDt),
+                   fmt=['%d', '%.6f', '%d', '%d', '%.4f', '%.4f'],
+                   delimiter=',',
+                   header=','.join(frameMetaDt.names), comments='')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RawStore():
+    """ Frames written sequentially to a raw file through a memory map,
+    C-ordered like the datasets of HDF5Store. The file is preallocated for
+    nFrames frames (or blocks of block frames when the length is unknown)
+    and cut to the recorded frames when the store is closed. Then a JSON
+    header with shape, dtype and attributes is written next to it, and the
+    metadata to a _meta.npy file. See analysis.store_image.pack_raw."""
+
+    def __init__(self, filename, shape, attrs=(), nFrames=None, block=1000):
+        self.filename = filename
+        self.frameShape = tuple(shape)
+        self.attrs = attrs
+        self.block = block
+        self.allocated = nFrames or block
+        self.nFrames = 0
+        self.dtype = None
+        self.map = None
+        self.meta = []
+        open(filename, 'wb').close()
+
+    def resize(self, nFrames):
+        """ Sets the file size, the file can't be mapped meanwhile."""
+        if self.map is not None:
+            self.map.flush()
+            self.map = None
+        frameBytes = self.dtype.itemsize * int(np.prod(self.frameShape))
+        with open(self.filename, 'r+b') as f:
+            f.truncate(nFrames * frameBytes)
+
+    def allocate(self, nFrames):
+        self.resize(nFrames)
+        self.allocated = nFrames
+        self.map = np.memmap(self.filename, self.dtype, 'r+',
+                             shape=(nFrames,) + self.frameShape)
+
+    def write(self, frames, meta):
+        if len(frames) == 0:
+            return
+        if self.map is None:
+            self.dtype = np.asarray(frames[0]).dtype
+            self.allocate(self.allocated)
+        if self.nFrames + len(frames) > self.allocated:
+            self.allocate(max(self.nFrames + len(frames),
+                              self.allocated + self.block))
+        for frame in frames:
+            self.map[self.nFrames] = frame
+            self.nFrames += 1
+        self.meta.extend(meta)
+
+    def close(self):
+        if self.dtype is None:
+            self.dtype = np.dtype(np.uint16)
+        self.resize(self.nFrames)
+        base = os.path.splitext(self.filename)[0]
+        np.save(base + '_meta.npy', np.array(self.meta, dtype=frameMetaDt))
+        header = {'shape': [self.nFrames] + list(self.frameShape),
+                  'dtype': self.dtype.str, 'order': 'C',
+                  'attrs': [list(item) for item in self.attrs],
+                  'meta_fmt': ['%d', '%.6f', '%d', '%d', '%.4f', '%.4f']}
+        with open(base + '.json', 'w') as f:
+            json.dump(header, f, indent=1, default=chunkstore.jsonValue)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 
 class RecWorker(QtCore.QObject):
 
@@ -574,6 +796,33 @@ class RecWorker(QtCore.QObject):
         self.nStored = 0  # number of frames stored
         self.tRecorded = 0
 
+    def recording(self, plane=0):
+        """ Whether the recording of the current z plane has to go on."""
+        if not self.pressed:
+            return False
+        if self.recMode == 1:
+            return self.nStored < self.timeorframes
+        elif self.recMode == 2:
+            return self.tRecorded < self.timeorframes
+        elif self.recMode in [3, 4]:
+            return self.nStored != self.framesExpected*(plane + 1)
+        return True
+
+    def storeNew(self, store, plane=0):
+        self.tRecorded = time.time() - self.starttime
+        time.sleep(0.01)
+        # fMeta is appended right after fRecorded, so it sets the limit
+        n = len(self.lvworker.fMeta)
+        if self.recMode in [3, 4]:
+            n = min(n, self.framesExpected*(plane + 1))
+        newFrames = self.lvworker.fRecorded[self.nStored:n]
+        newMeta = self.lvworker.fMeta[self.nStored:n]
+        metrics.observe('record.pending', len(newFrames))
+        with metrics.timer('record.write'):
+            store.write(newFrames, newMeta)
+        self.nStored += len(newFrames)
+        self.updateSignal.emit()
+
     def start(self):
         self.lvworker.startRecording()
         time.sleep(0.1)
@@ -581,65 +830,8 @@ class RecWorker(QtCore.QObject):
         self.starttime = time.time()
         saveMode = self.main.formatBox.currentText()
 
-        # Main loop for waiting until recording is finished and sending update
-        # signal
-        if self.recMode == 1:
-            if saveMode == 'tiff':
-                with tiff.TiffWriter(self.savename + '.tiff',
-                                     software='Tormenta') as storeFile:
-                    while self.nStored < self.timeorframes and self.pressed:
-                        self.tRecorded = time.time() - self.starttime
-                        time.sleep(0.01)
-                        newFrames = self.lvworker.fRecorded[self.nStored:]
-                        self.nStored += len(newFrames)
-                        for frame in newFrames:
-                            storeFile.save(frame)
-                        self.updateSignal.emit()
-
-            elif saveMode == 'hdf5':
-                with hdf.File(self.savename + '.hdf5', "w") as storeFile:
-                    storeFile.create_dataset(
-                        'Images', (1, self.shape[0], self.shape[1]),
-                        maxshape=(None, self.shape[0], self.shape[1]))
-                    dataset = storeFile['Images']
-                    while self.nStored < self.timeorframes and self.pressed:
-                        self.tRecorded = time.time() - self.starttime
-                        time.sleep(0.01)
-                        newFrames = self.lvworker.fRecorded[self.nStored:]
-                        dataset.resize((self.nStored+len(newFrames)), axis=0)
-                        dataset[self.nStored:] = newFrames
-                        self.nStored += len(newFrames)
-                        self.updateSignal.emit()
-
-        elif self.recMode == 2:
-            if saveMode == 'tiff':
-                with tiff.TiffWriter(self.savename + '.tiff',
-                                     software='Tormenta') as storeFile:
-                    while self.tRecorded < self.timeorframes and self.pressed:
-                        self.tRecorded = time.time() - self.starttime
-                        time.sleep(0.01)
-                        newFrames = self.lvworker.fRecorded[self.nStored:]
-                        self.nStored += len(newFrames)
-                        for frame in newFrames:
-                            storeFile.save(frame)
-                        self.updateSignal.emit()
-
-            elif saveMode == 'hdf5':
-                with hdf.File(self.savename + '.hdf5', "w") as storeFile:
-                    storeFile.create_dataset(
-                        'Images', (1, self.shape[0], self.shape[1]),
-                        maxshape=(None, self.shape[0], self.shape[1]))
-                    dataset = storeFile['Images']
-                    while self.tRecorded < self.timeorframes and self.pressed:
-                        self.tRecorded = time.time() - self.starttime
-                        time.sleep(0.01)
-                        newFrames = self.lvworker.fRecorded[self.nStored:]
-                        dataset.resize((self.nStored + len(newFrames)), axis=0)
-                        dataset[self.nStored:] = newFrames
-                        self.nStored += len(newFrames)
-                        self.updateSignal.emit()
-
-        elif self.recMode in [3, 4]:
+        nPlanes = 1
+        if self.recMode in [3, 4]:
             # Change setting for scanning
             self.main.main.trigsourceparam.setValue('External "frame-trigger"')
             laserWidget = self.main.main.laserWidgets
@@ -649,77 +841,65 @@ class RecWorker(QtCore.QObject):
             if self.scanWidget.scanMode.currentText() == 'VOL scan':
                 sizeZ = self.scanWidget.scanParValues['sizeZ']
                 stepSizeZ = self.scanWidget.scanParValues['stepSizeZ']
-                stepsZ = int(np.ceil(sizeZ / stepSizeZ))
-            else:
-                stepsZ = 1
-            framesExpected = int(self.scanWidget.stageScan.frames / stepsZ)
+                nPlanes = int(np.ceil(sizeZ / stepSizeZ))
+            self.framesExpected = int(self.scanWidget.stageScan.frames /
+                                      nPlanes)
 
             # start scanning
             self.scanWidget.scanButton.click()
-            if saveMode == 'tiff':
-                for i in range(stepsZ):
+
+        # Main loop for waiting until recording is finished and sending update
+        # signal. Scans are saved with one file (tiff), group (hdf5) or
+        # directory (chunks) per z plane.
+        if saveMode == 'tiff':
+            for i in range(nPlanes):
+                if self.recMode in [3, 4]:
                     name = self.savename + '_z' + str(i) + '.tiff'
-                    with tiff.TiffWriter(name, software='Tormenta') \
-                            as storeFile:
-                        while self.nStored != framesExpected*(i + 1) \
-                                and self.pressed:
-                            time.sleep(0.01)
-                            newFrames = self.lvworker.fRecorded[self.nStored:]
-                            if self.nStored + len(newFrames) \
-                                    > framesExpected*(i + 1):
-                                maxF = framesExpected*(i + 1) - self.nStored
-                                newFrames = newFrames[:maxF]
-                            self.nStored += len(newFrames)
-                            for frame in newFrames:
-                                storeFile.save(frame)
-                            self.updateSignal.emit()
-
-            elif saveMode == 'hdf5':
-                with hdf.File(self.savename + '.hdf5', "w") as storeFile:
-                    for i in range(stepsZ):
-                        zPlane = storeFile.create_group('z' + str(i))
-                        dataset = zPlane.create_dataset(
-                            'Images', (1, self.shape[0], self.shape[1]),
-                            maxshape=(None, self.shape[0], self.shape[1]))
-                        while self.nStored != framesExpected*(i+1)\
-                                and self.pressed:
-                            time.sleep(0.01)
-                            newFrames = self.lvworker.fRecorded[self.nStored:]
-                            if self.nStored + len(newFrames) \
-                                    > framesExpected*(i + 1):
-                                maxF = framesExpected*(i+1)-self.nStored
-                                newFrames = newFrames[:maxF]
-                            size = (self.nStored - framesExpected*i +
-                                    len(newFrames))
-                            dataset.resize(size, axis=0)
-                            dataset[self.nStored:] = newFrames
-                            self.nStored += len(newFrames)
-                            self.updateSignal.emit()
-        elif self.recMode == 5:
-            if saveMode == 'tiff':
-                with tiff.TiffWriter(self.savename + '.tiff',
-                                     software='Tormenta') as storeFile:
-                    while self.pressed:
-                        time.sleep(0.01)
-                        newFrames = self.lvworker.fRecorded[self.nStored:]
-                        self.nStored += len(newFrames)
-                        for frame in newFrames:
-                            storeFile.save(frame)
-                        self.updateSignal.emit()
-
-            elif saveMode == 'hdf5':
-                with hdf.File(self.savename + '.hdf5', "w") as storeFile:
-                    storeFile.create_dataset(
-                        'Images', (1, self.shape[0], self.shape[1]),
-                        maxshape=(None, self.shape[0], self.shape[1]))
-                    dataset = storeFile['Images']
-                    while self.pressed:
-                        time.sleep(0.01)
-                        newFrames = self.lvworker.fRecorded[self.nStored:]
-                        dataset.resize((self.nStored + len(newFrames)), axis=0)
-                        dataset[self.nStored:] = newFrames
-                        self.nStored += len(newFrames)
-                        self.updateSignal.emit()
+                else:
+                    name = self.savename + '.tiff'
+                with TiffStore(name) as store:
+                    while self.recording(i):
+                        self.storeNew(store, i)
+
+        elif saveMode == 'hdf5':
+            with hdf.File(self.savename + '.hdf5', "w") as storeFile:
+                for i in range(nPlanes):
+                    if self.recMode in [3, 4]:
+                        group = storeFile.create_group('z' + str(i))
+                    else:
+                        group = storeFile
+                    store = HDF5Store(group, self.shape)
+                    while self.recording(i):
+                        self.storeNew(store, i)
+
+        elif saveMode.startswith('chunks'):
+            compression = 'zlib' if saveMode.endswith('zlib') else None
+            for i in range(nPlanes):
+                if self.recMode in [3, 4]:
+                    name = self.savename + '_z' + str(i) + '.chunks'
+                else:
+                    name = self.savename + '.chunks'
+                with chunkstore.ChunkStore(
+                        name, compression=compression, attrs=self.attrs,
+                        metaDtype=frameMetaDt) as store:
+                    while self.recording(i):
+                        self.storeNew(store, i)
+
+        elif saveMode.startswith('raw'):
+            names = []
+            for i in range(nPlanes):
+                if self.recMode in [3, 4]:
+                    name = self.savename + '_z' + str(i) + '.raw'
+                    nFrames = self.framesExpected
+                else:
+                    name = self.savename + '.raw'
+                    nFrames = self.timeorframes if self.recMode == 1 else None
+                with RawStore(name, self.shape, self.attrs, nFrames) as store:
+                    while self.recording(i):
+                        self.storeNew(store, i)
+                names.append(name)
+            if saveMode != 'raw':
+                self.main.packRaw(names, saveMode.split()[-1])
 
         self.lvworker.stopRecording()
 
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 23:14:52 2026
+
+@author: Tempesta_team
+
+Reconstruction of the scan (illumination) images while the scan runs. Every
+frame of a scan is a position of the stage given by its index, the image of
+a bead is the mean of the window of radius r around it in every frame, put
+at the position of the frame in the scan. The beads are only found at the
+end, on the first and last frames of the scan (see
+scanner.MultiScanWorker), so instead of averaging the windows of all the
+frames afterwards, LVWorker hands each frame to ScanImageBuilder as it
+arrives. The builder reduces it to the window means around a grid of nodes
+every stride px (from the integral image of the frame, in a few ms), and
+when the scan ends the images of the beads are read from the nodes nearest
+to them, with no pass over the frames.
+
+The frames are still recorded, for an analysis with another window size, so
+the grid is memory on top of them: half the size of uint16 frames at stride
+2. The builder makes the grid coarser when it would take more than maxBytes.
+"""
+
+import time
+import threading
+
+import numpy as np
+
+import control.metrics as metrics
+
+
+def scanImage(values, steps, primScanDim):
+    """ Image of the per-frame values of a scan plane, in the layout of the
+    scan. Frames that did not arrive are 0."""
+    image = np.zeros(steps[0] * steps[1])
+    n = min(len(values), len(image))
+    image[:n] = values[:n]
+    image = np.reshape(image, steps)
+    if primScanDim == 'x':
+        image = image.T
+    return image
+
+
+class ScanImageBuilder():
+    """ Window means of the frames of a scan, computed as they arrive.
+
+    :param int stride: px between the centers of the windows. The windows of
+    the beads are the ones of the nearest node, at most stride/2 px away.
+    :param int maxBytes: largest size of the window means of a scan, the
+    stride is increased for the scans that need more."""
+
+    def __init__(self, stride=2, maxBytes=512*2**20):
+        self.stride = stride
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.running = False
+        self.count = 0
+        self.nFrames = 0
+
+    def start(self, steps, primScanDim, planes, shape, radius):
+        """ Starts a scan of planes planes of steps[0] x steps[1] frames (in
+        the order of MultiScanWorker.steps) with frames of the given shape.
+        """
+        height, width = shape
+        r = radius
+        nFrames = steps[0] * steps[1] * planes
+        stride = self.stride
+        while (nFrames * np.ceil(height / stride) * np.ceil(width / stride) *
+               4 > self.maxBytes and stride < max(height, width)):
+            stride += 1
+        if stride != self.stride:
+            print('Scan images built with windows every {} px'.format(
+                stride))
+        ys = np.arange(0, height, stride)
+        xs = np.arange(0, width, stride)
+        with self.lock:
+            self.gridStride = stride
+            self.steps = tuple(steps)
+            self.primScanDim = primScanDim
+            self.planes = planes
+            self.shape = tuple(shape)
+            self.radius = radius
+            self.planeFrames = steps[0] * steps[1]
+            self.nFrames = self.planeFrames * planes
+
+            # Same windows as MultiScanWorker.meanROI
+            self.y0 = np.clip(ys - r, 0, height)
+            self.y1 = np.clip(ys + r, 0, height)
+            self.x0 = np.clip(xs - r, 0, width)
+            self.x1 = np.clip(xs + r, 0, width)
+            self.area = np.outer(self.y1 - self.y0, self.x1 - self.x0)
+
+            self.windowMeans = np.zeros((self.nFrames, len(ys), len(xs)),
+                                        dtype=np.float32)
+            self.frameMeans = np.zeros(self.nFrames)
+            self.firsts = [None] * planes
+            self.lasts = [None] * planes
+            self.maxValues = np.zeros(planes)
+            self.count = 0
+            self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def add(self, frame):
+        """ Takes the next frame of the scan."""
+        if not self.running:
+            return
+        index = self.count
+        if index >= self.nFrames:
+            self.running = False
+            return
+
+        t0 = time.perf_counter()
+        image = np.reshape(frame, self.shape)
+        integral = np.zeros((self.shape[0] + 1, self.shape[1] + 1))
+        np.cumsum(image, 0, out=integral[1:, 1:])
+        np.cumsum(integral[1:, 1:], 1, out=integral[1:, 1:])
+        sums = (integral[np.ix_(self.y1, self.x1)] -
+                integral[np.ix_(self.y0, self.x1)] -
+                integral[np.ix_(self.y1, self.x0)] +
+                integral[np.ix_(self.y0, self.x0)])
+
+        plane, position = divmod(index, self.planeFrames)
+        with self.lock:
+            self.windowMeans[index] = sums / self.area
+            self.frameMeans[index] = integral[-1, -1] / image.size
+            # MultiScanWorker.find_fp looks for the beads in the second and
+            # last frames
+            if position == min(1, self.planeFrames - 1):
+                self.firsts[plane] = image
+            self.lasts[plane] = image
+            self.maxValues[plane] = max(self.maxValues[plane], image.max())
+            self.count = index + 1
+        metrics.observe('scanimage.add', 1000*(time.perf_counter() - t0))
+
+    def planeSlice(self, plane):
+        start = plane * self.planeFrames
+        return slice(start, max(start, min(self.count,
+                                           start + self.planeFrames)))
+
+    def nodes(self, centers):
+        """ Indices of the grid nodes nearest to the (x, y) centers."""
+        centers = np.array(centers, dtype=int).reshape(-1, 2)
+        ix = np.rint(centers[:, 0] / self.gridStride).astype(int)
+        iy = np.rint(centers[:, 1] / self.gridStride).astype(int)
+        ix = np.clip(ix, 0, len(self.x0) - 1)
+        iy = np.clip(iy, 0, len(self.y0) - 1)
+        return iy, ix
+
+    def means(self, centers, plane=0):
+        """ Means of the windows of the (x, y) centers in the frames of the
+        plane received so far, one row per center."""
+        iy, ix = self.nodes(centers)
+        with self.lock:
+            return self.windowMeans[self.planeSlice(plane)][:, iy, ix].T
+
+    def image(self, values):
+        return scanImage(values, self.steps, self.primScanDim)
+
+    def images(self, centers, plane=0):
+        """ Scan images of the (x, y) centers."""
+        return [self.image(values) for values in self.means(centers, plane)]
+
+    def liveImage(self, centers=None):
+        """ Scan image of the plane being scanned, of the first center or
+        of the mean of the frames if no center is given."""
+        plane = min(max(self.count - 1, 0) // self.planeFrames,
+                    self.planes - 1)
+        if centers is not None and len(centers) > 0:
+            return self.images(centers[:1], plane)[0]
+        with self.lock:
+            return self.image(self.frameMeans[self.planeSlice(plane)])
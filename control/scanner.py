@@ -19,8 +19,11 @@ from PyQt4 import QtGui, QtCore
 import matplotlib.pyplot as plt
 import collections
 import nidaqmx
+import nidaqmx.stream_writers
 
 import control.guitools as guitools
+import control.metrics as metrics
+import control.scanimage as scanimage
 
 from cv2 import rectangle, goodFeaturesToTrack, moments
 
@@ -45,7 +48,7 @@ class Positionner(QtGui.QWidget):
         self.scanWidget = main
         self.focusWgt = self.scanWidget.focusWgt
 
-        # Position of the different devices in V
+        # Position of the different devices in µm
         self.x = 0.00
         self.y = 0.00
         self.z = 0.00
@@ -61,19 +64,9 @@ class Positionner(QtGui.QWidget):
         self.activeChannels = ["x", "y", "z"]
         self.AOchans = [0, 1, 2]     # Order corresponds to self.channelOrder
 
-        self.aotask = nidaqmx.Task("positionnerTask")
-        # Following loop creates the voltage channels
-        for n in self.AOchans:
-            self.aotask.ao_channels.add_ao_voltage_chan(
-                physical_channel='Dev1/ao%s' % n,
-                name_to_assign_to_channel=self.activeChannels[n],
-                min_val=minVolt[self.activeChannels[n]],
-                max_val=maxVolt[self.activeChannels[n]])
-
-        self.aotask.timing.cfg_samp_clk_timing(
-            rate=self.sampleRate,
-            sample_mode=nidaqmx.constants.AcquisitionType.FINITE,
-            samps_per_chan=self.nSamples)
+        # The analog output task is shared with the scans
+        self.tasks = self.scanWidget.daqTasks
+        self.aotask = self.tasks.acquire('ao', self)
 
         # Axes control
         self.xLabel = QtGui.QLabel(
@@ -129,6 +122,11 @@ class Positionner(QtGui.QWidget):
 
     def move(self, axis, dist):
         """moves the position along the axis specified a distance dist."""
+        if not self.isActive:
+            # The scan drives all the channels of the shared analog task,
+            # including the ones it keeps constant
+            print('Cannot move {} while scanning'.format(axis))
+            return
 
         # read initial position for all channels
         texts = [getattr(self, ax + "Label").text()
@@ -144,12 +142,16 @@ class Positionner(QtGui.QWidget):
         # convert um to V and send signal to piezo
         factors = np.array([i for i in convFactors.values()])[:, np.newaxis]
         fullSignal = fullPos/factors
-        self.aotask.write(fullSignal, auto_start=True)
+        self.tasks.configure('ao', self.sampleRate,
+                             nidaqmx.constants.AcquisitionType.FINITE,
+                             self.nSamples)
+        self.tasks.write('ao', fullSignal, autoStart=True)
         self.aotask.wait_until_done()
         self.aotask.stop()
 
         # update position text
         newPos = fullPos[self.activeChannels.index(axis)][-1]
+        setattr(self, axis, newPos)
         newText = "<strong>" + axis + " = {0:.2f} µm</strong>".format(newPos)
         getattr(self, axis + "Label").setText(newText)
 
@@ -179,61 +181,43 @@ class Positionner(QtGui.QWidget):
 
         :param dict channels: the channels which are used or released by
         another object. The positionner does not touch the other channels"""
+        totalChannels = ["x", "y", "z"]
         if(self.isActive):
-            self.aotask.stop()
-            self.aotask.close()
-            del self.aotask
-            totalChannels = ["x", "y", "z"]
-            self.aotask = nidaqmx.Task("positionnerTask")
-
+            self.tasks.release('ao', self)
             # returns a list containing the axis not in use
             self.activeChannels = [
                 x for x in totalChannels if x not in channels]
-
-            try:
-                axis = self.activeChannels[0]
-                n = self.AOchans[self.activeChannels.index(axis)]
-                channel = "Dev1/ao%s" % n
-                self.aotask.ao_channels.add_ao_voltage_chan(
-                    physical_channel=channel, name_to_assign_to_channel=axis,
-                    min_val=minVolt[axis], max_val=maxVolt[axis])
-            except IndexError:
-                pass
             self.isActive = False
+            self.setButtonsEnabled(False)
 
         else:
-            # Restarting the analog channels
-            self.aotask.stop()
-            self.aotask.close()
-            del self.aotask
-            self.aotask = nidaqmx.Task("positionnerTask")
-
-            totalChannels = ["x", "y", "z"]
+            # Taking back the analog channels, the scan has already returned
+            # them to 0
+            self.aotask = self.tasks.acquire('ao', self)
             self.activeChannels = totalChannels
-            for axis in totalChannels:
-                n = self.AOchans[self.activeChannels.index(axis)]
-                channel = "Dev1/ao%s" % n
-                self.aotask.ao_channels.add_ao_voltage_chan(
-                    physical_channel=channel, name_to_assign_to_channel=axis,
-                    min_val=minVolt[axis], max_val=maxVolt[axis])
-
-            self.aotask.timing.cfg_samp_clk_timing(
-                rate=self.sampleRate,
-                sample_mode=nidaqmx.constants.AcquisitionType.FINITE,
-                samps_per_chan=self.nSamples)
-            self.aotask.start()
             self.isActive = True
+            self.setButtonsEnabled(True)
 
         for axis in self.activeChannels:
+            setattr(self, axis, 0.00)
             newText = "<strong>" + axis + " = {0:.2f} µm</strong>".format(0)
             getattr(self, axis + "Label").setText(newText)
 
+    def setButtonsEnabled(self, enabled):
+        """The buttons are disabled during the scans, which take all the
+        analog output channels."""
+        tip = '' if enabled else 'The piezos are driven by the scan'
+        for axis in ["x", "y", "z"]:
+            for direction in ["Up", "Down"]:
+                button = getattr(self, axis + direction + "Button")
+                button.setEnabled(enabled)
+                button.setToolTip(tip)
+
     def closeEvent(self, *args, **kwargs):
         if(self.isActive):
             # Resets the sliders, which will reset each channel to 0
             self.aotask.wait_until_done(timeout=2)
-            self.aotask.stop()
-            self.aotask.close()
+            self.tasks.release('ao', self)
 
 
 def saveScan(scanWid):
@@ -307,6 +291,10 @@ class ScanWidget(QtGui.QMainWindow):
     As seen in the commened lines of run() I also tried running in a QThread
     created in run().
     The rest of the functions contain mostly GUI related code.'''
+
+    scanStarted = QtCore.pyqtSignal()
+    scanEnded = QtCore.pyqtSignal()
+
     def __init__(self, device, main, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -341,6 +329,11 @@ class ScanWidget(QtGui.QMainWindow):
         
         self.channelOrder = ['x', 'y', 'z']
 
+        # NiDaq tasks shared by the positionner and the scans
+        self.daqTasks = TaskManager(self.nidaq, self.channelOrder,
+                                    self.devicechannels)
+        self.program = None
+
         self.saveScanBtn = QtGui.QPushButton('Save Scan')
 
         self.scanDir = os.path.join(self.main.controlFolder, 'scans')
@@ -424,8 +417,10 @@ class ScanWidget(QtGui.QMainWindow):
 
 
         self.stageScan = StageScan(self.sampleRate)
-        self.pxCycle = PixelCycle(self.sampleRate, self.allDevices)
+        self.pxCycle = PixelCycle(self.sampleRate, self.allDevices,
+                                  self.devicechannels)
         self.graph = GraphFrame(self.pxCycle, self.Device_info)
+        self.preview = None
         self.graph.plot.getAxis('bottom').setScale(1000/self.sampleRate)
         self.graph.setFixedHeight(100)
         self.updateScan(self.allDevices)
@@ -442,6 +437,8 @@ class ScanWidget(QtGui.QMainWindow):
 
         self.scanButton = QtGui.QPushButton('Scan')
         self.scanning = False
+        # Whether the images of the running scan are built while scanning
+        self.liveImages = False
         self.scanButton.clicked.connect(self.scanOrAbort)
         self.previewButton = QtGui.QPushButton('Plot scan path')
         self.previewButton.setSizePolicy(QtGui.QSizePolicy.Preferred,
@@ -563,25 +560,10 @@ class ScanWidget(QtGui.QMainWindow):
 
     def previewScan(self):
         self.updateScan(self.allDevices)
-        fig = plt.figure()
-        ax0 = fig.add_subplot(211)
-        ax0.plot(self.stageScan.sigDict['x'] * convFactors['x'])
-        ax0.plot(self.stageScan.sigDict['y'] * convFactors['y'])
-        ax0.plot(self.stageScan.sigDict['z'] * convFactors['z'])
-        ax0.plot(self.pxCycle.sigDict['CAM'])
-        ax0.grid()
-        ax0.set_xlabel('sample')
-        ax0.set_ylabel('position [um]')
-        ax1 = fig.add_subplot(212)
-        ax1.plot(self.stageScan.sigDict['x'] * convFactors['x'],
-                 self.stageScan.sigDict['y'] * convFactors['y'])
-        mx = max(self.scanParValues['sizeX'], self.scanParValues['sizeY'])
-        ax1.margins(0.1*mx)
-        ax1.axis('scaled')
-        ax1.set_xlabel("x axis [µm]")
-        ax1.set_ylabel("y axis [µm]")
-
-        plt.show()
+        if self.preview is None:
+            self.preview = ScanPreview()
+        self.preview.update(self.stageScan)
+        self.preview.show()
 
     def scanOrAbort(self):
         if not self.scanning:
@@ -599,25 +581,39 @@ class ScanWidget(QtGui.QMainWindow):
         ''' Only called if scanner is not running (See scanOrAbort function).
         '''
         if self.scanRadio.isChecked():
-            self.stageScan.update(self.scanParValues)
+            try:
+                program = self.scanProgram()
+            except ValueError as e:
+                print(e)
+                if continuous:
+                    # Parameters changed during a continuous scan, it ends
+                    # as it would if unchecked
+                    self.continuousCheck.setChecked(False)
+                    self.finalizeDone()
+                return
             self.scanButton.setText('Abort')
             if not(continuous):
                 self.main.piezoWidget.resetChannels(
                     self.stageScan.activeChannels[self.stageScan.scanMode])
-            self.scanner = Scanner(
-               self.nidaq, self.stageScan, self.pxCycle, self.devicechannels, self, continuous)
-            self.scanner.finalizeDone.connect(self.finalizeDone)
-            self.scanner.scanDone.connect(self.scanDone)
+            if not (continuous and self.scanner.program is program):
+                self.scanner = Scanner(self.nidaq, program, self, continuous)
+                self.scanner.finalizeDone.connect(self.finalizeDone)
+                self.scanner.scanDone.connect(self.scanDone)
             self.scanning = True
             if self.focusLocked:
                 self.focusWgt.unlockFocus()
 
             self.main.lvworkers[0].startRecording()
+            self.liveImages = self.multiScanWgt.makeImgBox.isChecked()
+            if self.liveImages:
+                self.multiScanWgt.startLive(self.stageScan,
+                                            self.main.shapes[0][::-1])
 
             self.scanner.runScan()
+            self.scanStarted.emit()
 
         elif self.scanButton.isChecked():
-            self.lasercycle = LaserCycle(self.nidaq, self.pxCycle)
+            self.lasercycle = LaserCycle(self.daqTasks, self.pxCycle)
             self.scanButton.setText('Stop')
             self.lasercycle.run()
 
@@ -628,38 +624,33 @@ class ScanWidget(QtGui.QMainWindow):
 
     def scanDone(self):
         self.scanButton.setEnabled(False)
+        self.multiScanWgt.stopLive()
 
         if not self.scanner.aborted:
             time.sleep(0.1)
 
             self.main.lvworkers[0].stopRecording()
 
-            # Building scanning image in 2D or 3D
-            if self.multiScanWgt.makeImgBox.isChecked():
-
-                # Get data
-                data = self.main.lvworkers[0].fRecorded
+            # Building scanning image in 2D or 3D, the windows means were
+            # computed while scanning. The builder keeps the ones of the
+            # last scan it was started for, which may not be this one.
+            builder = self.multiScanWgt.builder
+            if self.liveImages and builder.count:
+                worker = self.multiScanWgt.worker
 
-                # Send data to MultipleScanWidget and analyze it
                 if self.stageScan.scanMode == 'FOV scan':
-                    datashape = (len(data), *self.main.shapes[0][::-1])
-                    data = np.reshape(data, datashape)
-                    self.multiScanWgt.worker.set_images(data)
-                    self.multiScanWgt.worker.find_fp()
-                    self.multiScanWgt.worker.analyze()
+                    worker.set_builder(builder)
+                    worker.find_fp()
+                    worker.analyze()
 
                 elif self.stageScan.scanMode == 'VOL scan':
                     vScan = self.stageScan.scans['VOL scan']
-                    datashape = (vScan.stepsZ, -1, *self.main.shapes[0][::-1])
-                    data = np.reshape(data, datashape)
                     stk = np.zeros((vScan.stepsZ, vScan.stepsY, vScan.stepsX))
-                    i = 0
-                    for image in data:
-                        self.multiScanWgt.worker.set_images(image)
-                        self.multiScanWgt.worker.find_fp()
-                        self.multiScanWgt.worker.analyze()
-                        stk[i] = self.multiScanWgt.worker.illumImgs[0]
-                        i += 1
+                    for i in range(builder.planes):
+                        worker.set_builder(builder, i)
+                        worker.find_fp()
+                        worker.analyze()
+                        stk[i] = worker.illumImgs[0]
 
                     xAx = np.arange(0, vScan.stepsZ*vScan.stepSizeZ,
                                     vScan.stepSizeZ)
@@ -675,6 +666,7 @@ class ScanWidget(QtGui.QMainWindow):
                 self.focusWgt.lockFocus()
             self.main.piezoWidget.resetChannels(
                 self.stageScan.activeChannels[self.stageScan.scanMode])
+            self.scanEnded.emit()
         elif self.continuousCheck.isChecked():
             self.scanButton.setEnabled(True)
             self.prepAndRun(True)
@@ -682,6 +674,27 @@ class ScanWidget(QtGui.QMainWindow):
             self.scanButton.setEnabled(True)
             self.prepAndRun()
 
+    def programKey(self):
+        return (self.stageScan.scanMode, self.stageScan.primScanDim,
+                self.stageScan.sampleRate, self.pxCycle.sampleRate,
+                tuple(sorted(self.scanParValues.items())),
+                tuple(sorted(self.pxParValues.items())))
+
+    def scanProgram(self):
+        """Compiled program of the current scan parameters. It is only
+        compiled again when they change, the repetitions of continuous and
+        time-lapse scans reuse it."""
+        key = self.programKey()
+        if self.program is None or self.program.key != key:
+            with metrics.timer('scan.compile'):
+                self.stageScan.update(self.scanParValues)
+                self.pxCycle.update(self.allDevices, self.pxParValues,
+                                    self.stageScan.seqSamps)
+                self.program = ScanProgram(
+                    self.stageScan, self.pxCycle, self.channelOrder,
+                    self.daqTasks.dacScaling, key)
+        return self.program
+
     def updateScan(self, devices):
         self.stageScan.update(self.scanParValues)
         self.pxCycle.update(devices, self.pxParValues, self.stageScan.seqSamps)
@@ -691,6 +704,7 @@ class ScanWidget(QtGui.QMainWindow):
             self.scanner.waiter.terminate()
         except BaseException:
             pass
+        self.daqTasks.close()
 
 
 class WaitThread(QtCore.QThread):
@@ -711,35 +725,334 @@ class WaitThread(QtCore.QThread):
         self.wait = False
 
 
+class TaskManager():
+    """Keeps the analog output task of the piezo channels and the digital
+    output task of the pixel cycle lines configured for the whole session,
+    instead of creating, closing and resetting the device around every scan.
+    Positionner, Scanner and LaserCycle take a task with acquire and give it
+    back with release. Between runs only the sample clock is reconfigured,
+    and only when it changes.
+
+    :param nidaqmx.Device device: NiDaq card
+    :param list AOaxes: axis of each of the analog outputs 0, 1, 2...
+    :param list DOlines: lines of port 0 of the digital task. They form a
+    single port channel, the digital signals are port words with one bit per
+    line (see PixelCycle.portWord)"""
+
+    def __init__(self, device, AOaxes, DOlines):
+        self.nidaq = device
+        self.tasks = {'ao': nidaqmx.Task('aotask'),
+                      'do': nidaqmx.Task('dotask')}
+        for n, axis in enumerate(AOaxes):
+            self.tasks['ao'].ao_channels.add_ao_voltage_chan(
+                physical_channel='Dev1/ao%s' % n,
+                name_to_assign_to_channel='chan_%s' % axis,
+                min_val=minVolt[axis], max_val=maxVolt[axis])
+        self.tasks['do'].do_channels.add_do_chan(
+            lines=','.join('Dev1/port0/line%s' % line for line in DOlines),
+            name_to_assign_to_lines='port0',
+            line_grouping=nidaqmx.constants.LineGrouping.CHAN_FOR_ALL_LINES)
+        writer = nidaqmx.stream_writers.DigitalSingleChannelWriter(
+            self.tasks['do'].out_stream)
+        if portDtype(DOlines) == np.uint8:
+            self.writers = {'do': writer.write_many_sample_port_byte}
+        else:
+            self.writers = {'do': writer.write_many_sample_port_uint32}
+        # The scans write DAC codes, see DACScaling
+        self.dacScaling = DACScaling.fromTask(self.tasks['ao'])
+        self.rawWriters = {'ao': nidaqmx.stream_writers.AnalogUnscaledWriter(
+            self.tasks['ao'].out_stream).write_int16}
+        self.owners = {'ao': None, 'do': None}
+        self.timings = {'ao': None, 'do': None}
+        self.loaded = {'ao': None, 'do': None}
+
+    def acquire(self, kind, owner):
+        """Stops the task ('ao' or 'do') for its current owner and hands it
+        to owner."""
+        task = self.tasks[kind]
+        task.stop()
+        self.owners[kind] = owner
+        return task
+
+    def release(self, kind, owner):
+        if self.owners[kind] is owner:
+            self.tasks[kind].stop()
+            self.owners[kind] = None
+
+    def configure(self, kind, rate, sampleMode, samples=1000, source=None):
+        """Sets the sample clock of the task if it's not already set."""
+        timing = (rate, sampleMode, samples, source)
+        if self.timings[kind] == timing:
+            return
+        with metrics.timer('daq.configure'):
+            kwargs = {} if source is None else {'source': source}
+            self.tasks[kind].timing.cfg_samp_clk_timing(
+                rate=rate, sample_mode=sampleMode, samps_per_chan=samples,
+                **kwargs)
+        self.timings[kind] = timing
+
+    def write(self, kind, signal, key=None, autoStart=False):
+        """Writes the signal to the buffer of the task. If key is given and
+        the buffer already has the signal written with that key, the task
+        just regenerates it and nothing is written. Analog signals are
+        voltages, or DAC codes if they are int16."""
+        if key is not None and self.loaded[kind] == key:
+            metrics.count('daq.rewrite_skipped')
+            return
+        self.loaded[kind] = None
+        if kind in self.rawWriters and signal.dtype == np.int16:
+            self.rawWriters[kind](signal)
+            if autoStart:
+                self.tasks[kind].start()
+        elif kind in self.writers:
+            self.writers[kind](signal)
+            if autoStart:
+                self.tasks[kind].start()
+        else:
+            self.tasks[kind].write(signal, auto_start=autoStart)
+        self.loaded[kind] = key
+
+    def close(self):
+        for task in self.tasks.values():
+            task.stop()
+            task.close()
+
+
+class DACScaling():
+    """Conversion of voltages to the int16 codes of the DACs of the analog
+    outputs, with the calibration of the card (ao_dev_scaling_coeff of each
+    channel, polynomial from volts to codes). Writing the codes with the
+    unscaled writer skips the conversion of the float signals by nidaqmx at
+    write time, and they take a fourth of the memory.
+
+    :param list coeffs: scaling coefficients of each channel"""
+
+    def __init__(self, coeffs):
+        self.coeffs = [np.array(c, dtype=float) for c in coeffs]
+
+    @classmethod
+    def fromTask(cls, task):
+        return cls([chan.ao_dev_scaling_coeff for chan in task.ao_channels])
+
+    def codes(self, volts):
+        """int16 codes of the (channels x samples) voltages. The
+        conversion goes one channel at a time, only one row of floats is
+        made at once."""
+        codes = np.empty(np.shape(volts), dtype=np.int16)
+        for i, coeffs in enumerate(self.coeffs):
+            code = np.polynomial.polynomial.polyval(volts[i], coeffs)
+            np.rint(code, out=code)
+            np.clip(code, -32768, 32767, out=code)
+            codes[i] = code
+        return codes
+
+    def volts(self, codes):
+        """Voltages of one code per channel, inverting the scaling by
+        Newton's method."""
+        volts = []
+        for code, coeffs in zip(codes, self.coeffs):
+            poly = np.polynomial.Polynomial(coeffs)
+            deriv = poly.deriv()
+            v = (code - coeffs[0]) / coeffs[1]
+            for _ in range(5):
+                v -= (poly(v) - code) / deriv(v)
+            volts.append(v)
+        return np.array(volts)
+
+
+class ScanProgram():
+    """AO and DO signals of a scan, compiled once from the StageScan and the
+    PixelCycle and run as many times as needed while the scan parameters do
+    not change. The AO signals end with a ramp back to 0, so a scan that runs
+    to the end leaves the stage where the next one starts: the tasks keep
+    the signals in their buffers and the program is run again just
+    restarting them, without writing or reconfiguring anything.
+
+    :param StageScan stageScan: updated stage scan
+    :param PixelCycle pxCycle: updated pixel cycle
+    :param list channelOrder: axis of each row of the AO signals
+    :param DACScaling scaling: scaling of the analog outputs, the AO signals
+    are kept as DAC codes
+    :param key: parameters the program was compiled from"""
+
+    def __init__(self, stageScan, pxCycle, channelOrder, scaling, key=None):
+        self.key = key
+        self.scanMode = stageScan.scanMode
+        self.sampleRate = stageScan.sampleRate
+        self.doRate = pxCycle.sampleRate
+
+        scanSig = np.array([stageScan.sigDict[axis] for axis in channelOrder])
+        # The codes are clipped at the rails of the DACs, the scans beyond
+        # the range of the piezos are refused before
+        for axis, sig in zip(channelOrder, scanSig):
+            if sig.min() < minVolt[axis] or sig.max() > maxVolt[axis]:
+                raise ValueError(
+                    'The {} signal of the scan goes from {:.2f} to {:.2f} V, '
+                    'beyond the {} to {} V of the piezo'.format(
+                        axis, sig.min(), sig.max(), minVolt[axis],
+                        maxVolt[axis]))
+        returnRamps = np.array(
+            [makeRamp(sig[-1], 0, stageScan.seqSamps) for sig in scanSig])
+        self.scaling = scaling
+        self.aoSig = np.concatenate((scaling.codes(scanSig),
+                                     scaling.codes(returnRamps)), axis=1)
+        self.scanSamps = scanSig.shape[1]
+        self.samps = self.aoSig.shape[1]
+
+        """When doing unidirectional scan, the time needed for the stage to
+        move back to the initial x needs to be filled with zeros/False.
+        This time is now set to the time spanned by 1 sequence.
+        Therefore, the digital signal is assambled as the repetition of the
+        sequence for the whole scan in one row and then append zeros for 1
+        sequence time. The DO task regenerates this line signal for the whole
+        AO signal, the return ramp falls on the zeros at its start. THIS IS
+        NOW INCOMPATIBLE WITH VOLUMETRIC SCAN, maybe."""
+        if stageScan.primScanDim == 'x':
+            primSteps = stageScan.scans[stageScan.scanMode].stepsX
+        else:
+            primSteps = stageScan.scans[stageScan.scanMode].stepsY
+        # Signal for a single line
+        lineSig = np.tile(pxCycle.portWord, primSteps)
+        emptySig = np.zeros(int(stageScan.seqSamps), dtype=lineSig.dtype)
+        self.doSig = np.concatenate((emptySig, lineSig, emptySig))
+
+    def arm(self, tasks):
+        """Configures the tasks and writes the signals, when they are not
+        already there from the last run of this program."""
+        with metrics.timer('scan.configure'):
+            tasks.configure(
+                'ao', self.sampleRate,
+                nidaqmx.constants.AcquisitionType.FINITE, self.samps,
+                r'100kHzTimeBase')
+            tasks.configure(
+                'do', self.doRate,
+                nidaqmx.constants.AcquisitionType.FINITE, self.samps,
+                r'ao/SampleClock')
+        # Programs compiled from the same parameters have the same signals,
+        # the key tells whether the buffers already hold them
+        with metrics.timer('scan.write'):
+            tasks.write('ao', self.aoSig, self.key)
+            tasks.write('do', self.doSig, self.key)
+
+    def scanPosition(self, samps):
+        """Voltages of the AO channels after samps generated samples."""
+        return self.scaling.volts(
+            self.aoSig[:, min(max(samps, 1), self.samps) - 1])
+
+
+class RepeatScheduler(QtCore.QObject):
+    """Starts count repetitions, every interval seconds. A QTimer started at
+    fixed intervals lets the setup of every repetition (writing files,
+    waiting for the previous one to end) delay its start. Instead, the
+    deadlines are counted from the start of the first repetition and each
+    fire is emitted earlier by the mean setup time measured until then, the
+    time from fire to setupDone.
+
+    A repetition only counts when it starts (setupDone). A fire that could
+    not start one, because the previous scan was still running or being
+    stored, is emitted again by retry when it ends.
+
+    :param float interval: seconds between the starts of the repetitions
+    :param int count: number of repetitions"""
+
+    fire = QtCore.pyqtSignal()
+
+    def __init__(self, interval, count, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interval = interval
+        self.count = count
+        self.setupTimes = collections.deque(maxlen=5)
+        self.timer = QtCore.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.trigger)
+        self.started = 0
+        self.t0 = None
+        self.lastFire = None
+
+    @property
+    def setupTime(self):
+        if not self.setupTimes:
+            return 0
+        return np.mean(self.setupTimes)
+
+    def start(self):
+        self.started = 0
+        self.t0 = None
+        self.trigger()
+
+    def stop(self):
+        self.timer.stop()
+        self.started = self.count
+        self.lastFire = None
+
+    def trigger(self):
+        if self.started >= self.count:
+            return
+        now = time.perf_counter()
+        if self.t0 is not None:
+            late = now - self.deadline(self.started) + self.setupTime
+            metrics.observe('scan.schedule_late', 1000*late)
+        self.lastFire = now
+        self.fire.emit()
+
+    def retry(self):
+        """Fires again if the last fire did not start a repetition."""
+        if self.lastFire is not None and not self.timer.isActive():
+            metrics.count('scan.schedule_retry')
+            self.trigger()
+
+    def setupDone(self):
+        """Called when the repetition fired last actually starts."""
+        if self.lastFire is None:
+            return
+        now = time.perf_counter()
+        self.setupTimes.append(now - self.lastFire)
+        metrics.observe('scan.setup', 1000*(now - self.lastFire))
+        if self.t0 is None:
+            self.t0 = now
+        self.lastFire = None
+        self.started += 1
+        self.scheduleNext()
+
+    def deadline(self, n):
+        return self.t0 + n*self.interval
+
+    def scheduleNext(self):
+        if self.started >= self.count:
+            self.timer.stop()
+            return
+        start = self.deadline(self.started) - self.setupTime
+        wait = max(0, start - time.perf_counter())
+        self.timer.start(int(1000*wait))
+
+
 class Scanner(QtCore.QObject):
     """This class plays the role of interface between the software and the
     hardware. It writes the different signals to the electronic cards and
     manages the timing of a scan.
 
     :param nidaqmx.Device device: NiDaq card
-    :param StageScan stageScan: object containing the analog signals to drive
-    the stage
-    :param PixelCycle pxCycle: object containing the digital signals to
-    drive the lasers at each pixel acquisition
+    :param ScanProgram program: analog signals to drive the stage and
+    digital signals to drive the lasers at each pixel acquisition
     :param ScanWidget main: main scan GUI."""
 
     scanDone = QtCore.pyqtSignal()
     finalizeDone = QtCore.pyqtSignal()
 
-    def __init__(self, device, stageScan, pxCycle, DOchans, main, continuous=False,
+    def __init__(self, device, program, main, continuous=False,
                  *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.nidaq = device
-        self.stageScan = stageScan
-        self.pxCycle = pxCycle
+        self.program = program
         self.continuous = continuous
-
-        self.sampsInScan = len(self.stageScan.sigDict['x'])
         self.main = main
 
-        self.aotask = nidaqmx.Task('aotask')
-        self.dotask = nidaqmx.Task('dotask')
+        # The tasks are acquired before every run, in continuous mode the
+        # scanner is reused
+        self.tasks = main.daqTasks
+        self.aotask = self.tasks.tasks['ao']
+        self.dotask = self.tasks.tasks['do']
         self.waiter = WaitThread(self.aotask)
 
         self.scanTimeW = QtGui.QMessageBox()
@@ -752,60 +1065,12 @@ class Scanner(QtCore.QObject):
 
         self.focusWgt = self.main.focusWgt
 
-        AOchans = [0, 1, 2]
-        # Following loop creates the voltage channels
-        for n in range(len(AOchans)):
-            self.aotask.ao_channels.add_ao_voltage_chan(
-                physical_channel='Dev1/ao%s' % AOchans[n],
-                name_to_assign_to_channel='chan_%s' % self.channelOrder[n],
-                min_val=minVolt[self.channelOrder[n]],
-                max_val=maxVolt[self.channelOrder[n]])
-
-        self.fullAOsig = np.array(
-            [self.stageScan.sigDict[self.channelOrder[i]]
-             for i in range(len(AOchans))])
-
-        # Same as above but for the digital signals/devices
-        devs = list(self.pxCycle.sigDict.keys())
-        for d in DOchans:
-            chanstring = 'Dev1/port0/line%s' % d
-            print('Adding', chanstring)
-            self.dotask.do_channels.add_do_chan(
-                lines=chanstring, name_to_assign_to_lines='chan%s' % devs[d])
-
-        fullDOsig = np.array(
-            [self.pxCycle.sigDict[devs[i]] for i in range(0,len(devs))])
-
-        """When doing unidirectional scan, the time needed for the stage to
-        move back to the initial x needs to be filled with zeros/False.
-        This time is now set to the time spanned by 1 sequence.
-        Therefore, the digital signal is assambled as the repetition of the
-        sequence for the whole scan in one row and then append zeros for 1
-        sequence time. THIS IS NOW INCOMPATIBLE WITH VOLUMETRIC SCAN, maybe."""
-        if self.stageScan.primScanDim == 'x':
-            primSteps = self.stageScan.scans[self.stageScan.scanMode].stepsX
-        else:
-            primSteps = self.stageScan.scans[self.stageScan.scanMode].stepsY
-        # Signal for a single line
-        lineSig = np.tile(fullDOsig, primSteps)
-        emptySig = np.zeros((len(devs), int(self.stageScan.seqSamps)), dtype=bool)
-        self.fullDOsig = np.concatenate((emptySig, lineSig, emptySig), axis=1)
-
     def runScan(self):
         self.aborted = False
 
-        self.aotask.timing.cfg_samp_clk_timing(
-            rate=self.stageScan.sampleRate,
-            source=r'100kHzTimeBase',
-            sample_mode=nidaqmx.constants.AcquisitionType.FINITE,
-            samps_per_chan=self.sampsInScan)
-        self.dotask.timing.cfg_samp_clk_timing(
-            rate=self.pxCycle.sampleRate,
-            source=r'ao/SampleClock',
-            sample_mode=nidaqmx.constants.AcquisitionType.FINITE,
-            samps_per_chan=self.sampsInScan)
-        self.aotask.write(self.fullAOsig, auto_start=False)
-        self.dotask.write(self.fullDOsig, auto_start=False)
+        self.tasks.acquire('ao', self)
+        self.tasks.acquire('do', self)
+        self.program.arm(self.tasks)
 
         try:
             self.waiter.waitdoneSignal.disconnect(self.done)
@@ -814,8 +1079,10 @@ class Scanner(QtCore.QObject):
             pass
         self.waiter.waitdoneSignal.connect(self.finalize)
 
-        self.dotask.start()
-        self.aotask.start()
+        with metrics.timer('scan.start'):
+            self.dotask.start()
+            self.aotask.start()
+        metrics.count('scan.runs')
         self.waiter.start()
 
     def abort(self):
@@ -834,36 +1101,32 @@ class Scanner(QtCore.QObject):
         except TypeError:
             # This happens when the scan is aborted after the warning
             pass
+        if not self.aborted:
+            # The program already returned the stage to 0
+            self.done()
+            return
         self.waiter.waitdoneSignal.connect(self.done)
 
-        # Following code should correct channels mentioned in Buglist. Not
-        # correct though, assumes channels are 0, 1 and 2.
-        # TODO: Test abort (task function)
-        writtenSamps = int(np.round(self.aotask.out_stream.curr_write_pos))
-        chans = [0, 1, 2]
-        dim = [self.channelOrder[i] for i in chans]
-        finalSamps = [
-            self.stageScan.sigDict[dim[i]][writtenSamps - 1] for i in chans]
-        seqTime = self.main.scanParValues['seqTime']
+        # Ramps back to 0 from where the stage was stopped
+        outStream = self.aotask.out_stream
+        generatedSamps = int(outStream.total_samp_per_chan_generated)
+        finalSamps = self.program.scanPosition(generatedSamps)
+        returnSamps = int(self.program.sampleRate *
+                          self.main.scanParValues['seqTime'])
         returnRamps = np.array(
-            [makeRamp(finalSamps[i], 0, int(self.stageScan.sampleRate*seqTime))
-             for i in chans])
+            [makeRamp(final, 0, returnSamps) for final in finalSamps])
 
         self.aotask.stop()
-        self.aotask.timing.cfg_samp_clk_timing(
-            rate=self.stageScan.sampleRate,
-            sample_mode=nidaqmx.constants.AcquisitionType.FINITE,
-            samps_per_chan=self.stageScan.sampleRate)
+        self.tasks.configure('ao', self.program.sampleRate,
+                             nidaqmx.constants.AcquisitionType.FINITE,
+                             returnSamps)
 
-        self.aotask.write(returnRamps, auto_start=True)
+        self.tasks.write('ao', returnRamps, autoStart=True)
         self.waiter.start()
 
     def done(self):
-        self.aotask.stop()
-        self.aotask.close()
-        self.dotask.stop()
-        self.dotask.close()
-        self.nidaq.reset_device()
+        self.tasks.release('ao', self)
+        self.tasks.release('do', self)
         self.finalizeDone.emit()
 
 
@@ -903,6 +1166,11 @@ class MultipleScanWidget(QtGui.QFrame):
         # make worker
         self.worker = MultiScanWorker(self, self.main)
 
+        # reconstruction of the scan images while scanning
+        self.builder = scanimage.ScanImageBuilder()
+        self.liveTimer = QtCore.QTimer()
+        self.liveTimer.timeout.connect(self.updateLive)
+
         # make other GUI components
         self.analysis_btn = QtGui.QPushButton('Analyze')
         self.analysis_btn.clicked.connect(self.worker.analyze)
@@ -952,6 +1220,31 @@ class MultipleScanWidget(QtGui.QFrame):
 
         grid.setColumnMinimumWidth(3, 100)
 
+    def startLive(self, stageScan, shape):
+        """Starts reconstructing the images of the scan that is starting
+        from the frames of the liveview."""
+        scan = stageScan.scans[stageScan.scanMode]
+        planes = scan.stepsZ if stageScan.scanMode == 'VOL scan' else 1
+        self.builder.start(MultiScanWorker.scanSteps(stageScan),
+                           stageScan.primScanDim, planes, shape,
+                           int(self.win_size_edit.text()))
+        self.liveTimer.start(500)
+
+    def updateLive(self):
+        """Shows the image of the scan so far, of the first bead of the last
+        analysis if it is the same window size, of the mean of the frames
+        otherwise."""
+        if self.builder.count == 0:
+            return
+        centers = None
+        if getattr(self.worker, 'radius', None) == self.builder.radius:
+            centers = getattr(self.worker, 'centers', None)
+        self.illumWgt.update(self.builder.liveImage(centers))
+
+    def stopLive(self):
+        self.liveTimer.stop()
+        self.builder.stop()
+
     def change_illum_image(self):
         self.worker.delete_label()
         curr_ind = self.beadsBox.currentIndex()
@@ -992,21 +1285,57 @@ class MultiScanWorker(QtCore.QObject):
         self.illumImgs = []
         self.illumImgsStocked = []
         self.labels = []
+        self.images = None
+        self.builder = None
+        self.plane = 0
 
         # corner detection parameter of Shi-Tomasi
         self.featureParams = dict(maxCorners=100, qualityLevel=0.1,
                                   minDistance=7, blockSize=7)
 
+    @staticmethod
+    def scanSteps(stageScan):
+        """Steps of the scan in the order of the frames of a plane."""
+        scan = stageScan.scans[stageScan.scanMode]
+        if stageScan.primScanDim == 'x':
+            return [scan.stepsY, scan.stepsX]
+        else:
+            return [scan.stepsX, scan.stepsY]
+
     def set_images(self, images):
-        stageScan = self.mainScanWid.scanner.stageScan
+        stageScan = self.mainScanWid.stageScan
         self.primScanDim = stageScan.primScanDim
-        if self.primScanDim == 'x':
-            self.steps = [stageScan.scans[stageScan.scanMode].stepsY,
-                          stageScan.scans[stageScan.scanMode].stepsX]
-        else:
-            self.steps = [stageScan.scans[stageScan.scanMode].stepsX,
-                          stageScan.scans[stageScan.scanMode].stepsY]
+        self.steps = self.scanSteps(stageScan)
         self.images = images
+        self.builder = None
+
+    def set_builder(self, builder, plane=0):
+        """Analyzes the plane of the scan reconstructed while scanning by
+        builder (scanimage.ScanImageBuilder) instead of a stack of
+        images."""
+        self.primScanDim = builder.primScanDim
+        self.steps = list(builder.steps)
+        self.builder = builder
+        self.plane = plane
+        self.images = None
+
+    def getImages(self):
+        """Stack of the frames, taken from the liveview recording when the
+        images were reconstructed while scanning."""
+        if self.images is None:
+            frames = self.mainScanWid.main.lvworkers[0].fRecorded
+            frames = frames[self.builder.planeSlice(self.plane)]
+            self.images = np.reshape(frames, (len(frames),
+                                              *self.builder.shape))
+        return self.images
+
+    def frameStats(self):
+        """Frames where the beads are searched and max of the frames."""
+        if self.builder is not None:
+            return (self.builder.firsts[self.plane],
+                    self.builder.lasts[self.plane],
+                    self.builder.maxValues[self.plane])
+        return self.images[1], self.images[-1], np.max(self.images)
 
     def find_fp(self):
         self.main.illumWgt.delete_back()
@@ -1015,10 +1344,11 @@ class MultiScanWorker(QtCore.QObject):
         ql = float(self.main.quality_edit.text())
         self.featureParams['qualityLevel'] = ql
         self.radius = int(self.main.win_size_edit.text())
-        self.nor_const = 255 / (np.max(self.images))
+        first, last, maxValue = self.frameStats()
+        self.nor_const = 255 / maxValue
 
-        self.fFrame = (self.images[1] * self.nor_const).astype(np.uint8)
-        self.lFrame = (self.images[-1] * self.nor_const).astype(np.uint8)
+        self.fFrame = (first * self.nor_const).astype(np.uint8)
+        self.lFrame = (last * self.nor_const).astype(np.uint8)
         fps_f = goodFeaturesToTrack(
             self.fFrame, mask=None, **self.featureParams)
         fps_f = np.array([point[0] for point in fps_f])
@@ -1063,25 +1393,32 @@ class MultiScanWorker(QtCore.QObject):
         data_mean = []      # means of calculating window for each images
         cps_f = []          # center points of beads in first frame
         cps_l = []          # center points of beads in last frame
+        streamed = (self.builder is not None and
+                    self.builder.radius == self.radius)
+        if streamed:
+            # means already computed while scanning
+            centers = [c.astype(np.uint16) for c in self.centers]
+            data_mean = list(self.builder.means(centers, self.plane))
         for i in range(len(self.centers)):
-            data_mean.append([])
             # record the center point of gravity
             cps_f.append(self.find_cp(
                 self.fFrame, self.fps_f[i].astype(np.uint16), self.radius))
             cps_l.append(self.find_cp(
                 self.lFrame, self.fps_ll[i].astype(np.uint16), self.radius))
+            if streamed:
+                continue
 
             # calculate the mean of calculating window
-            for image in self.images:
+            data_mean.append([])
+            for image in self.getImages():
                 mean = self.meanROI(
                     image, self.centers[i].astype(np.uint16), self.radius)
                 data_mean[i].append(mean)
 
         # reconstruct the illumination image
         for i in range(len(data_mean)):
-            data_r = np.reshape(data_mean[i], self.steps)
-            if self.primScanDim == 'x':
-                data_r = data_r.T
+            data_r = scanimage.scanImage(data_mean[i], self.steps,
+                                         self.primScanDim)
             self.illumImgs.append(data_r)
             self.main.beadsBox.addItem(str(i))
 
@@ -1253,42 +1590,25 @@ class IllumImageWidget(pg.GraphicsLayoutWidget):
 
 class LaserCycle():
 
-    def __init__(self, device, pxCycle):
-        self.nidaq = device
+    def __init__(self, tasks, pxCycle):
+        self.tasks = tasks
         self.pxCycle = pxCycle
 
     def run(self):
-        self.dotask = nidaqmx.Task('dotaskLaser')
-
-        devs = list(self.pxCycle.sigDict.keys())
-        DOchans = range(1,5)
-        assert len(devs) == len(DOchans), '# digital channels is not the same as # devices'
-        it = range(0, len(devs))
-        for i in it:
-            print('Adding line', DOchans[i])
-            chanstring = 'Dev1/port0/line%s' % DOchans[i]
-            self.dotask.do_channels.add_do_chan(
-                lines=chanstring, name_to_assign_to_lines='chan%s' % devs[i])
-        
-        print('Finished adding lines')
-        
-        fullDOsig = np.array(
-            [self.pxCycle.sigDict[devs[i]] for i in range(0, len(DOchans))])
-        
-        self.dotask.timing.cfg_samp_clk_timing(
-           source=r'100kHzTimeBase',
-           rate=self.pxCycle.sampleRate,
-           sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS)
+        self.dotask = self.tasks.acquire('do', self)
 
-        self.dotask.write(fullDOsig, auto_start=False)
+        self.tasks.configure(
+            'do', self.pxCycle.sampleRate,
+            nidaqmx.constants.AcquisitionType.CONTINUOUS,
+            source=r'100kHzTimeBase')
+
+        self.tasks.write('do', self.pxCycle.portWord)
 
         self.dotask.start()
 
     def stop(self):
-        self.dotask.stop()
-        self.dotask.close()
+        self.tasks.release('do', self)
         del self.dotask
-        self.nidaq.reset_device()
 
 
 class StageScan():
@@ -1543,15 +1863,24 @@ class VOLscan():
 
 class PixelCycle():
     ''' Contains the digital signals for the pixel cycle. The update function
-    takes a parameter_values dict and updates the signal accordingly.'''
-    def __init__(self, sampleRate, devices):
+    takes a parameter_values dict and updates the signal accordingly.
+    Besides the signal of each device (sigDict), used for the plots, the
+    cycle is compiled into portWord, one word per sample with the bit of the
+    line of each device set when it is on. That is what the DO task writes
+    through its single port channel.'''
+    def __init__(self, sampleRate, devices, lines):
         self.sigDict = collections.OrderedDict()
+        self.spans = dict()
         for dev in devices:
             self.sigDict[dev] = []
+            self.spans[dev] = (0, 0)
 #        self.sigDict = collections.OrderedDict(
 #            [('405', []), ('488', []), ('473', []), ('CAM', [])])
+        self.lines = collections.OrderedDict(zip(devices, lines))
+        self.dtype = portDtype(lines)
         self.sampleRate = sampleRate
         self.cycleSamps = None
+        self.portWord = None
 
     def update(self, devices, parValues, cycleSamps):
         self.cycleSamps = cycleSamps
@@ -1563,8 +1892,14 @@ class PixelCycle():
             start_pos = int(min(start_pos, cycleSamps - 1))
             end_pos = parValues[end_name] * self.sampleRate
             end_pos = int(min(end_pos, cycleSamps))
-            signal[range(start_pos, end_pos)] = True
+            signal[start_pos:end_pos] = True
             self.sigDict[device] = signal
+            self.spans[device] = (start_pos, end_pos)
+
+        self.portWord = np.zeros(cycleSamps, dtype=self.dtype)
+        for device, line in self.lines.items():
+            start_pos, end_pos = self.spans[device]
+            self.portWord[start_pos:end_pos] |= self.dtype(1 << line)
 
 
 class GraphFrame(pg.GraphicsWindow):
@@ -1583,7 +1918,8 @@ class GraphFrame(pg.GraphicsWindow):
             r = Device_info[i][2][0]
             g = Device_info[i][2][1]
             b = Device_info[i][2][2]
-            self.plotSigDict[devs[i]] = self.plot.plot(pen=pg.mkPen(r,g,b))
+            self.plotSigDict[devs[i]] = guitools.EnvelopeCurve(
+                self.plot, pen=pg.mkPen(r,g,b))
             
 #        self.plotSigDict = {'405': self.plot.plot(pen=pg.mkPen(130, 0, 200)),
 #                            '488': self.plot.plot(pen=pg.mkPen(0, 247, 255)),
@@ -1599,6 +1935,50 @@ class GraphFrame(pg.GraphicsWindow):
             self.plotSigDict[device].setData(signal)
 
 
+class ScanPreview(pg.GraphicsWindow):
+    """Preview of the scan path: position of each axis along the scan,
+    drawn as envelopes so that long scans stay interactive, and path of the
+    stage in the xy plane."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.setWindowTitle('Scan path')
+        self.timePlot = self.addPlot(row=0, col=0)
+        self.timePlot.setLabels(bottom=('Time', 'ms'),
+                                left=('Position', 'µm'))
+        self.timePlot.showGrid(x=True, y=True)
+        self.timePlot.addLegend()
+        self.curves = collections.OrderedDict(
+            (axis, guitools.EnvelopeCurve(self.timePlot, pen=pen, name=axis))
+            for axis, pen in zip(['x', 'y', 'z'], ['r', 'g', 'c']))
+
+        self.pathPlot = self.addPlot(row=1, col=0)
+        self.pathPlot.setLabels(bottom=('x axis', 'µm'),
+                                left=('y axis', 'µm'))
+        self.pathPlot.setAspectLocked(True)
+        self.pathCurve = self.pathPlot.plot(pen='y')
+
+    def update(self, stageScan):
+        self.timePlot.getAxis('bottom').setScale(1000/stageScan.sampleRate)
+        position = {axis: stageScan.sigDict[axis] * convFactors[axis]
+                    for axis in self.curves}
+        for axis, curve in self.curves.items():
+            curve.setData(position[axis])
+
+        # The signals are ramps between multiples of seqSamps, only the ends
+        # of the ramps are needed for the path
+        n = len(position['x'])
+        seqSamps = stageScan.seqSamps
+        ends = np.union1d(np.arange(0, n, seqSamps),
+                          np.arange(seqSamps - 1, n, seqSamps))
+        self.pathCurve.setData(position['x'][ends], position['y'][ends])
+
+
+def portDtype(lines):
+    """Smallest word with a bit for each of the lines of a port."""
+    return np.uint8 if max(lines) < 8 else np.uint32
+
+
 def makeRamp(start, end, samples):
     return np.linspace(start, end, num=samples)
 
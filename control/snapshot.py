@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 21:02:14 2026
+
+@author: Tempesta_team
+
+Background snapshot of the instrument state for the recording attributes.
+Reading the laser powers over serial and the piezo position takes from
+milliseconds to seconds, so instead of querying them when a recording or snap
+starts, a thread polls them at a fixed interval (the 'Snapshot interval' of
+the parameter tree) and RecordingWidget.getAttrs takes the last values,
+without waiting.
+"""
+
+import time
+import threading
+import collections
+
+import control.metrics as metrics
+
+
+class SnapshotPoller():
+    """ Polls the registered sources (name, function returning the value)
+    every interval seconds. A source that fails keeps its last value, and
+    one that returns None has no value yet."""
+
+    def __init__(self, interval=1.):
+        self.interval = interval
+        self.sources = collections.OrderedDict()
+        self.values = {}
+        self.times = {}
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        # Set to cut the current wait short, on a new interval or a stop
+        self.wakeEvent = threading.Event()
+        self.thread = None
+
+    def add(self, name, getter):
+        with self.lock:
+            self.sources[name] = getter
+
+    def setInterval(self, interval):
+        self.interval = interval
+        self.wakeEvent.set()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if not self.running:
+            self.stopEvent.clear()
+            self.wakeEvent.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True,
+                                           name='snapshot')
+            self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.wakeEvent.set()
+        if self.thread is not None:
+            self.thread.join(5)
+            self.thread = None
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            t0 = time.perf_counter()
+            self.poll()
+            metrics.observe('snapshot.poll', 1000*(time.perf_counter() - t0))
+            self.wakeEvent.wait(max(0, self.interval -
+                                    (time.perf_counter() - t0)))
+            self.wakeEvent.clear()
+
+    def poll(self):
+        with self.lock:
+            sources = list(self.sources.items())
+        for name, getter in sources:
+            try:
+                value = getter()
+            except Exception:
+                metrics.count('snapshot.errors')
+                continue
+            if value is None:
+                continue
+            with self.lock:
+                self.values[name] = value
+                self.times[name] = time.time()
+
+    def snapshot(self):
+        """ (name, value) of the sources read at least once, in the order
+        they were added."""
+        with self.lock:
+            return [(name, self.values[name]) for name in self.sources
+                    if name in self.values]
+
+    def age(self):
+        """ Seconds since the oldest value of the snapshot was read."""
+        with self.lock:
+            if not self.times:
+                return None
+            return time.time() - min(self.times.values())
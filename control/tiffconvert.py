@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 20:21:37 2026
+
+@author: Tempesta_team
+
+Conversion of HDF5 recordings to TIFF. Every image dataset of a file (see
+IMAGE_NAMES, also the ones in the z plane groups of the scans) is streamed
+in blocks of frames into a single BigTIFF, so neither the dataset nor the
+output have to fit in memory and no frames are lost splitting files. The
+attributes of the dataset go to a .txt file and the other datasets
+(FrameMeta, the time axis of the dual camera recordings...) to .csv files.
+The files are converted in parallel by a process pool, one file per
+process.
+
+Used by guitools.TiffConverter and from the command line:
+    python -m control.tiffconvert rec1.hdf5 rec2.hdf5 [--processes N]
+"""
+
+import os
+import re
+import time
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+import h5py as hdf
+import tifffile as tiff
+
+# Frames read from the HDF5 file at a time are about this size
+BLOCK_BYTES = 2**26
+
+# Names of the image datasets: snapshots ('data'), recordings ('Images') and
+# dual camera recordings ('Channel0', 'Channel1')
+IMAGE_NAMES = re.compile(r'(data|Images|Channel\d+)$')
+
+
+def datasets(filename):
+    """ (name, shape) of the image datasets and names of the tables of an
+    HDF5 file."""
+    images = []
+    tables = []
+
+    def visit(name, item):
+        if isinstance(item, hdf.Dataset):
+            image = IMAGE_NAMES.match(name.split('/')[-1])
+            if image and item.ndim in (2, 3) and item.dtype.names is None:
+                images.append((name, item.shape))
+            else:
+                tables.append(name)
+
+    with hdf.File(filename, 'r') as f:
+        f.visititems(visit)
+    return images, tables
+
+
+def nFrames(shape):
+    return shape[0] if len(shape) == 3 else 1
+
+
+def outputName(filename, dataname):
+    return (os.path.splitext(filename)[0] + '_' +
+            dataname.replace('/', '_'))
+
+
+def convertDataset(data, name, queue=None, key=None):
+    """ Streams an image dataset into name.tiff. Sends the number of frames
+    written after every block to the queue."""
+    with open(name + '.txt', 'w') as fp:
+        fp.write('\n'.join('{}= {}'.format(*x) for x in data.attrs.items()))
+
+    if data.ndim == 2:
+        frames = [(0, data[()][np.newaxis])]
+    else:
+        frameBytes = data.dtype.itemsize * int(np.prod(data.shape[1:]))
+        n = max(1, BLOCK_BYTES // frameBytes)
+        frames = ((i, data[i:i + n]) for i in range(0, len(data), n))
+
+    with tiff.TiffWriter(name + '.tiff', bigtiff=True,
+                         software='Tormenta') as tfile:
+        for i, block in frames:
+            for j, frame in enumerate(block):
+                if i + j == 0:
+                    tfile.save(frame, description=data.name)
+                else:
+                    tfile.save(frame)
+            if queue is not None:
+                queue.put((key, len(block)))
+
+
+def convertTable(data, name):
+    table = data[()]
+    if table.dtype.names is None:
+        np.savetxt(name + '.csv', np.atleast_1d(table), delimiter=',')
+    else:
+        np.savetxt(name + '.csv', table, fmt='%s', delimiter=',',
+                   header=','.join(table.dtype.names), comments='')
+
+
+def convertFile(args):
+    """ Converts all the datasets of a file. Runs in the pool workers."""
+    filename, queue = args
+    images, tables = datasets(filename)
+    with hdf.File(filename, 'r') as f:
+        for dataname, shape in images:
+            convertDataset(f[dataname], outputName(filename, dataname),
+                           queue, filename)
+        for dataname in tables:
+            convertTable(f[dataname], outputName(filename, dataname))
+    return filename
+
+
+def printProgress(done, total, filename=None):
+    print('{:5.1f}% of {} frames'.format(100 * done / max(total, 1), total),
+          end='\r')
+
+
+def convert(filenames, processes=None, progress=printProgress,
+            interval=0.5):
+    """ Converts the HDF5 files, calling progress(frames done, total frames,
+    last file) every interval seconds. Returns the converted files."""
+    filenames = list(filenames)
+    if len(filenames) == 0:
+        return []
+    total = sum(nFrames(shape) for filename in filenames
+                for _, shape in datasets(filename)[0])
+    if processes is None:
+        processes = mp.cpu_count()
+    processes = max(1, min(processes, len(filenames)))
+
+    manager = mp.Manager()
+    queue = manager.Queue()
+    pool = mp.Pool(processes=processes)
+    result = pool.map_async(convertFile, [(f, queue) for f in filenames])
+
+    done = 0
+    last = None
+    while True:
+        finished = result.ready()
+        while not queue.empty():
+            last, n = queue.get()
+            done += n
+        if progress is not None:
+            progress(done, total, last)
+        if finished:
+            break
+        time.sleep(interval)
+
+    pool.close()
+    manager.shutdown()
+    # Raises the errors of the workers
+    return result.get()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Converts HDF5 recordings to BigTIFF')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    t0 = time.time()
+    converted = convert(args.files, args.processes)
+    print('\n{} files exported to TIFF in {:.1f} s'.format(
+        len(converted), time.time() - t0))
@@ -19,8 +19,17 @@
 
 import ctypes
 import ctypes.util
+import json
+import os
+import time
 import numpy as np
 
+try:
+    from control import metrics
+except ImportError:
+    # Driver used outside of Tempesta, no metrics are recorded.
+    metrics = None
+
 print('hellooooooooooooooooooooooooooooooooooooooooo')
 
 # Hamamatsu constants.
@@ -33,6 +42,7 @@ DCAMERR_NOERROR = 1
 DCAMPROP_ATTR_HASVALUETEXT = int("0x10000000", 0)
 DCAMPROP_ATTR_READABLE = int("0x00010000", 0)
 DCAMPROP_ATTR_WRITABLE = int("0x00020000", 0)
+DCAMPROP_ATTR_VOLATILE = int("0x00080000", 0)
 
 DCAMPROP_OPTION_NEAREST = int("0x80000000", 0)
 DCAMPROP_OPTION_NEXT = int("0x01000000", 0)
@@ -141,9 +151,12 @@ class HCamData():
     # Create a data object of the appropriate size.
     #
     # @param size The size of the data object in bytes.
+    # @param np_array Existing uint16 array to use as storage (optional).
     #
-    def __init__(self, size):
-        self.np_array = np.ascontiguousarray(np.empty(np.int(size/2), dtype=np.uint16))
+    def __init__(self, size, np_array=None):
+        if np_array is None:
+            np_array = np.empty(int(size/2), dtype=np.uint16)
+        self.np_array = np.ascontiguousarray(np_array)
         self.size = size
 
     ## __getitem__
@@ -178,6 +191,101 @@ class HCamData():
         return self.np_array.ctypes.data
 
 
+## HCamBufferPool
+#
+# Storage for the camera buffers of HamamatsuCameraMR.
+#
+# A single block of memory (the buffer budget) is allocated once and carved
+# into aligned frame buffers for whatever frame size is being acquired, so
+# changing the ROI doesn't allocate anything. The carving for each frame size
+# is kept, switching back to a previous frame size is free. The memory is
+# only allocated again if the budget changes.
+#
+class HCamBufferPool():
+
+    ## __init__
+    #
+    # @param budget The size of the memory block in bytes.
+    # @param alignment Alignment of each frame buffer in bytes.
+    #
+    def __init__(self, budget, alignment=4096):
+        self.alignment = alignment
+        self.budget = 0
+        self.slab = None
+        self.layouts = {}
+        self.setBudget(budget)
+
+    ## setBudget
+    #
+    # Change the size of the memory block. The buffers of the previous
+    # block must not be in use by the camera.
+    #
+    # @param budget The size of the memory block in bytes.
+    #
+    def setBudget(self, budget):
+        budget = int(budget)
+        if (budget == self.budget):
+            return
+        raw = np.empty(budget + self.alignment, dtype=np.uint8)
+        offset = -raw.ctypes.data % self.alignment
+        self.slab = raw[offset:offset + budget]
+        self.budget = budget
+        self.layouts = {}
+
+    ## carve
+    #
+    # @param frame_bytes The size of a frame in bytes.
+    #
+    # @return [array of buffer pointers for dcam_attachbuffer, list-like
+    #   of HCamData objects, one per buffer]
+    #
+    def carve(self, frame_bytes):
+        if (frame_bytes not in self.layouts):
+            stride = -(-frame_bytes // self.alignment) * self.alignment
+            n_buffers = self.budget // stride
+            if (n_buffers < 1):
+                raise DCAMException("buffer budget of " + str(self.budget) +
+                                    " bytes is smaller than one frame")
+            addresses = (self.slab.ctypes.data +
+                         stride * np.arange(n_buffers, dtype=np.uint64))
+            ptr_array = (ctypes.c_void_p * n_buffers).from_buffer(addresses)
+            views = HCamDataViews(self.slab, frame_bytes, stride, n_buffers)
+            # The pointer array doesn't own the addresses array.
+            self.layouts[frame_bytes] = (ptr_array, views, addresses)
+
+        return self.layouts[frame_bytes][:2]
+
+
+## HCamDataViews
+#
+# The frame buffers of a HCamBufferPool. The HCamData objects are created
+# on first access, there can be tens of thousands of small buffers.
+#
+class HCamDataViews():
+
+    def __init__(self, slab, frame_bytes, stride, n_buffers):
+        self.slab = slab
+        self.frame_bytes = frame_bytes
+        self.stride = stride
+        self.n_buffers = n_buffers
+        self.hcam_data = {}
+
+    def __len__(self):
+        return self.n_buffers
+
+    def __getitem__(self, n):
+        try:
+            return self.hcam_data[n]
+        except KeyError:
+            if not (0 <= n < self.n_buffers):
+                raise IndexError("buffer index out of range")
+            start = n * self.stride
+            view = self.slab[start:start + self.frame_bytes].view(np.uint16)
+            hc_data = HCamData(self.frame_bytes, view)
+            self.hcam_data[n] = hc_data
+            return hc_data
+
+
 ## HamamatsuCamera
 #
 # Basic camera interface class.
@@ -193,9 +301,16 @@ class HamamatsuCamera():
     #
     # Open the connection to the camera specified by camera_id.
     #
+    # Property attributes (type, flags, range) and text options are cached
+    # for the session, property values until the next property change or
+    # acquisition start. If cache_dir is given the property ids, attributes
+    # and text options are also stored there, one file per camera model, so
+    # the next time the camera is opened they don't have to be enumerated.
+    #
     # @param camera_id The id of the camera (an integer).
+    # @param cache_dir Directory for the property cache files (or None).
     #
-    def __init__(self, camera_id):
+    def __init__(self, camera_id, cache_dir=None):
 
         self.buffer_index = 0
         self.camera_id = camera_id
@@ -205,10 +320,24 @@ class HamamatsuCamera():
         self.frame_x = 0
         self.frame_y = 0
         self.last_frame_number = 0
+        self.frame_numbers = []
+        self.frame_buffers = []
+        self.backlog = 0
         self.properties = {}
+        self.prop_attrs = {}
+        self.prop_texts = {}
+        self.prop_values = {}
+        self.prop_ranges = {}
         self.max_backlog = 0
         self.number_image_buffers = 0
 
+        self.cache_file = None
+        if cache_dir is not None:
+            model = self.camera_model.decode("utf-8", "replace")
+            model = "".join(c if c.isalnum() else "_" for c in model)
+            self.cache_file = os.path.join(cache_dir,
+                                           "hamamatsu_" + model + ".json")
+
         # Open the camera.
         self.camera_handle = ctypes.c_void_p(0)
         self.checkStatus(dcam.dcam_open(ctypes.byref(self.camera_handle),
@@ -216,7 +345,9 @@ class HamamatsuCamera():
                                         None),
                          "dcam_open")
         # Get camera properties.
-        self.properties = self.getCameraProperties()
+        if not self.loadPropertyCache():
+            self.properties = self.getCameraProperties()
+            self.savePropertyCache()
         # Get camera max width, height.
         self.max_width = self.getPropertyValue("image_width")[0]
         self.max_height = self.getPropertyValue("image_height")[0]
@@ -230,6 +361,8 @@ class HamamatsuCamera():
     def captureSetup(self):
         self.buffer_index = -1
         self.last_frame_number = 0
+        self.frame_numbers = []
+        self.invalidateValues()
 
         # Set sub array mode.
         self.setSubArrayMode()
@@ -322,6 +455,7 @@ class HamamatsuCamera():
     # @return [frames, [frame x size, frame y size]]
     #
     def getFrames(self):
+        t0 = time.perf_counter()
         frames = []
         for n in self.newFrames():
 
@@ -347,6 +481,9 @@ class HamamatsuCamera():
 
             frames.append(hc_data)
 
+        if metrics is not None:
+            metrics.observe('camera.getFrames',
+                            1000*(time.perf_counter() - t0))
         return [frames, [self.frame_x, self.frame_y]]
         
     ## getModelInfo
@@ -377,17 +514,81 @@ class HamamatsuCamera():
     def getProperties(self):
         return self.properties
 
-    ## getPropertyAttribute
+    ## loadPropertyCache
     #
-    # Return the attribute structure of a particular property.
+    # Load the property ids, attributes and text options stored for this
+    # camera model by savePropertyCache.
     #
-    # FIXME (OPTIMIZATION): Keep track of known attributes?
+    # @return True if the cache was loaded.
+    #
+    def loadPropertyCache(self):
+        if (self.cache_file is None) or not os.path.exists(self.cache_file):
+            return False
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            properties = cache["properties"]
+            prop_attrs = {}
+            for name, fields in cache["attributes"].items():
+                p_attr = DCAM_PARAM_PROPERTYATTR(**fields)
+                prop_attrs[name] = p_attr
+            prop_texts = {}
+            for name, texts in cache["texts"].items():
+                prop_texts[name] = {k.encode("latin-1"): v
+                                    for k, v in texts.items()}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(" could not load property cache", self.cache_file, e)
+            return False
+
+        self.properties = properties
+        self.prop_attrs = prop_attrs
+        self.prop_texts = prop_texts
+        return True
+
+    ## savePropertyCache
+    #
+    # Store the property ids, attributes and text options of the camera
+    # so that they are not queried again next time the camera is opened.
+    #
+    def savePropertyCache(self):
+        if (self.cache_file is None):
+            return
+        attributes = {}
+        texts = {}
+        for name in self.properties:
+            p_attr = self.getPropertyAttribute(name)
+            if p_attr is False:
+                continue
+            attributes[name] = {f[0]: getattr(p_attr, f[0])
+                                for f in p_attr._fields_}
+            texts[name] = {k.decode("latin-1"): v
+                           for k, v in self.getPropertyText(name).items()}
+        try:
+            os.makedirs(os.path.dirname(self.cache_file) or ".",
+                        exist_ok=True)
+            with open(self.cache_file, "w") as f:
+                json.dump({"model": self.camera_model.decode("latin-1"),
+                           "properties": self.properties,
+                           "attributes": attributes,
+                           "texts": texts}, f, indent=1, sort_keys=True)
+        except OSError as e:
+            print(" could not save property cache", self.cache_file, e)
+
+    ## getPropertyAttribute
+    #
+    # Return the attribute structure of a particular property. The attributes
+    # are cached, the range of a property can depend on the value of other
+    # properties though, use refresh to query the camera again.
     #
     # @param property_name The name of the property to get the attributes of.
+    # @param refresh Ignore the cached attributes.
     #
     # @return A DCAM_PARAM_PROPERTYATTR object.
     #
-    def getPropertyAttribute(self, property_name):
+    def getPropertyAttribute(self, property_name, refresh=False):
+        if not refresh and (property_name in self.prop_attrs):
+            return self.prop_attrs[property_name]
+
         p_attr = DCAM_PARAM_PROPERTYATTR()
         p_attr.cbSize = ctypes.sizeof(p_attr)
         p_attr.iProp = self.properties[property_name]
@@ -395,9 +596,10 @@ class HamamatsuCamera():
                                                          ctypes.byref(p_attr)),
                                "dcam_getpropertyattr")
         if (ret == 0):
-            print(" property", property_id, "is not supported")
+            print(" property", property_name, "is not supported")
             return False
         else:
+            self.prop_attrs[property_name] = p_attr
             return p_attr
 
     ## getPropertyText
@@ -409,8 +611,12 @@ class HamamatsuCamera():
     # @return A dictionary of text properties (which may be empty).
     #
     def getPropertyText(self, property_name):
+        if (property_name in self.prop_texts):
+            return self.prop_texts[property_name]
+
         prop_attr = self.getPropertyAttribute(property_name)
         if not (prop_attr.attribute & DCAMPROP_ATTR_HASVALUETEXT):
+            self.prop_texts[property_name] = {}
             return {}
         else:
             # Create property text structure.
@@ -446,23 +652,31 @@ class HamamatsuCamera():
                 if (ret == 0):
                     done = True
 
+            self.prop_texts[property_name] = text_options
             return text_options
 
     ## getPropertyRange
     #
-    # Return the range for an attribute.
+    # Return the range for an attribute. The range is queried from the camera
+    # the first time after a property is set, since it can depend on other
+    # properties (see setPropertyValue), and cached until then.
     #
     # @param property_name The name of the property (as a string).
+    # @param refresh Query the camera instead of using the cached range.
     #
     # @return [minimum value, maximum value]
     #
-    def getPropertyRange(self, property_name):
-        prop_attr = self.getPropertyAttribute(property_name)
+    def getPropertyRange(self, property_name, refresh=False):
+        if not refresh and (property_name in self.prop_ranges):
+            return list(self.prop_ranges[property_name])
+        prop_attr = self.getPropertyAttribute(property_name, True)
         temp = prop_attr.attribute & DCAMPROP_TYPE_MASK
         if (temp == DCAMPROP_TYPE_REAL):
-            return [float(prop_attr.valuemin), float(prop_attr.valuemax)]
+            prop_range = [float(prop_attr.valuemin), float(prop_attr.valuemax)]
         else:
-            return [int(prop_attr.valuemin), int(prop_attr.valuemax)]
+            prop_range = [int(prop_attr.valuemin), int(prop_attr.valuemax)]
+        self.prop_ranges[property_name] = prop_range
+        return list(prop_range)
 
     ## getPropertyRW
     #
@@ -504,6 +718,14 @@ class HamamatsuCamera():
             return False
         prop_id = self.properties[property_name]
 
+        # Values are cached until the next property change.
+        if (property_name in self.prop_values):
+            if metrics is not None:
+                metrics.count('camera.property.cached')
+            return list(self.prop_values[property_name])
+        if metrics is not None:
+            metrics.count('camera.property.read')
+
         # Get the property attributes.
         prop_attr = self.getPropertyAttribute(property_name)
 
@@ -528,9 +750,22 @@ class HamamatsuCamera():
         else:
             prop_type = "NONE"
             prop_value = False
-    
+
+        # Volatile properties (temperature, ...) change by themselves.
+        if not (prop_attr.attribute & DCAMPROP_ATTR_VOLATILE):
+            self.prop_values[property_name] = [prop_value, prop_type]
+
         return [prop_value, prop_type]
 
+    ## invalidateValues
+    #
+    # Forget the cached property values. Setting a property can change the
+    # value of others (the frame size after a subarray change, the frame rate
+    # after an exposure change, ...) so all of them are dropped.
+    #
+    def invalidateValues(self):
+        self.prop_values = {}
+
     ## isCameraProperty
     #
     # Check if a property name is supported by the camera.
@@ -556,12 +791,15 @@ class HamamatsuCamera():
     def newFrames(self):
 
         # Wait for a new frame.
+        t0 = time.perf_counter()
         dwait = ctypes.c_int(DCAMCAP_EVENT_FRAMEREADY)
         self.checkStatus(dcam.dcam_wait(self.camera_handle,
                                         ctypes.byref(dwait),
                                         ctypes.c_int(DCAMWAIT_TIMEOUT_INFINITE),
                                         None),
                          "dcam_wait")
+        if metrics is not None:
+            metrics.observe('camera.wait', 1000*(time.perf_counter() - t0))
 
         # Check how many new frames there are.
         b_index = ctypes.c_int32(0)
@@ -577,9 +815,14 @@ class HamamatsuCamera():
         backlog = cur_frame_number - self.last_frame_number
         if (backlog > self.number_image_buffers):
             print("warning: hamamatsu camera frame buffer overrun detected!")
+            if metrics is not None:
+                metrics.count('camera.overruns')
         if (backlog > self.max_backlog):
             self.max_backlog = backlog
         self.last_frame_number = cur_frame_number
+        if metrics is not None:
+            metrics.observe('camera.backlog', backlog)
+            metrics.count('camera.frames', backlog)
 
         cur_buffer_index = b_index.value
 
@@ -595,6 +838,14 @@ class HamamatsuCamera():
                 new_frames.append(i+1)
         self.buffer_index = cur_buffer_index
 
+        # DCAM frame counter of each of the new frames, the last one is the
+        # most recent frame.
+        n = len(new_frames)
+        self.frame_numbers = list(range(cur_frame_number - n + 1,
+                                        cur_frame_number + 1))
+        self.frame_buffers = new_frames
+        self.backlog = backlog
+
         if self.debug:
             print(new_frames)
 
@@ -604,6 +855,12 @@ class HamamatsuCamera():
     #
     # Set the value of a property.
     #
+    # The range of a property can depend on other properties (the subarray
+    # size on the subarray position for example) and DCAM doesn't tell which
+    # ones, so setting a property drops all the cached ranges. The range is
+    # also queried again when the value falls outside of it and when the
+    # camera rejects the value.
+    #
     # @param property_name The name of the property.
     # @param property_value The value to set the property to.
     #
@@ -616,23 +873,64 @@ class HamamatsuCamera():
 
         # If the value is text, figure out what the 
         # corresponding numerical property value is.
-        if (type(property_value) == type("")):
+        if isinstance(property_value, (str, bytes)):
             text_values = self.getPropertyText(property_name)
-            if (property_value in text_values):
-                property_value = float(text_values[property_value])
+            if isinstance(property_value, str):
+                key = property_value.encode("utf-8")
+            else:
+                key = property_value
+            if (key in text_values):
+                property_value = float(text_values[key])
             else:
                 print(" unknown property text value:", property_value, "for", property_name)
                 return False
 
+        try:
+            return self.writePropertyValue(property_name, property_value)
+        except DCAMException:
+            # Maybe the cached range is stale, try again with the current one.
+            return self.writePropertyValue(property_name, property_value,
+                                           refresh=True)
+        finally:
+            self.invalidateValues()
+            self.prop_ranges = {}
+
+    ## setPropertyValues
+    #
+    # Set several properties in the given order (the order matters for
+    # properties that constrain each other like the subarray position and
+    # size). DCAM sets one property at a time, so this is the same as
+    # calling setPropertyValue for each of them.
+    #
+    # @param values A list of (property name, value) pairs or a dictionary.
+    #
+    # @return A list with the values the properties were set to.
+    #
+    def setPropertyValues(self, values):
+        if isinstance(values, dict):
+            values = values.items()
+        return [self.setPropertyValue(name, value) for name, value in values]
+
+    ## writePropertyValue
+    #
+    # Range check and write of a numerical property value (internal use only).
+    #
+    # @return The value the property was set to.
+    #
+    def writePropertyValue(self, property_name, property_value,
+                           refresh=False):
+
         # Check that the property is within range.
-        [pv_min, pv_max] = self.getPropertyRange(property_name)
+        [pv_min, pv_max] = self.getPropertyRange(property_name, refresh)
+        if not refresh and not (pv_min <= property_value <= pv_max):
+            [pv_min, pv_max] = self.getPropertyRange(property_name, True)
         if (property_value < pv_min):
             print(" set property value", property_value, "is less than minimum of", pv_min, property_name, "setting to minimum")
             property_value = pv_min
         if (property_value > pv_max):
             print(" set property value", property_value, "is greater than maximum of", pv_max, property_name, "setting to maximum")
             property_value = pv_max
-        
+
         # Set the property value, return what it was set too.
         prop_id = self.properties[property_name]
         p_value = ctypes.c_double(property_value)
@@ -665,7 +963,6 @@ class HamamatsuCamera():
     #
     def startAcquisition(self):
         self.captureSetup()
-        print(self.frame_bytes)
         #
         # Allocate Hamamatsu image buffers.
         # We allocate enough to buffer 2 seconds of data.
@@ -733,13 +1030,17 @@ class HamamatsuCameraMR(HamamatsuCamera):
     ## __init__
     #
     # @param camera_id The id of the camera.
+    # @param cache_dir Directory for the property cache files (or None).
+    # @param buffer_budget Memory for the camera buffers in bytes.
     #
-    def __init__(self, camera_id):
-        HamamatsuCamera.__init__(self, camera_id)
+    def __init__(self, camera_id, cache_dir=None,
+                 buffer_budget=2*1024*1024*1024):
+        HamamatsuCamera.__init__(self, camera_id, cache_dir)
 
         self.hcam_data = []
         self.hcam_ptr = False
-        self.old_frame_bytes = -1
+        self.buffer_budget = buffer_budget
+        self.buffer_pool = None
 
         self.setPropertyValue("output_trigger_kind[0]", 2)
 
@@ -756,38 +1057,45 @@ class HamamatsuCameraMR(HamamatsuCamera):
     # @return [frames, [frame x size, frame y size]]
     #
     def getFrames(self):
+        t0 = time.perf_counter()
         frames = []
         for n in self.newFrames():
             frames.append(self.hcam_data[n])
 
+        if metrics is not None:
+            metrics.observe('camera.getFrames',
+                            1000*(time.perf_counter() - t0))
         return [frames, [self.frame_x, self.frame_y]]
 
+    ## setBufferBudget
+    #
+    # Change the memory used for the camera buffers, it is applied at the
+    # next acquisition start.
+    #
+    # @param buffer_budget Memory for the camera buffers in bytes.
+    #
+    def setBufferBudget(self, buffer_budget):
+        self.buffer_budget = int(buffer_budget)
+
     ## startAcquisition
     #
-    # Allocate as many frames as will fit in 2GB of memory and start data acquisition.
+    # Use as many frames as fit in the buffer budget and start data
+    # acquisition. The buffers are carved out of the memory of the buffer
+    # pool, which is only allocated the first time and when the budget
+    # changes.
     #
     def startAcquisition(self):
         self.captureSetup()
-        print(self.frame_bytes)
-        #
-        # Allocate new image buffers if necessary.
-        # Allocate as many frames as can fit in 2GB of memory.
-        #
-        if (self.old_frame_bytes != self.frame_bytes):
-
-            n_buffers = int((2.0 * 1024 * 1024 * 1024)/self.frame_bytes)
-            self.number_image_buffers = n_buffers
 
-            # Allocate new image buffers.
-            ptr_array = ctypes.c_void_p * self.number_image_buffers
-            self.hcam_ptr = ptr_array()
-            self.hcam_data = []
-            for i in range(self.number_image_buffers):
-                hc_data = HCamData(self.frame_bytes)
-                self.hcam_ptr[i] = hc_data.getDataPtr()
-                self.hcam_data.append(hc_data)
-
-            self.old_frame_bytes = self.frame_bytes
+        t0 = time.perf_counter()
+        if (self.buffer_pool is None):
+            self.buffer_pool = HCamBufferPool(self.buffer_budget)
+        else:
+            self.buffer_pool.setBudget(self.buffer_budget)
+        [self.hcam_ptr, self.hcam_data] = self.buffer_pool.carve(self.frame_bytes)
+        self.number_image_buffers = len(self.hcam_data)
+        if metrics is not None:
+            metrics.observe('camera.buffers', 1000*(time.perf_counter() - t0))
 
         # Attach image buffers.
         #